@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import argparse
+import mmap
+import os
+import sys
+from multiprocessing import Pool
+
+from convert_to_influx import TimestampParser, convert_lines, make_timezone
+
+# Set in each worker process by init_worker
+worker_options = None
+
+def init_worker(result_header, measurement, tag, timezone_name):
+    global worker_options
+    worker_options = {
+        'result_header': result_header,
+        'measurement': measurement,
+        'tag': tag,
+        'parse_timestamp': TimestampParser(make_timezone(timezone_name)),
+    }
+
+def split_chunks(path, chunk_size):
+    # (path, start, end) byte ranges of about chunk_size, each ending just after a newline
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunks = []
+            start = 0
+            while start < size:
+                end = mm.find(b"\n", min(start + chunk_size, size) - 1)
+                end = size if end == -1 else end + 1
+                chunks.append((path, start, end))
+                start = end
+            return chunks
+
+def convert_chunk(chunk):
+    # Runs in a worker: map the file and convert its part, only the result travels back
+    path, start, end = chunk
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines = mm[start:end].split(b"\n")
+    converted = convert_lines(lines, **worker_options)
+    return path, "\n".join(converted) + "\n" if converted else ""
+
+def output_names(paths):
+    # <file>.lp per input; inputs with the same name from different directories get the directories
+    # that tell them apart in front (a/run.log, b/run.log -> a_run.log.lp, b_run.log.lp)
+    def stem(path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    stems = {}
+    for path in paths:
+        stems.setdefault(stem(path), set()).add(os.path.abspath(path))
+    names = {}
+    for path in paths:
+        same = stems[stem(path)]
+        if len(same) == 1:
+            names[path] = stem(path) + ".lp"
+        else:
+            common = os.path.commonpath([os.path.dirname(other) for other in same])
+            names[path] = os.path.relpath(os.path.abspath(path), common).replace(os.sep, "_") + ".lp"
+    return names
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert archived G-code response logs to InfluxDB line protocol on all cores.")
+    parser.add_argument("files", nargs="+", help="Log files captured with gcode_response_spy.py")
+    parser.add_argument("--result-header", required=True, help="The header used to split the log line and extract results.")
+    parser.add_argument("--measurement", required=True, help="The measurement name to use in the InfluxDB line protocol.")
+    parser.add_argument("--tag", help="Optional tag in the format key=value to add to the InfluxDB line protocol.")
+    parser.add_argument("--timezone", default="local",
+                        help="Time zone of the log timestamps: 'local', 'UTC' or a name like Europe/Helsinki (default: local)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Worker processes (default: one per core)")
+    parser.add_argument("--chunk-size", type=int, default=16 << 20, help="Bytes of log per work unit (default: 16 MiB)")
+    parser.add_argument("--output-dir", help="Write <file>.lp per input file into this directory (default: all to stdout)")
+    parser.add_argument("--bucket", help="Write straight to this InfluxDB bucket with the batched writer instead")
+    parser.add_argument("--config-file", default=os.path.expanduser("~/.influxdbv2/configs"),
+                        help="Path to the INI config file (default: ~/.influxdbv2/configs)")
+    parser.add_argument("--config-name", default="onboarding",
+                        help="Configuration profile name in the INI file (default: onboarding)")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the request bodies when writing to InfluxDB")
+    args = parser.parse_args()
+    if args.output_dir:
+        args.output_names = output_names(args.files)
+        by_name = {}
+        for path, name in args.output_names.items():
+            by_name.setdefault(name, set()).add(os.path.abspath(path))
+        for name, paths in by_name.items():
+            if len(paths) > 1:
+                parser.error(f"{', '.join(sorted(paths))} would all be written to {name}")
+    return args
+
+def main():
+    args = parse_arguments()
+
+    writer = None
+    if args.bucket:
+        from influx_write_by_line import InfluxWriter, load_config
+        url, token, org = load_config(args.config_file, args.config_name)
+        writer = InfluxWriter(url, token, org, args.bucket, use_gzip=args.gzip)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    chunks = [chunk for path in args.files for chunk in split_chunks(path, args.chunk_size)]
+    outputs = {}
+    with Pool(args.jobs, initializer=init_worker,
+              initargs=(args.result_header, args.measurement, args.tag, args.timezone)) as pool:
+        # imap keeps the input order: files as given, chunks from start to end
+        for path, converted in pool.imap(convert_chunk, chunks):
+            if not converted:
+                continue
+            if writer:
+                for line in converted.splitlines():
+                    writer.add(line)
+            elif args.output_dir:
+                out = outputs.get(path)
+                if out is None:
+                    out = outputs[path] = open(os.path.join(args.output_dir, args.output_names[path]), "w")
+                out.write(converted)
+            else:
+                sys.stdout.write(converted)
+
+    for out in outputs.values():
+        out.close()
+    if writer:
+        writer.close()
+        print(writer.summary(), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
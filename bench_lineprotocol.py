@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import argparse
+import random
+import re
+import time
+
+from lineprotocol import format_line, parse_line, parse_lines
+
+def legacy_parse_line_protocol(line):
+    # The per-line regex parser summarizer.py and humanread.py used before lineprotocol.py, as a baseline
+    pattern = r'(?P<measurement>[\w_]+)(?:,(?P<tag>[\w=]+))? (?P<fields>.+) (?P<timestamp>\d+)$'
+    match = re.match(pattern, line)
+    if not match:
+        return None
+    field_data = {}
+    for field in match.group('fields').split(','):
+        key, value = field.split('=')
+        try:
+            field_data[key] = float(value)
+        except ValueError:
+            continue
+    return {
+        'measurement': match.group('measurement'),
+        'tag': match.group('tag'),
+        'fields': field_data,
+        'timestamp': int(match.group('timestamp'))
+    }
+
+def sample_lines(count, seed=1):
+    # Shaped like the pipelines' output: templogger temperatures, convert_to_influx probe results,
+    # and a few lines with multiple tags, escaping, integers and strings
+    rng = random.Random(seed)
+    timestamp = 1729080000000000000
+    lines = []
+    for i in range(count):
+        timestamp += rng.randint(100_000_000, 300_000_000)
+        kind = i % 10
+        if kind < 7:
+            lines.append(f"ratos2,printer=vc4 extruder_temp={200 + rng.random():.2f},extruder_target=200.0,"
+                         f"extruder_pwm={rng.random():.3f},heater_bed_temp={60 + rng.random():.2f},"
+                         f"heater_bed_target=60.0,heater_bed_pwm={rng.random():.3f} {timestamp}")
+        elif kind < 9:
+            lines.append(f"probe,printer=vc4-400 maximum={2.5 + rng.random() / 100:.6f},minimum=2.49,range=0.0025,"
+                         f"average=2.495,median=2.495,standard_deviation=0.000713 {timestamp}")
+        else:
+            lines.append(f"probe_loop,host=ratos2.local,printer=vc4\\ 400 loop={i}i,midpoint=false,"
+                         f"message=\"Loop count: {i}\" {timestamp}")
+    return lines
+
+def run(name, function, repeat, count):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    # A parser that gives up on a line is cheap, so say how many it actually understood
+    understood = sum(item is not None for item in result)
+    print(f"{name:<28} {count / best:>12,.0f} lines/s  ({best * 1000:.1f} ms, {understood}/{count} lines)", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the line protocol parser and serializer.")
+    parser.add_argument("--input", help="Recorded line protocol capture to benchmark with (default: built-in sample lines)")
+    parser.add_argument("--lines", type=int, default=100000, help="Number of sample lines when no --input is given (default: 100000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark, the best one is reported (default: 5)")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            lines = [line.rstrip("\n") for line in f if line.strip()]
+    else:
+        lines = sample_lines(args.lines)
+    buffer = "\n".join(lines)
+    points = [point for point in map(parse_line, lines) if point is not None]
+    count = len(lines)
+    print(f"{count} lines, {len(points)} valid, {len(buffer) / 1e6:.1f} MB")
+
+    run("legacy regex parse", lambda: [legacy_parse_line_protocol(line) for line in lines], args.repeat, count)
+    run("parse_line", lambda: [parse_line(line) for line in lines], args.repeat, count)
+    run("parse_lines (buffer)", lambda: parse_lines(buffer), args.repeat, count)
+    run("format_line", lambda: [format_line(p['measurement'], p['tag'], p['fields'], p['timestamp']) for p in points],
+        args.repeat, len(points))
+    run("format_line (precision=3)", lambda: [format_line(p['measurement'], p['tag'], p['fields'], p['timestamp'], precision=3)
+                                              for p in points], args.repeat, len(points))
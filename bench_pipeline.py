@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# End-to-end benchmark: runs a pipeline of the scripts against moonraker_sim.py and the influx_sim.py
+# write endpoint, and reports the points per second that arrive, how long after their timestamp they
+# arrive (p50/p99), and the CPU and memory each stage used. Needs Linux (/proc) and nothing on the network.
+#
+#   ./bench_pipeline.py --scenario temps --printers 10 --rate 4 --duration 30
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import influx_sim
+from moonraker_sim import object_names
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+RESULT_HEADER = "// probe accuracy results:"
+
+def script(name, *options):
+    return [sys.executable, os.path.join(HERE, name), *options]
+
+def writer_options(args, config):
+    options = ["--bucket", "bench", "--config-file", config, "--config-name", "bench", "--batch", "--linger", str(args.linger)]
+    return options + ["--gzip"] if args.gzip else options
+
+# Each scenario returns one chain of (stage name, argv) per printer, every stage writing into the
+# stdin of the next one, like the README pipelines are run; collector.py follows all printers in one chain
+def temps_chains(args, hosts, config):
+    return [[("templogger", script("templogger.py", "--host", host, "--obj", *args.objects, "--measurement", "bench",
+                                   "--tag", f"printer={number}")),
+             ("influx_write_by_line", script("influx_write_by_line.py", *writer_options(args, config)))]
+            for number, host in enumerate(hosts)]
+
+def summary_chains(args, hosts, config):
+    return [[source, ("summarizer", script("summarizer.py", "--interval", str(args.interval))), writer]
+            for source, writer in temps_chains(args, hosts, config)]
+
+def gcode_chains(args, hosts, config):
+    return [[("gcode_response_spy", script("gcode_response_spy.py", "--host", host, "--probe", "--tag", f"printer={number}")),
+             ("influx_write_by_line", script("influx_write_by_line.py", *writer_options(args, config)))]
+            for number, host in enumerate(hosts)]
+
+def convert_chains(args, hosts, config):
+    return [[("gcode_response_spy", script("gcode_response_spy.py", "--host", host)),
+             ("convert_to_influx", script("convert_to_influx.py", "--result-header", RESULT_HEADER, "--measurement", "probe",
+                                          "--tag", f"printer={number}")),
+             ("influx_write_by_line", script("influx_write_by_line.py", *writer_options(args, config)))]
+            for number, host in enumerate(hosts)]
+
+def collector_chains(args, hosts, config):
+    return [[("collector", script("collector.py", "--host", *hosts, "--obj", *args.objects, "--measurement", "bench")),
+             ("influx_write_by_line", script("influx_write_by_line.py", *writer_options(args, config)))]]
+
+def pipeline_chains(args, hosts, config):
+    # What temps does with two processes per printer in one
+    return [[("pipeline", script("pipeline.py", "temps", "--host", host, "--obj", *args.objects, "--measurement", "bench",
+                                 "--tag", f"printer={number}", "::", "influx", *writer_options(args, config)))]
+            for number, host in enumerate(hosts)]
+
+SCENARIOS = {
+    'temps': temps_chains,
+    'summary': summary_chains,
+    'gcode': gcode_chains,
+    'convert': convert_chains,
+    'collector': collector_chains,
+    'pipeline': pipeline_chains,
+}
+
+def cpu_seconds(pid):
+    # utime + stime from /proc/<pid>/stat, the command name may contain spaces
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def memory_kb(pid):
+    # (current, peak) resident set size
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    memory[key] = int(value.split()[0])
+    except OSError:
+        return None, None
+    return memory.get("VmRSS"), memory.get("VmHWM")
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def start_chains(chains, log):
+    # [(stage name, Popen, first in its chain)], each chain connected with pipes
+    processes = []
+    for chain in chains:
+        stdin = subprocess.DEVNULL
+        for position, (name, command) in enumerate(chain):
+            last = position == len(chain) - 1
+            process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.DEVNULL if last else subprocess.PIPE, stderr=log)
+            if stdin is not subprocess.DEVNULL:
+                # The next process holds it now
+                stdin.close()
+            stdin = process.stdout
+            processes.append((name, process, position == 0))
+    return processes
+
+def stop_chains(processes):
+    # Ctrl-C to the sources, the others see the end of their input and finish
+    for _, process, first in processes:
+        if first:
+            process.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + 10
+    for _, process, _ in processes:
+        try:
+            process.wait(max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def stage_usage(processes, cpu_start, duration):
+    # Per stage name: processes, CPU seconds and percent in the measurement, RSS now and the highest peak
+    usage = {}
+    for name, process, _ in processes:
+        stage = usage.setdefault(name, {'processes': 0, 'cpu_seconds': 0.0, 'cpu_percent': 0.0, 'rss_mb': 0.0, 'peak_rss_mb': 0.0})
+        end = cpu_seconds(process.pid)
+        rss, peak = memory_kb(process.pid)
+        stage['processes'] += 1
+        if end is not None and cpu_start.get(process.pid) is not None:
+            stage['cpu_seconds'] += end - cpu_start[process.pid]
+        stage['rss_mb'] += (rss or 0) / 1024
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], (peak or 0) / 1024)
+    for stage in usage.values():
+        stage['cpu_percent'] = 100 * stage['cpu_seconds'] / duration
+    return usage
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="zhopper-bench-")
+    log_path = os.path.join(workdir, "stages.log")
+    server = influx_sim.make_server(port=0, validate=not args.no_validate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = os.path.join(workdir, "influx.ini")
+    with open(config, "w") as f:
+        f.write(f'[bench]\nurl="http://127.0.0.1:{server.server_port}"\ntoken="bench"\norg="bench"\n')
+
+    simulator_options = ["--port", str(args.port), "--printers", str(args.printers), "--obj", *args.objects,
+                         "--rate", str(args.rate), "--gcode-rate", str(args.gcode_rate), "--speed", str(args.speed)]
+    if args.replay_status:
+        simulator_options += ["--replay-status", args.replay_status]
+    if args.replay_gcode:
+        simulator_options += ["--replay-gcode", args.replay_gcode]
+    hosts = [f"127.0.0.1:{args.port + number}" for number in range(args.printers)]
+    chains = SCENARIOS[args.scenario](args, hosts, config)
+
+    log = open(log_path, "w")
+    simulator = subprocess.Popen(script("moonraker_sim.py", *simulator_options), stdout=log, stderr=log)
+    processes = []
+    try:
+        if not all(wait_for_port(args.port + number) for number in range(args.printers)):
+            raise RuntimeError("moonraker_sim.py did not start")
+        processes = start_chains(chains, log)
+        time.sleep(args.warmup)
+        failed = [name for name, process, _ in processes if process.poll() is not None]
+        if failed:
+            raise RuntimeError(f"stage exited early: {', '.join(failed)}")
+
+        # The measurement: counters from zero, CPU from here on
+        server.stats.reset()
+        cpu_start = {process.pid: cpu_seconds(process.pid) for _, process, _ in processes}
+        time.sleep(args.duration)
+        written = server.stats.summary()
+        usage = stage_usage(processes, cpu_start, written['seconds'])
+    except RuntimeError as e:
+        log.flush()
+        with open(log_path) as f:
+            sys.stderr.write(f.read()[-4000:])
+        raise SystemExit(f"Benchmark failed: {e}")
+    finally:
+        stop_chains(processes)
+        simulator.send_signal(signal.SIGINT)
+        simulator.wait()
+        server.shutdown()
+        log.close()
+
+    if not args.keep:
+        shutil.rmtree(workdir)
+    return {'scenario': args.scenario, 'printers': args.printers, 'objects': len(args.objects), 'rate': args.rate,
+            'gcode_rate': args.gcode_rate, 'duration': args.duration, 'written': written, 'stages': usage}
+
+def print_report(result):
+    written = result['written']
+    print(f"Scenario {result['scenario']}: {result['printers']} printer(s), {result['objects']} objects, "
+          f"{result['rate']:g} updates/s, {result['gcode_rate']:g} G-code responses/s, {written['seconds']:.1f} s")
+    print(f"Written   {written['points_per_second']:>10,.0f} points/s ({written['points']} points in {written['requests']} requests, "
+          f"{written['rejected']} rejected)")
+    if written['latency_p50_ms'] is not None:
+        print(f"Latency   p50 {written['latency_p50_ms']:.1f} ms  p99 {written['latency_p99_ms']:.1f} ms")
+    print(f"{'Stage':<22}{'procs':>6}{'CPU s':>9}{'CPU %':>8}{'RSS MB':>9}{'peak MB':>9}")
+    for name, stage in result['stages'].items():
+        print(f"{name:<22}{stage['processes']:>6}{stage['cpu_seconds']:>9.2f}{stage['cpu_percent']:>8.1f}"
+              f"{stage['rss_mb']:>9.1f}{stage['peak_rss_mb']:>9.1f}")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark a pipeline end to end against simulated printers and InfluxDB.")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="temps",
+                        help="temps: templogger|writer, summary: templogger|summarizer|writer, gcode: gcode_response_spy --probe|writer, "
+                             "convert: gcode_response_spy|convert_to_influx|writer, collector: collector|writer, "
+                             "pipeline: pipeline.py temps :: influx (default: temps)")
+    parser.add_argument("--printers", type=int, default=1, help="Simulated printers (default: 1)")
+    parser.add_argument("--obj", nargs='+', default=["extruder", "heater_bed"], help="Heater objects (default: extruder heater_bed)")
+    parser.add_argument("--objects", type=int, help="Number of heater objects, more than --obj adds extruder1, extruder2, ...")
+    parser.add_argument("--rate", type=float, default=4.0, help="Status updates per second per printer (default: 4)")
+    parser.add_argument("--gcode-rate", type=float, help="G-code responses per second per printer "
+                                                         "(default: 20 for the gcode and convert scenarios, else 0)")
+    parser.add_argument("--replay-status", help="Replay this templogger.py capture instead of synthetic status")
+    parser.add_argument("--replay-gcode", help="Replay this gcode_response_spy.py log instead of synthetic responses")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 0 for as fast as possible (default: 1)")
+    parser.add_argument("--interval", type=int, default=10, help="summarizer.py interval for the summary scenario (default: 10)")
+    parser.add_argument("--linger", type=float, default=1.0, help="Writer linger in seconds (default: 1)")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the writes")
+    parser.add_argument("--no-validate", action="store_true", help="Don't parse the written lines in the stand-in, only count them")
+    parser.add_argument("--port", type=int, default=17125, help="First simulator port (default: 17125)")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds before measuring (default: 3)")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to measure (default: 20)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON, e.g. to compare runs")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory with the stage logs")
+    args = parser.parse_args()
+    args.objects = object_names(args.obj, args.objects)
+    if args.gcode_rate is None:
+        args.gcode_rate = 20.0 if args.scenario in ("gcode", "convert") else 0.0
+    return args
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    result = run_benchmark(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
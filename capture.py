@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# Compact append-only capture of numeric series, instead of keeping days of line protocol or text.
+#
+# A capture is a directory:
+#   index.json                  the series: measurement, tag set, field names and types, and the chunk size
+#   s<series>/<chunk>.ts        int64 timestamps in ns, little-endian, one per point
+#   s<series>/<chunk>.<n>.f64   float64 values of field n, NaN where a point didn't have the field
+# Every chunk holds up to chunk_rows points, so the files of a chunk can be memory-mapped and read
+# into NumPy without copying. Fields that appear later are NaN in the chunks before; a field file
+# that is missing or shorter than the timestamps (after a crash) reads as NaN. A writer reopening the
+# capture cuts a record written in part off the end of the last chunk.
+#
+#   ./capture.py import ~/tmp/drift < drift.lp
+#   ./capture.py info ~/tmp/drift
+#   ./replay.py ~/tmp/drift --speed 60 | ./summarizer.py --interval 60
+import argparse
+import json
+import math
+import mmap
+import os
+import sys
+import time
+from array import array
+
+from lineprotocol import format_tags, parse_line
+
+INDEX = "index.json"
+VERSION = 1
+NAN = float("nan")
+
+# Every value is stored as float64, the type says what it was written as: float, integer or boolean,
+# float once a field has been written as more than one
+FLOAT, INTEGER, BOOLEAN = "f", "i", "b"
+
+def numeric(value):
+    # (float value, type), (None, None) for strings
+    if isinstance(value, float):
+        return value, FLOAT
+    if isinstance(value, bool):
+        return float(value), BOOLEAN
+    if isinstance(value, int):
+        return float(value), INTEGER
+    return None, None
+
+def restore(value, kind):
+    if kind == INTEGER:
+        return int(value)
+    if kind == BOOLEAN:
+        return bool(value)
+    return value
+
+class SeriesBuffer:
+    # Points of one series not written yet, and where its files stand
+    def __init__(self, number, measurement, tag, fields=(), types=None, rows=0):
+        self.number = number
+        self.measurement = measurement
+        self.tag = tag
+        self.fields = list(fields)
+        self.types = list(types) if types else [FLOAT] * len(self.fields)
+        self.field_numbers = {field: n for n, field in enumerate(self.fields)}
+        self.rows = rows  # Points in the files
+        self.timestamps = array('q')
+        self.columns = [array('d') for _ in self.fields]
+
+    def add(self, timestamp, fields):
+        # True when a field or the type of one is new
+        row = len(self.timestamps)
+        self.timestamps.append(timestamp)
+        changed = False
+        for field, value in fields.items():
+            value, kind = numeric(value)
+            if value is None:
+                continue
+            n = self.field_numbers.get(field)
+            if n is None:
+                n = self.field_numbers[field] = len(self.fields)
+                self.fields.append(field)
+                self.types.append(kind)
+                self.columns.append(array('d', [NAN]) * row)
+                changed = True
+            elif self.types[n] != kind and self.types[n] != FLOAT:
+                # Written as one type before and another now: float, so neither reads back cut off
+                self.types[n] = FLOAT
+                changed = True
+            self.columns[n].append(value)
+        for column in self.columns:
+            # Fields this point didn't have
+            if len(column) <= row:
+                column.append(NAN)
+        return changed
+
+class CaptureWriter:
+    # Buffers points per series and appends them to the chunk files every flush_rows points,
+    # flush_interval seconds, on flush() and on close()
+    def __init__(self, path, chunk_rows=1 << 16, flush_rows=4096, flush_interval=5.0):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.series = {}
+        self.chunk_rows = chunk_rows
+        index = read_index(path)
+        if index is not None:
+            self.chunk_rows = index['chunk_rows']
+            for entry in index['series']:
+                trim_last_chunk(path, entry['id'], len(entry['fields']))
+                key = (entry['measurement'], entry['tag'])
+                self.series[key] = SeriesBuffer(entry['id'], entry['measurement'], entry['tag'], entry['fields'],
+                                                entry.get('types'), series_rows(path, entry['id'], self.chunk_rows))
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+        self.index_dirty = False
+
+    def add(self, measurement, tag, fields, timestamp):
+        if isinstance(tag, dict):
+            tag = format_tags(tag)
+        key = (measurement, tag or None)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = SeriesBuffer(len(self.series), measurement, tag or None)
+            self.index_dirty = True
+        if series.add(timestamp, fields):
+            self.index_dirty = True
+        self.buffered += 1
+        if self.buffered >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def add_line(self, line):
+        parsed = parse_line(line)
+        if parsed is None or parsed['timestamp'] is None:
+            return False
+        self.add(parsed['measurement'], parsed['tag'], parsed['fields'], parsed['timestamp'])
+        return True
+
+    def flush(self):
+        # The index first, so every file on disk belongs to a known series and field
+        if self.index_dirty:
+            write_index(self.path, self.chunk_rows, self.series.values())
+            self.index_dirty = False
+        for series in self.series.values():
+            if series.timestamps:
+                self.write_series(series)
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def write_series(self, series):
+        directory = os.path.join(self.path, f"s{series.number}")
+        os.makedirs(directory, exist_ok=True)
+        written = 0
+        count = len(series.timestamps)
+        while written < count:
+            chunk, offset = divmod(series.rows, self.chunk_rows)
+            take = min(count - written, self.chunk_rows - offset)
+            with open(os.path.join(directory, f"{chunk:06d}.ts"), "ab") as f:
+                f.write(series.timestamps[written:written + take].tobytes())
+            for n, column in enumerate(series.columns):
+                name = os.path.join(directory, f"{chunk:06d}.{n}.f64")
+                with open(name, "ab") as f:
+                    if offset and f.tell() < offset * 8:
+                        # A field new in this chunk: NaN for the points before it
+                        f.write(array('d', [NAN] * (offset - f.tell() // 8)).tobytes())
+                    f.write(column[written:written + take].tobytes())
+            series.rows += take
+            written += take
+        series.timestamps = array('q')
+        series.columns = [array('d') for _ in series.fields]
+
+    def close(self):
+        self.flush()
+
+def read_index(path):
+    try:
+        with open(os.path.join(path, INDEX)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return None
+    if index.get('version') != VERSION:
+        raise ValueError(f"{path}: unsupported capture version {index.get('version')}")
+    return index
+
+def write_index(path, chunk_rows, series):
+    index = {
+        'version': VERSION,
+        'chunk_rows': chunk_rows,
+        'series': [{'id': s.number, 'measurement': s.measurement, 'tag': s.tag, 'fields': s.fields, 'types': s.types}
+                   for s in sorted(series, key=lambda s: s.number)],
+    }
+    temporary = os.path.join(path, INDEX + ".tmp")
+    with open(temporary, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(temporary, os.path.join(path, INDEX))
+
+def chunk_files(path, number):
+    # Chunk numbers of a series, in order
+    directory = os.path.join(path, f"s{number}")
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name[:-3]) for name in os.listdir(directory) if name.endswith(".ts"))
+
+def trim_last_chunk(path, number, field_count):
+    # A crash can leave part of a record at the end of the last chunk; appends after it would be
+    # misaligned. Cut the files back to whole points of the timestamps
+    chunks = chunk_files(path, number)
+    if not chunks:
+        return
+    directory = os.path.join(path, f"s{number}")
+    timestamps = os.path.join(directory, f"{chunks[-1]:06d}.ts")
+    size = os.path.getsize(timestamps)
+    rows = size // 8
+    names = [timestamps] + [os.path.join(directory, f"{chunks[-1]:06d}.{n}.f64") for n in range(field_count)]
+    for name in names:
+        try:
+            size = os.path.getsize(name)
+        except FileNotFoundError:
+            continue
+        keep = min(size - size % 8, rows * 8)
+        if keep != size:
+            print(f"{name}: cut {size - keep} bytes of a point written in part", file=sys.stderr)
+            os.truncate(name, keep)
+
+def series_rows(path, number, chunk_rows):
+    chunks = chunk_files(path, number)
+    if not chunks:
+        return 0
+    last = chunks[-1]
+    size = os.path.getsize(os.path.join(path, f"s{number}", f"{last:06d}.ts"))
+    return last * chunk_rows + size // 8
+
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+        index = read_index(path)
+        if index is None:
+            raise FileNotFoundError(f"{path}: not a capture (no {INDEX})")
+        self.chunk_rows = index['chunk_rows']
+        self.series = index['series']
+
+    def find(self, measurement=None, tag=None):
+        # The series entries matching a measurement and/or tag set
+        return [s for s in self.series
+                if (measurement is None or s['measurement'] == measurement) and (tag is None or s['tag'] == tag)]
+
+    def chunk_path(self, series, chunk, suffix):
+        return os.path.join(self.path, f"s{series['id']}", f"{chunk:06d}.{suffix}")
+
+    def chunks(self, series, fields=None):
+        # Yields (timestamps, {field: values}) per chunk as NumPy arrays on memory maps, no copying
+        import numpy as np
+        fields = series['fields'] if fields is None else fields
+        for chunk in chunk_files(self.path, series['id']):
+            timestamps = map_array(np, self.chunk_path(series, chunk, "ts"), np.int64)
+            rows = len(timestamps)
+            columns = {}
+            for field in fields:
+                if field not in series['fields']:
+                    raise KeyError(f"{series['measurement']}: no field {field}")
+                values = map_array(np, self.chunk_path(series, chunk, f"{series['fields'].index(field)}.f64"), np.float64)
+                if len(values) < rows:
+                    # Missing or cut short: pad with NaN, this one is a copy
+                    values = np.concatenate([values, np.full(rows - len(values), np.nan)])
+                columns[field] = values[:rows]
+            yield timestamps, columns
+
+    def read(self, series, fields=None, start=None, end=None):
+        # All of a series (between start and end ns) as (timestamps, {field: values}); one copy when it spans chunks
+        import numpy as np
+        parts = list(self.chunks(series, fields))
+        if not parts:
+            names = series['fields'] if fields is None else fields
+            return np.empty(0, np.int64), {field: np.empty(0, np.float64) for field in names}
+        if len(parts) == 1:
+            timestamps, columns = parts[0]
+        else:
+            timestamps = np.concatenate([part[0] for part in parts])
+            columns = {field: np.concatenate([part[1][field] for part in parts]) for field in parts[0][1]}
+        if start is not None or end is not None:
+            # Timestamps of a series are in arrival order, which is time order for the collectors
+            low = 0 if start is None else np.searchsorted(timestamps, start, "left")
+            high = len(timestamps) if end is None else np.searchsorted(timestamps, end, "left")
+            timestamps = timestamps[low:high]
+            columns = {field: values[low:high] for field, values in columns.items()}
+        return timestamps, columns
+
+    def rows(self, series):
+        # Plain Python rows (timestamp, [values]) per chunk, for tools that don't need NumPy
+        for chunk in chunk_files(self.path, series['id']):
+            timestamps = read_array(self.chunk_path(series, chunk, "ts"), 'q')
+            columns = []
+            for n in range(len(series['fields'])):
+                values = read_array(self.chunk_path(series, chunk, f"{n}.f64"), 'd')
+                if len(values) < len(timestamps):
+                    values.extend([NAN] * (len(timestamps) - len(values)))
+                columns.append(values)
+            for row, timestamp in enumerate(timestamps):
+                yield timestamp, [column[row] for column in columns]
+
+def map_array(np, path, dtype):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.empty(0, dtype)
+    return np.memmap(path, dtype=np.dtype(dtype).newbyteorder("<"), mode="r")
+
+def read_array(path, typecode):
+    values = array(typecode)
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    values.frombytes(mm[:size - size % values.itemsize])
+    except FileNotFoundError:
+        pass
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+def load_series(path, measurement=None, tag=None):
+    # [(series entry, timestamps, {field: values})] as NumPy arrays, from a capture directory
+    # or, parsed line by line, from a line protocol file ('-' for stdin)
+    import numpy as np
+    if os.path.isdir(path):
+        reader = CaptureReader(path)
+        return [(series, *reader.read(series)) for series in reader.find(measurement, tag)]
+    buffers = {}
+    with (open(sys.stdin.fileno(), closefd=False) if path == "-" else open(path)) as f:
+        for line in f:
+            point = parse_line(line)
+            if point is None or point['timestamp'] is None:
+                continue
+            if (measurement is not None and point['measurement'] != measurement) or (tag is not None and point['tag'] != tag):
+                continue
+            key = (point['measurement'], point['tag'])
+            buffer = buffers.get(key)
+            if buffer is None:
+                buffer = buffers[key] = SeriesBuffer(len(buffers), *key)
+            buffer.add(point['timestamp'], point['fields'])
+    return [({'id': b.number, 'measurement': b.measurement, 'tag': b.tag, 'fields': b.fields, 'types': b.types},
+             np.frombuffer(b.timestamps, np.int64) if b.timestamps else np.empty(0, np.int64),
+             {field: np.frombuffer(column, np.float64) if column else np.empty(0, np.float64)
+              for field, column in zip(b.fields, b.columns)})
+            for b in buffers.values()]
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def import_lines(path, stream, chunk_rows):
+    writer = CaptureWriter(path, chunk_rows=chunk_rows, flush_rows=1 << 16, flush_interval=math.inf)
+    imported = skipped = 0
+    for line in stream:
+        if writer.add_line(line):
+            imported += 1
+        elif line.strip():
+            skipped += 1
+    writer.close()
+    print(f"Imported {imported} points, skipped {skipped} lines", file=sys.stderr)
+
+def show_info(path):
+    reader = CaptureReader(path)
+    for series in reader.series:
+        rows = series_rows(path, series['id'], reader.chunk_rows)
+        tag = f",{series['tag']}" if series['tag'] else ""
+        print(f"{series['measurement']}{tag}: {rows} points, fields {', '.join(series['fields'])}")
+    print(f"{directory_size(path) / 1e6:.1f} MB")
+
+def add_arguments(parser):
+    parser.add_argument("--capture", help="Also append the points to this capture directory (see capture.py)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import line protocol into a columnar capture, or describe one.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser("import", help="Append line protocol from stdin to a capture")
+    importer.add_argument("path", help="Capture directory")
+    importer.add_argument("--chunk-rows", type=int, default=1 << 16, help="Points per chunk file for a new capture (default: 65536)")
+    info = commands.add_parser("info", help="List the series of a capture")
+    info.add_argument("path", help="Capture directory")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        import_lines(args.path, sys.stdin, args.chunk_rows)
+    else:
+        show_info(args.path)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import asyncio
+import websockets
+import json
+import os
+import random
+import sys
+import signal
+import time
+import argparse
+from datetime import datetime
+
+import capture
+import metrics
+from templogger import EmitPolicy, StatusCache, build_subscription, format_temperature_line, receive
+
+SUBSCRIBE_ID = 1
+
+async def collect_host(host, objects, measurement, tag=None, gcode_log=None, rate=None, on_change=False, min_backoff=1.0, max_backoff=30.0,
+                       stats=metrics.NO_METRICS, capture=None):
+    # One websocket per printer carries both the status subscription and the G-code responses.
+    # When the printer goes away the connection is retried forever with jittered exponential backoff.
+    uri = f"ws://{host}/websocket"  # Moonraker WebSocket URL
+    subscription_message = json.dumps(build_subscription(objects, request_id=SUBSCRIBE_ID))
+    host_tag = f"host={host}" + (f",{tag}" if tag else "")
+    gcode_file = None
+    if gcode_log:
+        gcode_file = open(os.path.expanduser(gcode_log.format(host=host)), "a", buffering=1)
+
+    backoff = min_backoff
+    while True:
+        try:
+            async with websockets.connect(uri, open_timeout=10, ping_interval=10, ping_timeout=10) as websocket:
+                print(f"{host}: connected", file=sys.stderr, flush=True)
+                stats.count("connects")
+                await websocket.send(subscription_message)
+
+                cache = StatusCache(objects)
+                policy = EmitPolicy(rate=rate, on_change=on_change)
+                while True:
+                    response = await receive(websocket, policy.timeout())
+                    updated = False
+                    if response is not None:
+                        stats.count("messages_in")
+                        start = time.perf_counter()
+                        try:
+                            data = json.loads(response)
+                            method = data.get("method")
+
+                            if method == "notify_status_update":
+                                status_data = data["params"][0] if isinstance(data["params"][0], dict) else {}
+                                cache.update(status_data)
+                                updated = True
+                            elif data.get("id") == SUBSCRIBE_ID and "result" in data:
+                                # The subscribe reply carries the full current state
+                                backoff = min_backoff
+                                cache.update(data["result"].get("status", {}))
+                                updated = True
+                            elif method == "notify_gcode_response":
+                                stats.count("gcode_responses")
+                                if gcode_file:
+                                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                                    gcode_file.write(f"{timestamp} {data.get('params', [])[0]}\n")
+                            elif method == "notify_klippy_ready":
+                                # Klipper restarted behind Moonraker, its subscriptions are gone
+                                await websocket.send(subscription_message)
+                                stats.count("resubscribes")
+                        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                            # Not JSON or not shaped like Moonraker's messages: skip it, one odd message
+                            # shouldn't take this printer (and through gather all the others) down
+                            print(f"{host}: skipped a bad message ({e!r}): {response[:200]!r}", file=sys.stderr, flush=True)
+                            stats.count("bad_messages")
+                            continue
+                        stats.observe("parse", time.perf_counter() - start)
+
+                    if not policy.should_emit(cache, updated):
+                        continue
+                    cache.changed = False
+                    line = format_temperature_line(measurement, host_tag, objects, cache.state, time.time_ns(), capture)
+                    if line:
+                        sys.stdout.write(line + "\n")
+                        sys.stdout.flush()
+                        stats.count("lines_out")
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+            print(f"{host}: connection lost ({e}), retrying in ~{backoff:.0f}s", file=sys.stderr, flush=True)
+            stats.count("reconnects")
+
+        await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+        backoff = min(backoff * 2, max_backoff)
+
+async def collect(hosts, **kwargs):
+    # All printers share one event loop
+    await asyncio.gather(*(collect_host(host, **kwargs) for host in hosts))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect temperatures and G-code responses from several Moonraker hosts in one process.")
+    parser.add_argument("--host", required=True, nargs='+', help="Hostnames or IP addresses of the Moonraker servers.")
+    parser.add_argument("--obj", required=True, nargs='+', help="Objects to monitor (e.g., heater_bed extruder).")
+    parser.add_argument("--measurement", required=True, help="The measurement name to use in the InfluxDB line protocol.")
+    parser.add_argument("--tag", help="Optional extra tag in the format key=value, every line is also tagged with host=<host>.")
+    parser.add_argument("--rate", type=float, help="Write the state of each host this many times per second instead of on every update.")
+    parser.add_argument("--on-change", action="store_true", help="Only write when a value changed (combined with --rate: changed since the last sample).")
+    parser.add_argument("--gcode-log", help="File for the G-code responses of each host, {host} is replaced by the hostname (e.g. ~/tmp/{host}.out).")
+    capture.add_arguments(parser)
+    metrics.add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+    stats = metrics.setup(args, "collector")
+    writer = capture.CaptureWriter(args.capture) if args.capture else None
+    if writer:
+        # Stopped like Ctrl-C, so the buffered points get written
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        asyncio.run(collect(args.host, objects=args.obj, measurement=args.measurement, tag=args.tag, gcode_log=args.gcode_log,
+                            rate=args.rate, on_change=args.on_change, stats=stats, capture=writer))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer:
+            writer.close()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# Drops the samples that can be reconstructed from the ones around them, like a process historian:
+# a flat temperature becomes a point every --max-gap seconds, a heater overshoot keeps its shape.
+#
+#   ./templogger.py --host ratos2.local --obj extruder heater_bed --measurement ratos2 \
+#     | ./compress.py --door '*_temp=0.1' --deadband '*_pwm=0.02' --max-gap 60 | ./influx_write_by_line.py --bucket r3 --batch
+#
+# Per field, one of:
+#   swinging door (--door): a sample is kept when the line from the last kept one to the next would
+#     no longer pass within the tolerance of every sample in between; drawing lines between the kept
+#     samples is off by at most the tolerance. For smooth curves like temperatures.
+#   deadband (--deadband): a sample is kept when it is more than the tolerance away from the last kept
+#     one, together with the sample before it so steps stay steps. For values that jump, like PWM.
+# Fields without either, and strings and booleans, are kept whenever they change (a tolerance of 0).
+# Every field gets a point at least every --max-gap seconds, so a quiet series still shows up.
+import argparse
+import fnmatch
+import sys
+import time
+
+import metrics
+from lineprotocol import format_line, parse_line
+from streamio import StdinLines
+
+DOOR = "door"
+DEADBAND = "deadband"
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class DeadbandField:
+    def __init__(self, tolerance, max_gap_ns):
+        self.tolerance = tolerance
+        self.max_gap_ns = max_gap_ns
+        self.kept = None  # (timestamp, value)
+        self.held = None  # The last sample, kept or not
+
+    def differs(self, value, kept):
+        if is_number(value) and is_number(kept):
+            return abs(value - kept) > self.tolerance
+        return value != kept
+
+    def add(self, timestamp, value):
+        # Returns the (timestamp, value) samples to keep
+        kept = []
+        if self.kept is None:
+            kept.append((timestamp, value))
+        elif timestamp <= self.kept[0]:
+            # Duplicate or out of order
+            return kept
+        elif self.differs(value, self.kept[1]):
+            if self.held[0] != self.kept[0]:
+                kept.append(self.held)
+            kept.append((timestamp, value))
+        elif self.max_gap_ns and timestamp - self.kept[0] >= self.max_gap_ns:
+            kept.append((timestamp, value))
+        if kept:
+            self.kept = kept[-1]
+        self.held = (timestamp, value)
+        return kept
+
+    def flush(self):
+        # The last sample, so the series ends where it really ended
+        if self.held is None or self.held[0] == self.kept[0]:
+            return []
+        self.kept = self.held
+        return [self.held]
+
+class SwingingDoorField:
+    def __init__(self, tolerance, max_gap_ns):
+        self.tolerance = tolerance
+        self.max_gap_ns = max_gap_ns
+        self.kept = None
+        self.held = None  # The last sample when it is not kept yet
+        self.keep(None)
+
+    def keep(self, sample):
+        # Start over from this sample; the door (the slopes from it that pass within the tolerance of every
+        # sample since) is wide open
+        if sample is not None:
+            self.kept = sample
+        self.upper = float("inf")
+        self.lower = float("-inf")
+
+    def add(self, timestamp, value):
+        if self.kept is None:
+            self.keep((timestamp, value))
+            return [self.kept]
+        if timestamp <= self.kept[0]:
+            return []
+        kept = []
+        kept_time, kept_value = self.kept
+        if self.held is not None and not self.lower <= (value - kept_value) / (timestamp - kept_time) <= self.upper:
+            # The line to this sample would miss one in between: keep the one before, start from there
+            kept.append(self.held)
+            self.keep(self.held)
+            kept_time, kept_value = self.kept
+        elapsed = timestamp - kept_time
+        self.upper = min(self.upper, (value + self.tolerance - kept_value) / elapsed)
+        self.lower = max(self.lower, (value - self.tolerance - kept_value) / elapsed)
+        self.held = (timestamp, value)
+        if self.max_gap_ns and timestamp - kept_time >= self.max_gap_ns:
+            kept.append(self.held)
+            self.keep(self.held)
+            self.held = None
+        return kept
+
+    def flush(self):
+        if self.held is None:
+            return []
+        self.keep(self.held)
+        self.held = None
+        return [self.kept]
+
+class SeriesCompressor:
+    # The fields of one series. What a sample keeps is only known at the next one, so the kept values
+    # of the latest timestamp wait for it, and each output point has every field kept at its time.
+    def __init__(self, settings, max_gap_ns, precision=None):
+        self.settings = settings
+        self.max_gap_ns = max_gap_ns
+        self.precision = precision
+        self.fields = {}
+        self.pending_timestamp = None
+        self.pending = {}
+        self.last_seen = time.monotonic()
+
+    def field(self, name, value):
+        state = self.fields.get(name)
+        if state is None:
+            method, tolerance = self.settings(name) if is_number(value) else (DEADBAND, 0)
+            cls = SwingingDoorField if method == DOOR else DeadbandField
+            state = self.fields[name] = cls(tolerance, self.max_gap_ns)
+        return state
+
+    def add(self, timestamp, fields):
+        # Returns [(timestamp, fields)] of the points that are complete
+        self.last_seen = time.monotonic()
+        kept = []
+        for name, value in fields.items():
+            kept += [(t, name, v) for t, v in self.field(name, value).add(timestamp, value)]
+        return self.collect(kept, timestamp)
+
+    def collect(self, kept, timestamp=None):
+        done = []
+        current = {}
+        for t, name, value in kept:
+            if t == timestamp:
+                current[name] = value
+            elif t == self.pending_timestamp:
+                self.pending[name] = value
+            else:
+                # Kept from a sample further back, a field the last samples didn't have
+                done.append((t, {name: value}))
+        if self.pending:
+            done.append((self.pending_timestamp, self.pending))
+        self.pending_timestamp, self.pending = timestamp, current
+        done.sort(key=lambda point: point[0])
+        return done
+
+    def flush(self):
+        kept = [(t, name, v) for name, state in self.fields.items() for t, v in state.flush()]
+        return self.collect(kept)
+
+class Compressor:
+    # Series by (measurement, tag); measurements not in `measurements` (when given) pass through
+    def __init__(self, settings, max_gap=60.0, measurements=None):
+        self.settings = settings
+        self.max_gap_ns = int(max_gap * 1e9)
+        self.measurements = set(measurements) if measurements else None
+        self.series = {}
+        self.values_in = 0
+        self.values_out = 0
+
+    def points(self, key, done):
+        measurement, tag = key
+        precision = self.series[key].precision
+        records = []
+        for timestamp, fields in done:
+            self.values_out += len(fields)
+            records.append({'measurement': measurement, 'tag': tag, 'fields': fields, 'timestamp': timestamp, 'precision': precision})
+        return records
+
+    def add(self, record):
+        # Returns the records to write
+        if record['timestamp'] is None or (self.measurements is not None and record['measurement'] not in self.measurements):
+            return [record]
+        key = (record['measurement'], record['tag'])
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = SeriesCompressor(self.settings, self.max_gap_ns, record.get('precision'))
+        self.values_in += len(record['fields'])
+        return self.points(key, series.add(record['timestamp'], record['fields']))
+
+    def tick(self):
+        # Series that went quiet for longer than the max gap write out their last samples and are forgotten
+        records = []
+        if not self.max_gap_ns:
+            return records
+        now = time.monotonic()
+        for key, series in list(self.series.items()):
+            if (now - series.last_seen) * 1e9 >= self.max_gap_ns:
+                records += self.points(key, series.flush())
+                del self.series[key]
+        return records
+
+    def flush(self):
+        records = []
+        for key, series in self.series.items():
+            records += self.points(key, series.flush())
+        self.series.clear()
+        return records
+
+def parse_tolerances(specs, method):
+    # ['0.5', '*_pwm=0.02', 'extruder_temp=0.1'] -> [(pattern, method, tolerance)]; a bare number is for every field
+    rules = []
+    for spec in specs or []:
+        pattern, _, value = spec.rpartition("=")
+        try:
+            tolerance = float(value)
+        except ValueError:
+            raise ValueError(f"invalid tolerance: {spec}")
+        if tolerance < 0:
+            raise ValueError(f"negative tolerance: {spec}")
+        rules.append((pattern or "*", method, tolerance))
+    return rules
+
+def make_settings(door=None, deadband=None):
+    # The field -> (method, tolerance) lookup: an exact field name wins over a pattern, a pattern over
+    # a bare default, and --deadband over --door at the same level. Unmatched fields: door with 0.
+    rules = parse_tolerances(door, DOOR) + parse_tolerances(deadband, DEADBAND)
+
+    def level(pattern):
+        return 0 if pattern == "*" else 2 if not any(c in pattern for c in "*?[") else 1
+
+    def settings(name):
+        best = None
+        for pattern, method, tolerance in rules:
+            if fnmatch.fnmatchcase(name, pattern) and (best is None or level(pattern) >= best[0]):
+                best = (level(pattern), method, tolerance)
+        return (best[1], best[2]) if best else (DOOR, 0.0)
+    return settings
+
+def add_arguments(parser):
+    parser.add_argument("--door", nargs='+', metavar="[FIELD=]TOLERANCE",
+                        help="Swinging door tolerance, for every field or for fields matching a name or pattern (e.g. '*_temp=0.1')")
+    parser.add_argument("--deadband", nargs='+', metavar="[FIELD=]TOLERANCE",
+                        help="Deadband tolerance, for every field or for fields matching a name or pattern (e.g. '*_pwm=0.02')")
+    parser.add_argument("--max-gap", type=float, default=60.0,
+                        help="Keep a sample of every field at least this often, in seconds; 0 for never (default: 60)")
+    parser.add_argument("--measurement", nargs='+', help="Only compress these measurements, pass the others through (default: all)")
+
+def make_compressor(args):
+    return Compressor(make_settings(args.door, args.deadband), max_gap=args.max_gap, measurements=args.measurement)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress line protocol series with swinging door and deadband tolerances.")
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    stats = metrics.setup(args, "compress")
+    try:
+        compressor = make_compressor(args)
+    except ValueError as e:
+        parser.error(str(e))
+    stats.watch("values_in", lambda: compressor.values_in)
+    stats.watch("values_out", lambda: compressor.values_out)
+    stats.watch("series", lambda: len(compressor.series))
+
+    def emit(records):
+        if records:
+            sys.stdout.write("".join(format_line(r['measurement'], r['tag'], r['fields'], r['timestamp'],
+                                                 precision=r.get('precision')) + "\n" for r in records))
+            sys.stdout.flush()
+            stats.count("lines_out", len(records))
+
+    reader = StdinLines()
+    try:
+        while True:
+            lines = reader.read(1.0)
+            if lines is None:
+                break
+            start = time.perf_counter()
+            records = []
+            for line in lines:
+                record = parse_line(line)
+                if record is None:
+                    if line:
+                        stats.count("skipped")
+                    continue
+                stats.count("lines_in")
+                records += compressor.add(record)
+            records += compressor.tick()
+            stats.observe("compress", time.perf_counter() - start)
+            emit(records)
+    except KeyboardInterrupt:
+        pass
+    emit(compressor.flush())
+    if compressor.values_in:
+        print(f"Kept {compressor.values_out} of {compressor.values_in} values "
+              f"({100.0 * compressor.values_out / compressor.values_in:.1f}%)", file=sys.stderr)
@@ -1,31 +1,53 @@
 #!/usr/bin/env python3
 
-import time
 import sys
+import time
 import argparse
-from datetime import datetime
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 
-def process_line(line, *, result_header, measurement, tag=None):
-    # Extract the time and the accuracy results
-    try:
-        time_str, data_str = line.split(result_header)
-    except ValueError:
-        print(f"Line does not contain the result header: {line}", file=sys.stderr)
-        return None
+import capture
+import metrics
+from lineprotocol import format_line
 
-    timestamp = time_str.strip()
-    try:
-        # Convert the timestamp to a Unix timestamp in nanoseconds
-        timestamp_ns = int(time.mktime(datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timetuple()) * 1e9)
-    except ValueError:
-        print(f"Invalid timestamp format: {timestamp}", file=sys.stderr)
+class TimestampParser:
+    # "2024-10-16 12:34:56" -> Unix timestamp in nanoseconds.
+    # Consecutive lines share the date, hour and minute, so only that prefix goes through
+    # datetime (once per minute) and the seconds are added on top.
+    # tz is a tzinfo for the time zone the log was written in, None for the local time zone.
+    def __init__(self, tz=None):
+        self.tz = tz
+        self.prefix = None
+        self.minute_ns = None
+
+    def __call__(self, timestamp):
+        if len(timestamp) != 19 or timestamp[16] != ":" or not timestamp[17:].isdigit():
+            raise ValueError(f"Invalid timestamp: {timestamp}")
+        prefix = timestamp[:16]
+        if prefix != self.prefix:
+            minute = datetime.strptime(prefix, "%Y-%m-%d %H:%M")
+            if self.tz is not None:
+                minute = minute.replace(tzinfo=self.tz)
+            self.minute_ns = int(minute.timestamp()) * 1_000_000_000
+            self.prefix = prefix
+        return self.minute_ns + int(timestamp[17:]) * 1_000_000_000
+
+def make_timezone(name):
+    # "local" (the default, what the logs were always read as), "UTC" or an IANA name like "Europe/Helsinki"
+    if name == "local":
         return None
+    if name.upper() == "UTC":
+        return timezone.utc
+    return ZoneInfo(name)
+
+local_timestamps = TimestampParser()
 
+def parse_results(data_str):
     # Extract values
     # Split the data based on commas and strip any leading/trailing spaces
-    data = [item.strip() for item in data_str.split(",")]
     data_dict = {}
-    for item in data:
+    for item in data_str.split(","):
+        item = item.strip()
         try:
             splitter = "=" if "=" in item else " " #key and value can be separated by a space or an equal sign
             key, value = item.rsplit(splitter, 1)
@@ -35,14 +57,30 @@ def process_line(line, *, result_header, measurement, tag=None):
         except ValueError:
             print(f"Skipping malformed data: {item}", file=sys.stderr)
             continue
+    return data_dict
+
+def process_line(line, *, result_header, measurement, tag=None, parse_timestamp=local_timestamps, capture=None):
+    # Extract the time and the accuracy results
+    try:
+        time_str, data_str = line.split(result_header)
+    except ValueError:
+        print(f"Line does not contain the result header: {line}", file=sys.stderr)
+        return None
+
+    timestamp = time_str.strip()
+    try:
+        # Convert the timestamp to a Unix timestamp in nanoseconds
+        timestamp_ns = parse_timestamp(timestamp)
+    except ValueError:
+        print(f"Invalid timestamp format: {timestamp}", file=sys.stderr)
+        return None
+
+    data_dict = parse_results(data_str)
+    if capture and data_dict:
+        capture.add(measurement, tag, data_dict, timestamp_ns)
 
     # Prepare Line Protocol format using the provided measurement and optional tag
-    fields = ",".join([f"{key}={value}" for key, value in data_dict.items()])
-    
-    # If a tag is provided, add it to the line protocol
-    tag_part = f",{tag}" if tag else ""
-    
-    line_protocol = f"{measurement}{tag_part} {fields} {timestamp_ns}"
+    line_protocol = format_line(measurement, tag, data_dict, timestamp_ns)
     
     return line_protocol
 
@@ -52,23 +90,108 @@ def parse_arguments():
     parser.add_argument("--result-header", required=True, help="The header used to split the log line and extract results.")
     parser.add_argument("--measurement", required=True, help="The measurement name to use in the InfluxDB line protocol.")
     parser.add_argument("--tag", help="Optional tag in the format key=value to add to the InfluxDB line protocol.")
+    parser.add_argument("--timezone", default="local",
+                        help="Time zone of the log timestamps: 'local', 'UTC' or a name like Europe/Helsinki (default: local)")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Read the input in large blocks and write the output in buffered chunks, for converting whole files")
+    parser.add_argument("files", nargs="*", help="Log files to convert in bulk mode (default: stdin)")
+    capture.add_arguments(parser)
+    metrics.add_arguments(parser)
     return parser.parse_args()
 
+def read_blocks(stream, block_size=1 << 22):
+    # Lines in large blocks; the last, possibly incomplete line of a block is kept for the next one
+    pending = b""
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        lines = (pending + block).split(b"\n")
+        pending = lines.pop()
+        yield lines
+    if pending:
+        yield [pending]
+
+def open_files(paths):
+    for path in paths:
+        with open(path, "rb") as f:
+            yield f
+
+def convert_lines(lines, *, result_header, measurement, tag=None, parse_timestamp=local_timestamps, capture=None):
+    # Convert a list of raw (bytes) log lines, returns the line protocol of those with results
+    header = result_header.encode("utf-8")
+    converted = []
+    for line in lines:
+        if header not in line:
+            continue
+        line = line.decode("utf-8", errors="replace").strip()
+        try:
+            line_protocol = process_line(line, result_header=result_header, measurement=measurement,
+                                         tag=tag, parse_timestamp=parse_timestamp, capture=capture)
+        except ValueError:
+            print(f"Skipping malformed line: {line}", file=sys.stderr)
+            continue
+        if line_protocol:
+            converted.append(line_protocol)
+    return converted
+
+def convert_bulk(streams, out, stats=metrics.NO_METRICS, **options):
+    for stream in streams:
+        for lines in read_blocks(stream):
+            start = time.perf_counter()
+            converted = convert_lines(lines, **options)
+            # Per block: the lines without the result header count as skipped
+            stats.observe("parse", time.perf_counter() - start)
+            stats.count("lines_in", len(lines))
+            stats.count("lines_out", len(converted))
+            stats.count("skipped", len(lines) - len(converted))
+            if converted:
+                out.write("\n".join(converted) + "\n")
+
 def main():
     # Parse command-line arguments
     args = parse_arguments()
+    stats = metrics.setup(args, "convert_to_influx")
+    parse_timestamp = TimestampParser(make_timezone(args.timezone))
+    writer = capture.CaptureWriter(args.capture) if args.capture else None
+    try:
+        convert(args, stats, parse_timestamp, writer)
+    finally:
+        if writer:
+            writer.close()
+
+def convert(args, stats, parse_timestamp, writer):
+    if args.bulk:
+        if args.files:
+            streams = open_files(args.files)
+        else:
+            streams = [sys.stdin.buffer]
+        convert_bulk(streams, sys.stdout, stats, result_header=args.result_header, measurement=args.measurement,
+                     tag=args.tag, parse_timestamp=parse_timestamp, capture=writer)
+        sys.stdout.flush()
+        return
 
     # Read lines from stdin
     for line in sys.stdin:
         line = line.strip()
+        stats.count("lines_in")
         if args.result_header in line:  # Only process lines with the correct format
             try:
-                line_protocol = process_line(line, result_header=args.result_header, measurement=args.measurement, tag=args.tag)
+                start = time.perf_counter()
+                line_protocol = process_line(line, result_header=args.result_header, measurement=args.measurement,
+                                             tag=args.tag, parse_timestamp=parse_timestamp, capture=writer)
+                stats.observe("parse", time.perf_counter() - start)
                 if line_protocol:
                     print(f"{line_protocol}", flush=True)
+                    stats.count("lines_out")
+                else:
+                    stats.count("failed")
             except ValueError:
                 # Handle case where the split or conversion fails, if necessary
                 print(f"Skipping malformed line: {line}", file=sys.stderr)
+                stats.count("failed")
+        else:
+            stats.count("skipped")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -3,30 +3,188 @@
 import asyncio
 import websockets
 import json
+import re
+import signal
+import time
 import argparse
 from datetime import datetime
 
-async def listen_gcode_responses(host="localhost"):
+import capture
+import metrics
+from convert_to_influx import parse_results
+from lineprotocol import format_line
+
+# Klipper prints "// probe accuracy results: maximum ..., minimum ..., ...", some setups "// Result is ..."
+RESULT_HEADERS = ["// Result is", "// probe accuracy results:"]
+# The markers gcodeplan.py (and genprobeaccuracy.py) write with M118
+LOOP_RE = re.compile(r"Loop count: (\d+)")
+MIDPOINT_MARKER = "Midpoint reached"
+RUN_RE = re.compile(r"Plan run: (\d+)/\d+(.*)")
+PARAMETER_RE = re.compile(r"(\w+)=(\S+)")
+
+def parse_parameter(value):
+    # Numbers as floats, so a swept parameter keeps one field type across runs (5, then 2.5)
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+class ProbeExtractor:
+    # Turns PROBE_ACCURACY results and the loop markers into line protocol as they arrive.
+    # The loop count marker comes right after each PROBE_ACCURACY, so a result is held until that
+    # marker says which loop it was; a result without one (the next result, a plan run marker or the
+    # end of input comes first) goes out without a loop. A count of 1, or one lower than the last,
+    # is a new test: the midpoint and the run of the last one don't carry over.
+    # A plan run marker starts the loops over; the results after it carry the run number.
+    def __init__(self, measurement, tag=None, result_headers=RESULT_HEADERS, capture=None):
+        self.measurement = measurement
+        self.marker_measurement = f"{measurement}_marker"
+        self.tag = tag
+        self.result_headers = result_headers
+        self.capture = capture
+        self.loop = 0
+        self.after_midpoint = False
+        self.run = None
+        self.held = None  # (fields, timestamp) of a result waiting for its loop marker
+
+    def start_over(self):
+        self.loop = 0
+        self.after_midpoint = False
+
+    def release(self, loop=None):
+        # The held result, with its loop when the marker after it came
+        if self.held is None:
+            return []
+        fields, timestamp_ns = self.held
+        self.held = None
+        if loop is not None:
+            fields["loop"] = loop
+            fields["after_midpoint"] = self.after_midpoint
+            if self.run is not None:
+                fields["run"] = self.run
+        return [(self.measurement, fields, timestamp_ns)]
+
+    def extract(self, response, timestamp_ns=None):
+        # Returns the (measurement, fields, timestamp) of the results and markers that are complete
+        for header in self.result_headers:
+            if header in response:
+                fields = parse_results(response.split(header, 1)[1])
+                if not fields:
+                    return []
+                extracted = self.release()
+                self.held = (fields, timestamp_ns)
+                return extracted
+
+        match = RUN_RE.search(response)
+        if match:
+            extracted = self.release()
+            self.run = int(match.group(1))
+            self.start_over()
+            fields = {name: parse_parameter(value) for name, value in PARAMETER_RE.findall(match.group(2))}
+            fields["run"] = self.run
+            return extracted + [(self.marker_measurement, fields, timestamp_ns)]
+
+        match = LOOP_RE.search(response)
+        if match:
+            loop = int(match.group(1))
+            if loop == 1 or loop <= self.loop:
+                if self.loop:
+                    # Not started by a plan run marker: an ordinary test, no run
+                    self.run = None
+                self.start_over()
+            self.loop = loop
+            return self.release(loop) + [(self.marker_measurement, {"loop": loop}, timestamp_ns)]
+
+        if MIDPOINT_MARKER in response:
+            self.after_midpoint = True
+            return [(self.marker_measurement, {"loop": self.loop, "midpoint": True}, timestamp_ns)]
+        return []
+
+    def flush(self):
+        # End of input: the result still waiting for a marker
+        return self.release()
+
+    def format(self, extracted):
+        lines = []
+        for measurement, fields, timestamp_ns in extracted:
+            if self.capture:
+                self.capture.add(measurement, self.tag, fields, timestamp_ns)
+            lines.append(format_line(measurement, self.tag, fields, timestamp_ns))
+        return lines
+
+    def process(self, response, timestamp_ns):
+        # Returns the line protocol lines that are complete, often none
+        return self.format(self.extract(response, timestamp_ns))
+
+async def gcode_responses(host="localhost", stats=metrics.NO_METRICS):
+    # Yields (response, receive time in ns) for every G-code response
     uri = f"ws://{host}/websocket"  # Replace <moonraker-ip> with your Moonraker server's IP
     async with websockets.connect(uri) as websocket:
         # Continuously listen for G-code responses (notify_gcode_response)
         while True:
             response = await websocket.recv()
+            stats.count("messages_in")
             data = json.loads(response)
-            
+
             # Check if the message contains G-code response
             if data.get("method") == "notify_gcode_response":
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                gcode_response = data.get("params", [])[0]
-                print(f"{timestamp} {gcode_response}", flush=True)
+                yield data.get("params", [])[0], time.time_ns()
+
+async def listen_gcode_responses(host="localhost", extractor=None, raw_log=None, stats=metrics.NO_METRICS):
+    async for gcode_response, received_ns in gcode_responses(host, stats):
+        if extractor is None:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{timestamp} {gcode_response}", flush=True)
+            stats.count("lines_out")
+            continue
+
+        # Structured output on stdout, the text log on the side
+        if raw_log:
+            timestamp = datetime.fromtimestamp(received_ns / 1e9).strftime("%Y-%m-%d %H:%M:%S")
+            raw_log.write(f"{timestamp} {gcode_response}\n")
+        start = time.perf_counter()
+        lines = extractor.process(gcode_response, received_ns)
+        stats.observe("parse", time.perf_counter() - start)
+        if lines:
+            print("\n".join(lines), flush=True)
+            stats.count("lines_out", len(lines))
+        else:
+            stats.count("skipped")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Listen for G-code responses from Moonraker.")
-    parser.add_argument("--host", required=True, help="Hostname or IP address of the Moonraker server.")    
+    parser.add_argument("--host", required=True, help="Hostname or IP address of the Moonraker server.")
+    parser.add_argument("--probe", action="store_true",
+                        help="Write PROBE_ACCURACY results and loop markers as line protocol instead of the raw text.")
+    parser.add_argument("--measurement", default="probe", help="Measurement name for --probe (default: probe, markers go to probe_marker).")
+    parser.add_argument("--tag", help="Optional tag in the format key=value to add to the --probe line protocol.")
+    parser.add_argument("--result-header", nargs='+', default=RESULT_HEADERS,
+                        help="Texts that start a result line (default: '// Result is' and '// probe accuracy results:').")
+    parser.add_argument("--raw-log", help="With --probe, also append the raw text responses to this file.")
+    capture.add_arguments(parser)
+    metrics.add_arguments(parser)
     # Parse arguments
     args = parser.parse_args()
-    
+    stats = metrics.setup(args, "gcode_response_spy")
 
-# Run the WebSocket listener
+    if args.capture and not args.probe:
+        parser.error("--capture needs --probe")
+    writer = capture.CaptureWriter(args.capture) if args.capture else None
+    if writer:
+        # Stopped like Ctrl-C, so the buffered points get written
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    extractor = ProbeExtractor(args.measurement, args.tag, args.result_header, writer) if args.probe else None
+    raw_log = open(args.raw_log, "a", buffering=1) if args.raw_log else None
 
-asyncio.run(listen_gcode_responses(host=args.host))
\ No newline at end of file
+    # Run the WebSocket listener
+    try:
+        asyncio.run(listen_gcode_responses(host=args.host, extractor=extractor, raw_log=raw_log, stats=stats))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if extractor:
+            lines = extractor.format(extractor.flush())
+            if lines:
+                print("\n".join(lines), flush=True)
+        if writer:
+            writer.close()
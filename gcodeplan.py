@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Writes G-code test plans: the G-code of one loop, repeated for every combination of the swept
+# parameters, with M118 markers that gcode_response_spy.py --probe keys the results on.
+#
+#   ./gcodeplan.py sweep.json --out "sweep-{printer}.gcode.gz"
+#   ./gcodeplan.py probe_accuracy --set loops=500 --sweep retract=2,5,10 --out z.gcode
+#
+# A plan is JSON, or the name of a built-in plan (see PLANS):
+#   {
+#     "header": ["; Z drift sweep"],
+#     "loop": ["PROBE_ACCURACY SAMPLE_RETRACT_DIST={retract} samples={samples}", "G4 P{dwell}"],
+#     "every": {"10": ["G28 Z"]},                                       after loops 1, 11, 21, ...
+#     "midpoint": ["G0 Z{excursion}"],                                  after loop loops // 2
+#     "footer": ["M400"],
+#     "parameters": {"loops": 100, "samples": 10, "retract": 10, "dwell": 0, "excursion": 390},
+#     "sweep": {"samples": [5, 10, 20], "retract": [2, 5, 10]},       every combination is a run
+#     "printers": {"vc4-400": {"excursion": 390}, "vc4-300": {"excursion": 290}}
+#   }
+# Lines take the parameters as {name}, and {loop} (from 1), {index} (from 0), {run} and {printer}.
+# Each printer gets its own output; --out then needs {printer} in it.
+#
+# Markers, unless "markers" is false: every run starts with "M118 Plan run: <run>/<runs> name=value ...",
+# every loop ends with "M118 Loop count: <loop>", the midpoint is "M118 Midpoint reached".
+#
+# The output is generated a chunk at a time and streamed to a buffered file, or to gzip for .gz names
+# or --gzip, so a sweep of hundreds of MB takes constant memory.
+import argparse
+import copy
+import gzip
+import io
+import itertools
+import json
+import re
+import sys
+import time
+
+import metrics
+
+PLANS = {
+    # genprobeaccuracy.py
+    'probe_accuracy': {
+        'header': ['; G-code to test for Z drift'],
+        'loop': ['PROBE_ACCURACY SAMPLE_RETRACT_DIST={retract} samples={samples}'],
+        'midpoint': ['G0 Z{excursion}'],
+        'parameters': {'loops': 100, 'retract': 10, 'samples': 10, 'excursion': 390},
+    },
+    # genzhops.py
+    'z_moves': {
+        'header': ['; G-code to test for Z drift'],
+        'loop': ['G0 Z{z}', 'G0 Z{z_home}'],
+        'every': {'10': ['M117 {index}', 'G4 P{dwell}']},
+        'footer': ['M400 ; Wait for all movements to finish', '; Test complete'],
+        'parameters': {'loops': 100, 'z': 1, 'z_home': 0, 'dwell': 1000},
+        'markers': False,
+    },
+}
+
+PLAN_KEYS = {'header', 'loop', 'every', 'midpoint', 'footer', 'parameters', 'sweep', 'printers', 'markers'}
+LOOP_PLACEHOLDERS = re.compile(r"\{(loop|index)\}")
+WHITESPACE = re.compile(r"\s+")
+# Pieces of text joined before a write
+CHUNK_PIECES = 4096
+
+def load_plan(source):
+    # A built-in plan by name, else a JSON file
+    if source in PLANS:
+        plan = copy.deepcopy(PLANS[source])
+    else:
+        with open(source) as f:
+            plan = json.load(f)
+    check_plan(plan)
+    return plan
+
+def check_plan(plan):
+    unknown = set(plan) - PLAN_KEYS
+    if unknown:
+        raise ValueError(f"unknown plan keys: {', '.join(sorted(unknown))}")
+    if not plan.get('loop'):
+        raise ValueError("the plan has no loop G-code")
+    for name, values in (plan.get('sweep') or {}).items():
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"sweep of {name} needs a list of values")
+    for every in plan.get('every') or {}:
+        if not str(every).isdigit() or int(every) < 1:
+            raise ValueError(f"every needs a positive number of loops, not {every}")
+
+def parse_value(text):
+    # '10' -> 10, '0.5' -> 0.5, anything else stays text
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def apply_overrides(plan, settings=None, sweeps=None):
+    # --set name=value fixes a parameter (and stops sweeping it), --sweep name=v1,v2,... sweeps it
+    for setting in settings or []:
+        name, _, value = setting.partition("=")
+        if not name or not value:
+            raise ValueError(f"expected name=value: {setting}")
+        plan.setdefault('parameters', {})[name] = parse_value(value)
+        (plan.get('sweep') or {}).pop(name, None)
+    for sweep in sweeps or []:
+        name, _, values = sweep.partition("=")
+        if not name or not values:
+            raise ValueError(f"expected name=value,value,...: {sweep}")
+        plan.setdefault('sweep', {})[name] = [parse_value(value) for value in values.split(",")]
+    check_plan(plan)
+
+def runs(plan, printer_parameters=None):
+    # The parameters of every run: the plan's, the printer's, then one combination of the swept values
+    sweep = plan.get('sweep') or {}
+    result = []
+    for values in itertools.product(*sweep.values()):
+        parameters = dict(plan.get('parameters') or {})
+        parameters.update(printer_parameters or {})
+        parameters.update(zip(sweep, values))
+        loops = parameters.get('loops')
+        if not isinstance(loops, int) or isinstance(loops, bool) or loops < 1:
+            raise ValueError(f"loops needs to be a positive whole number, not {loops!r}")
+        result.append(parameters)
+    return result
+
+def compile_lines(lines, mapping):
+    # Fills in everything but {loop} and {index}: [text, 'loop'|'index', text, ...]
+    text = "".join(line + "\n" for line in lines)
+    try:
+        text = text.format_map(mapping)
+    except KeyError as e:
+        raise ValueError(f"unknown parameter {e} in {lines}")
+    return LOOP_PLACEHOLDERS.split(text)
+
+def fill(pieces, loop):
+    if len(pieces) == 1:
+        return pieces[0]
+    values = {'loop': str(loop), 'index': str(loop - 1)}
+    return "".join(values[piece] if i % 2 else piece for i, piece in enumerate(pieces))
+
+def marker_parameters(parameters):
+    # name=value pairs, without spaces, for the run marker
+    return " ".join(f"{name}={WHITESPACE.sub('_', str(value))}" for name, value in parameters.items())
+
+def generate(plan, printer=None, stats=metrics.NO_METRICS):
+    # Yields the G-code of one printer's output, a chunk of text at a time
+    run_parameters = runs(plan, (plan.get('printers') or {}).get(printer))
+    markers = plan.get('markers', True)
+    loop_mapping = {'loop': '{loop}', 'index': '{index}'}
+    outer = dict(plan.get('parameters') or {}, printer=printer or '', runs=len(run_parameters), **loop_mapping)
+
+    chunk = [fill(compile_lines(plan.get('header') or [], outer), 0)]
+    for run, parameters in enumerate(run_parameters, 1):
+        mapping = dict(parameters, printer=printer or '', run=run, runs=len(run_parameters), **loop_mapping)
+        body = compile_lines(plan['loop'], mapping)
+        every = [(int(n), compile_lines(lines, mapping)) for n, lines in (plan.get('every') or {}).items()]
+        midpoint = compile_lines(plan.get('midpoint') or [], mapping)
+        loops = parameters['loops']
+        if markers:
+            chunk.append(f"M118 Plan run: {run}/{len(run_parameters)} {marker_parameters(parameters)}\n")
+        for loop in range(1, loops + 1):
+            chunk.append(fill(body, loop))
+            for n, pieces in every:
+                if (loop - 1) % n == 0:
+                    chunk.append(fill(pieces, loop))
+            if markers:
+                chunk.append(f"M118 Loop count: {loop}\n")
+            if loop == loops // 2:
+                if markers:
+                    chunk.append("M118 Midpoint reached\n")
+                chunk.append(fill(midpoint, loop))
+            if len(chunk) >= CHUNK_PIECES:
+                yield "".join(chunk)
+                chunk = []
+        stats.count("runs")
+        stats.count("loops", loops)
+    chunk.append(fill(compile_lines(plan.get('footer') or [], outer), 0))
+    yield "".join(chunk)
+
+def open_output(path, use_gzip=False, level=1):
+    # '-' for stdout; gzip for --gzip or a .gz name, else a file with a large buffer
+    if use_gzip or path.endswith(".gz"):
+        if path == "-":
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb", compresslevel=level))
+        return gzip.open(path, "wt", compresslevel=level)
+    if path == "-":
+        return sys.stdout
+    return open(path, "w", buffering=1 << 20)
+
+def outputs(plan, out):
+    # [(printer, path)], one output per printer
+    printers = list(plan.get('printers') or [None])
+    if len(printers) > 1 and "{printer}" not in out:
+        raise ValueError("a plan with several printers needs {printer} in the output name")
+    return [(printer, out.replace("{printer}", printer or "")) for printer in printers]
+
+def write_plan(plan, out, use_gzip=False, level=1, stats=metrics.NO_METRICS):
+    # Writes every printer's output, returns the number of characters written
+    written = 0
+    for printer, path in outputs(plan, out):
+        f = open_output(path, use_gzip, level)
+        try:
+            for text in generate(plan, printer, stats):
+                f.write(text)
+                written += len(text)
+        finally:
+            if f is sys.stdout:
+                f.flush()
+            else:
+                f.close()
+    stats.count("chars_out", written)
+    return written
+
+def add_arguments(parser):
+    parser.add_argument("plan", help=f"Plan file (JSON) or a built-in plan: {', '.join(PLANS)}")
+    parser.add_argument("--out", default="z.gcode",
+                        help="Output file, '-' for stdout, {printer} for the printer's name (default: z.gcode)")
+    parser.add_argument("--set", nargs='+', metavar="NAME=VALUE", help="Set parameters, e.g. loops=500")
+    parser.add_argument("--sweep", nargs='+', metavar="NAME=V1,V2", help="Sweep parameters, e.g. retract=2,5,10")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the output (also for output names ending in .gz)")
+    parser.add_argument("--gzip-level", type=int, default=1, choices=range(1, 10), metavar="1-9",
+                        help="Gzip compression level (default: 1, the fastest)")
+    parser.add_argument("--list", action="store_true", help="Only list the runs with their parameters")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate G-code test plans with parameter sweeps.")
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    stats = metrics.setup(args, "gcodeplan")
+    try:
+        plan = load_plan(args.plan)
+        apply_overrides(plan, args.set, args.sweep)
+        if args.list:
+            for printer, printer_parameters in (plan.get('printers') or {None: None}).items():
+                for run, parameters in enumerate(runs(plan, printer_parameters), 1):
+                    print(f"{printer or ''} {run} {marker_parameters(parameters)}".strip())
+            sys.exit(0)
+        start = time.perf_counter()
+        written = write_plan(plan, args.out, args.gzip, args.gzip_level, stats)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.out != "-":
+        print(f"Wrote {written / 1e6:.1f} MB of G-code in {time.perf_counter() - start:.1f} s", file=sys.stderr)
@@ -1,107 +1,266 @@
 #!/usr/bin/env python3
 import sys
-import re
+import time
+import shutil
 import argparse
+from array import array
 from datetime import datetime
 
+import metrics
+from lineprotocol import parse_line
+from streamio import StdinLines
+
+NAN = float("nan")
+
 def parse_line_protocol(line, format):
     # Example line format: measurement,tag key1=value1,key2=value2 timestamp
-    pattern = r'(?P<measurement>[\w_]+)(?:,(?P<tag>[\w=]+))? (?P<fields>.+) (?P<timestamp>\d+)$'
-    match = re.match(pattern, line)
-    
-    if not match:
+    parsed = parse_line(line)
+    if parsed is None or parsed['timestamp'] is None:
         return None
+    return format_entry(parsed, format)
 
-    # Parse components
-    measurement = match.group('measurement')
-    tag = match.group('tag')
-    timestamp = match.group('timestamp')
-    
-    # Parse fields into a dictionary
-    fields = match.group('fields')
-    field_data = {}
-    
-    for field in fields.split(','):
-        key, value = field.split('=')
-        try:
-            # Try to format as a float with up to 3 decimal places, preserving original format
-            float_value = float(value)
-            if float_value.is_integer():
-                # If the value is an integer, show it without decimals
-                field_data[key] = f"{int(float_value)}"
-            else:
-                # Only display up to 3 necessary decimal places
-                field_data[key] = f"{float_value:.3f}".rstrip('0').rstrip('.')
-        except ValueError:
-            # If not a float, keep as-is
-            field_data[key] = value
+def format_value(value):
+    if isinstance(value, float):
+        if value.is_integer():
+            # If the value is an integer, show it without decimals
+            return f"{int(value)}"
+        # Only display up to 3 necessary decimal places
+        return f"{value:.3f}".rstrip('0').rstrip('.')
+    # Integers, booleans and strings as-is
+    return str(value)
 
+def format_timestamp(timestamp, format):
     # Convert timestamp to a human-readable format
-    readable_timestamp = \
-        datetime.fromtimestamp(int(timestamp) / 1e9).strftime('%Y-%m-%d %H:%M:%S') if format == 'line' \
-            else datetime.fromtimestamp(int(timestamp) / 1e9).isoformat()
-    
+    moment = datetime.fromtimestamp(int(timestamp) / 1e9)
+    return moment.strftime('%Y-%m-%d %H:%M:%S') if format == 'line' else moment.isoformat()
+
+def format_entry(parsed, format):
+    # Format fields for display
     return {
-        'measurement': measurement,
-        'tag': tag,
-        'fields': field_data,
-        'timestamp': readable_timestamp
+        'measurement': parsed['measurement'],
+        'tag': parsed['tag'],
+        'fields': {key: format_value(value) for key, value in parsed['fields'].items()},
+        'timestamp': format_timestamp(parsed['timestamp'], format)
     }
 
-def display_header(fields, format):
-    if format == "line":
-        # Create the header with dynamic field names
-        header = f"{'Timestamp':<20} {'Measurement':<15} {'Tag':<20}"
-        for field in sorted(fields):
-            header += f"{field:<15}"
-        print(header, flush=True)
-        print("=" * len(header), flush=True)
-    elif format == 'csv':
-        header_parts = ['timestamp', 'measurement']
-        header_parts.extend(map(lambda f: f if not " " in f else '"' + f + '"', sorted(fields)))
-        header = ",".join(header_parts)
-        print(header, flush=True)
-
-def display_entry(entry, fields, format):
-    if format == "line":
-        # Ensure columns for all known fields, leaving space for missing fields
-        field_values = []
-        for field in sorted(fields):
-            value = entry['fields'].get(field, "")
-            field_values.append(f"{value:<15}")
-
-        line = f"{entry['timestamp']:<20} {entry['measurement']:<15} {entry['tag'] or '':<20}" + "".join(field_values)
-        print(line, flush=True)
-    elif format == "csv":
-        values = [entry['timestamp'],entry['measurement']]
-        values.extend(map(lambda f: entry['fields'].get(f,""), sorted(fields)))
-        line = ",".join(values)
-        print(line, flush=True)
+class ColumnLayout:
+    # The sorted columns of a field set with the header and row template compiled once,
+    # rebuilt only when a new field shows up
+    def __init__(self, fields, format):
+        self.fields = sorted(fields)
+        self.format = format
+        if format == "line":
+            # Create the header with dynamic field names
+            header = f"{'Timestamp':<20} {'Measurement':<15} {'Tag':<20}" + "".join(f"{field:<15}" for field in self.fields)
+            self.header = [header, "=" * len(header)]
+            self.template = "{:<20} {:<15} {:<20}" + "{:<15}" * len(self.fields)
+        else:
+            header_parts = ['timestamp', 'measurement']
+            header_parts.extend(map(lambda f: f if not " " in f else '"' + f + '"', self.fields))
+            self.header = [",".join(header_parts)]
+
+    def row(self, timestamp, measurement, tag, values):
+        # values: field -> formatted value, missing fields stay blank
+        if self.format == "line":
+            return self.template.format(timestamp, measurement, tag or '', *(values.get(field, "") for field in self.fields))
+        return ",".join([timestamp, measurement, *(values.get(field, "") for field in self.fields)])
+
+class Table:
+    # Scrolling output: one row per entry, the header again whenever new fields widen the table
+    def __init__(self, format, out=None):
+        self.format = format
+        self.out = out or sys.stdout
+        self.fields = set()  # Tracks all unique field names seen
+        self.layout = None
+
+    def show(self, entry):
+        fields = entry['fields']
+        if self.layout is None or not fields.keys() <= self.fields:
+            self.fields.update(fields)
+            self.layout = ColumnLayout(self.fields, self.format)
+            self.out.write("\n".join(self.layout.header) + "\n")
+        # Display each entry, filling in blanks for missing fields
+        self.out.write(self.layout.row(entry['timestamp'], entry['measurement'], entry['tag'], fields) + "\n")
+
+class RingBuffer:
+    # The last `capacity` rows of one series: timestamps and one float column per field, allocated
+    # once; NaN where a row didn't have the field. Strings go to a list of the same size.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('q', [0]) * capacity
+        self.columns = {}
+        self.texts = {}
+        self.kinds = {}  # Field -> type of its values, to show them as they came
+        self.next = 0
+        self.count = 0
+        self.updated = 0
+        self.layout = None
+
+    def add(self, timestamp, fields):
+        row = self.next
+        self.timestamps[row] = timestamp
+        for field, value in fields.items():
+            column = self.columns.get(field)
+            if column is None:
+                column = self.columns[field] = array('d', [NAN]) * self.capacity
+                self.kinds[field] = type(value)
+                # The field set changed
+                self.layout = None
+            if isinstance(value, str):
+                self.kinds[field] = str
+                texts = self.texts.get(field)
+                if texts is None:
+                    texts = self.texts[field] = [None] * self.capacity
+                texts[row] = value
+                column[row] = 0.0
+            else:
+                column[row] = value
+        if len(fields) < len(self.columns):
+            for field, column in self.columns.items():
+                if field not in fields:
+                    column[row] = NAN
+        self.next = (row + 1) % self.capacity
+        self.count += 1
+
+    def value(self, field, row):
+        # The value as it came, None if the row didn't have the field
+        value = self.columns[field][row]
+        if value != value:
+            return None
+        kind = self.kinds[field]
+        if kind is str:
+            return self.texts[field][row]
+        if kind is bool:
+            return bool(value)
+        if kind is int:
+            return int(value)
+        return value
+
+    def rows(self):
+        # Row numbers, oldest first
+        filled = min(self.count, self.capacity)
+        return [(self.next - filled + i) % self.capacity for i in range(filled)]
+
+class LiveView:
+    # Keeps the last rows of every series and redraws them in place at most `refresh` times a second,
+    # so memory and CPU stay flat however long the stream runs
+    def __init__(self, rows=10, refresh=2.0, max_series=20, out=None):
+        self.rows = rows
+        self.interval = 1.0 / refresh
+        self.max_series = max_series
+        self.out = out or sys.stdout
+        self.series = {}  # In order of appearance, so blocks stay put on screen
+        self.updates = 0
+        self.dirty = False
+        self.next_draw = time.monotonic()
+
+    def add(self, parsed):
+        key = (parsed['measurement'], parsed['tag'])
+        buffer = self.series.get(key)
+        if buffer is None:
+            if len(self.series) >= self.max_series:
+                # The least recently updated series makes room
+                del self.series[min(self.series, key=lambda k: self.series[k].updated)]
+            buffer = self.series[key] = RingBuffer(self.rows)
+        self.updates += 1
+        buffer.updated = self.updates
+        buffer.add(parsed['timestamp'], parsed['fields'])
+        self.dirty = True
+
+    def timeout(self):
+        # Seconds until the next redraw is due, None when there is nothing new
+        if not self.dirty:
+            return None
+        return max(0.0, self.next_draw - time.monotonic())
+
+    def render(self):
+        lines = []
+        for (measurement, tag), buffer in self.series.items():
+            if buffer.layout is None:
+                buffer.layout = ColumnLayout(buffer.columns, "line")
+            layout = buffer.layout
+            lines.extend(layout.header)
+            for row in buffer.rows():
+                values = {}
+                for field in layout.fields:
+                    value = buffer.value(field, row)
+                    if value is not None:
+                        values[field] = format_value(value)
+                lines.append(layout.row(format_timestamp(buffer.timestamps[row], "line"), measurement, tag, values))
+            lines.append("")
+        return lines
+
+    def draw(self, force=False):
+        # Returns True if it drew
+        now = time.monotonic()
+        if not force and (not self.dirty or now < self.next_draw):
+            return False
+        width, height = shutil.get_terminal_size()
+        lines = [line[:width] for line in self.render()[:height - 1]]
+        # Home, each line cleared to its end, the rest of the screen cleared: no flicker
+        self.out.write("\x1b[H" + "".join(line + "\x1b[K\n" for line in lines) + "\x1b[J")
+        self.out.flush()
+        self.dirty = False
+        self.next_draw = now + self.interval
+        return True
+
+def add_arguments(parser):
+    parser.add_argument("--format", choices=["csv", "line"], default="line", help="Output format: 'csv' or 'line' protocol (default: 'line').")
+    parser.add_argument("--live", action="store_true",
+                        help="Redraw the latest rows of every series in place instead of scrolling (line format only)")
+    parser.add_argument("--rows", type=int, default=10, help="Rows kept and shown per series with --live (default: 10)")
+    parser.add_argument("--refresh", type=float, default=2.0, help="Redraws per second at most with --live (default: 2)")
+    parser.add_argument("--max-series", type=int, default=20,
+                        help="Series shown with --live, the least recently updated ones make room (default: 20)")
+
+def check_arguments(parser, args):
+    if args.live and args.format != "line":
+        parser.error("--live needs --format line")
+    if args.rows < 1 or args.refresh <= 0 or args.max_series < 1:
+        parser.error("--rows, --refresh and --max-series must be positive")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate time-weighted averages from InfluxDB line protocol input.")
-    parser.add_argument("--format", choices=["csv", "line"], default="line", help="Output format: 'csv' or 'line' protocol (default: 'line').")
+    add_arguments(parser)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-    
-    parsed_data = []
-    all_fields = set()  # Tracks all unique field names seen
-    
-    # Read input line by line
-    for line in sys.stdin:
-        line = line.strip()
-        parsed_entry = parse_line_protocol(line, args.format)
-        if parsed_entry:
-            # Track fields to maintain consistent columns
-            current_fields = set(parsed_entry['fields'].keys())
-            new_fields = current_fields - all_fields
-            all_fields.update(current_fields)
-
-            # Display the header again if new fields are added
-            if new_fields:
-                display_header(all_fields, args.format)
-
-            # Display each entry, filling in blanks for missing fields
-            display_entry(parsed_entry, all_fields, args.format)
-
-            # Store the parsed entry for potential further processing
-            parsed_data.append(parsed_entry)
\ No newline at end of file
+    check_arguments(parser, args)
+    stats = metrics.setup(args, "humanread")
+
+    view = LiveView(args.rows, args.refresh, args.max_series) if args.live else None
+    table = Table(args.format)
+
+    # Read input a block at a time, write and flush once per block
+    reader = StdinLines()
+    try:
+        while True:
+            lines = reader.read(view.timeout() if view else None)
+            if lines is None:
+                break
+            for line in lines:
+                stats.count("lines_in")
+                if view:
+                    parsed = parse_line(line)
+                    if parsed is None or parsed['timestamp'] is None:
+                        stats.count("skipped")
+                        continue
+                    view.add(parsed)
+                    stats.count("lines_out")
+                    continue
+                parsed_entry = parse_line_protocol(line, args.format)
+                if parsed_entry:
+                    table.show(parsed_entry)
+                    stats.count("lines_out")
+                else:
+                    stats.count("skipped")
+            if view:
+                start = time.perf_counter()
+                if view.draw():
+                    stats.count("redraws")
+                    stats.observe("draw", time.perf_counter() - start)
+            else:
+                sys.stdout.flush()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    if view:
+        view.draw(force=True)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# A stand-in for InfluxDB's /api/v2/write, for trying out and benchmarking the writers without a server.
+# It accepts (gzipped) line protocol like InfluxDB does, refuses batches with invalid lines naming them,
+# and keeps count of what it got: points, requests, bytes and how long after their timestamp they arrived.
+# Errors and slow responses can be injected to exercise batching, retries and the spool.
+import argparse
+import gzip
+import json
+import random
+import signal
+import sys
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lineprotocol import parse_line
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of sorted values, None for none
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class WriteStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.points = 0
+            self.rejected = 0
+            self.errors = 0
+            self.bytes = 0
+            self.started = time.monotonic()
+            # Arrival time minus point timestamp, in ns, of every point with a timestamp
+            self.latencies = array('q')
+
+    def record(self, size, points, rejected, latencies):
+        with self.lock:
+            self.requests += 1
+            self.points += points
+            self.rejected += rejected
+            self.bytes += size
+            self.latencies.extend(latencies)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            latencies = sorted(self.latencies)
+            return {
+                'requests': self.requests,
+                'points': self.points,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'seconds': elapsed,
+                'points_per_second': self.points / elapsed if elapsed else 0.0,
+                'latency_p50_ms': None if not latencies else percentile(latencies, 0.5) / 1e6,
+                'latency_p99_ms': None if not latencies else percentile(latencies, 0.99) / 1e6,
+            }
+
+class WriteHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/health") or self.path.startswith("/ping"):
+            self.reply(200, {'status': 'pass'})
+        elif self.path.startswith("/stats"):
+            self.reply(200, self.server.stats.summary())
+        else:
+            self.reply(404, {'code': 'not found', 'message': 'path not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.startswith("/api/v2/write"):
+            self.reply(404, {'code': 'not found', 'message': 'path not found'})
+            return
+
+        server = self.server
+        if server.delay:
+            time.sleep(server.delay)
+        if server.error_rate and random.random() < server.error_rate:
+            with server.stats.lock:
+                server.stats.errors += 1
+            self.reply(503, {'code': 'unavailable', 'message': 'injected error'})
+            return
+
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        arrived = time.time_ns()
+        lines = [line for line in body.decode("utf-8", errors="replace").split("\n") if line.strip()]
+
+        accepted = []
+        rejected = []
+        latencies = []
+        for number, line in enumerate(lines, 1):
+            if server.validate:
+                parsed = parse_line(line)
+                if parsed is None or not parsed['fields']:
+                    rejected.append(f"line {number}: unable to parse '{line}': invalid line protocol")
+                    continue
+                timestamp = parsed['timestamp']
+            else:
+                # Just the timestamp, for when the stand-in must not be the bottleneck
+                last = line.rsplit(" ", 1)[-1]
+                timestamp = int(last) if last.isdigit() else None
+            if timestamp is not None:
+                latencies.append(arrived - timestamp)
+            accepted.append(line)
+
+        if rejected:
+            # Like InfluxDB 2.x: nothing of the batch is written, the error names the bad lines
+            server.stats.record(len(body), 0, len(rejected), [])
+            self.reply(400, {'code': 'invalid', 'message': "failed to parse line protocol: errors encountered on line(s):\n"
+                                                           + "\n".join(rejected)})
+            return
+        server.stats.record(len(body), len(accepted), 0, latencies)
+        if server.output and accepted:
+            with server.output_lock:
+                server.output.write("\n".join(accepted) + "\n")
+        self.reply(204)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(host="127.0.0.1", port=8086, *, validate=True, delay=0.0, error_rate=0.0, output=None):
+    # Port 0 picks a free one, see server.server_port
+    server = ThreadingHTTPServer((host, port), WriteHandler)
+    server.daemon_threads = True
+    server.stats = WriteStats()
+    server.validate = validate
+    server.delay = delay
+    server.error_rate = error_rate
+    server.output = output
+    server.output_lock = threading.Lock()
+    return server
+
+def format_summary(summary):
+    latency = ""
+    if summary['latency_p50_ms'] is not None:
+        latency = f", latency p50 {summary['latency_p50_ms']:.1f} ms p99 {summary['latency_p99_ms']:.1f} ms"
+    return (f"Received {summary['points']} points in {summary['requests']} requests "
+            f"({summary['points_per_second']:.0f} points/s), rejected {summary['rejected']}, "
+            f"errors {summary['errors']}{latency}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in InfluxDB /api/v2/write endpoint that counts what it receives.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8086, help="Port to listen on (default: 8086)")
+    parser.add_argument("--no-validate", action="store_true", help="Accept every line without parsing it")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before answering each write")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of writes to answer with 503 (e.g. 0.1)")
+    parser.add_argument("--output", help="Append the accepted lines to this file")
+    parser.add_argument("--summary-interval", type=float, default=10.0,
+                        help="Print the counters every this many seconds, 0 for only at exit (default: 10)")
+    args = parser.parse_args()
+
+    output = open(args.output, "a") if args.output else None
+    server = make_server(args.host, args.port, validate=not args.no_validate, delay=args.delay,
+                         error_rate=args.error_rate, output=output)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Listening on http://{args.host}:{server.server_port}/api/v2/write", flush=True)
+
+    # SIGTERM ends the stand-in like Ctrl-C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            time.sleep(args.summary_interval or 3600)
+            if args.summary_interval:
+                print(format_summary(server.stats.summary()), flush=True)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    if output:
+        output.close()
+    print(format_summary(server.stats.summary()), file=sys.stderr)
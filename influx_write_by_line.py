@@ -1,19 +1,19 @@
 #!/usr/bin/env python3
 
 import configparser
+import gzip
+import json
 import os
+import re
 import requests
 import sys
+import threading
+import time
 import argparse
 
-# Parse command-line arguments for the bucket name, config file, and config profile
-parser = argparse.ArgumentParser(description="Send line protocol data to InfluxDB")
-parser.add_argument('--bucket', required=True, help='The InfluxDB bucket to write data to')
-parser.add_argument('--config-file', default=os.path.expanduser('~/.influxdbv2/configs'),
-                    help='Path to the INI config file (default: ~/.influxdbv2/configs)')
-parser.add_argument('--config-name', default='onboarding', 
-                    help='Configuration profile name in the INI file (default: onboarding)')
-args = parser.parse_args()
+import metrics
+from spool import Spool, drain, start_drainer
+from streamio import StdinLines
 
 # Function to strip surrounding double quotes from a string
 def strip_quotes(value):
@@ -21,42 +21,355 @@ def strip_quotes(value):
         return value[1:-1]
     return value
 
-# Get the config file and config profile from the command-line argument or default values
-config_file_path = args.config_file
-config_name = args.config_name
-
-# Initialize the configparser and read the INI file
-config = configparser.ConfigParser()
-config.read(config_file_path)
-
-if config_name in config:
-    url = strip_quotes(config[config_name].get("url"))
-    token = strip_quotes(config[config_name].get("token"))
-    org = strip_quotes(config[config_name].get("org"))
-else:
-    raise ValueError(f"Configuration '{config_name}' not found in {config_file_path}")
-
-# Get the bucket from the command-line argument
-bucket = args.bucket
-
-# Prepare the HTTP request details
-precision = "ns"  # Precision for the timestamp (can be ns, ms, s, etc.)
-write_url = f"{url}/api/v2/write?org={org}&bucket={bucket}&precision={precision}"
-
-# Set up the HTTP headers
-headers = {
-    "Authorization": f"Token {token}",
-    "Content-Type": "text/plain; charset=utf-8"
-}
-
-# Read line protocol data from standard input and send it to InfluxDB
-for line in sys.stdin:
-    data = line.strip()  # Line protocol data from stdin
-    if data:  # Only send non-empty lines
-        response = requests.post(write_url, headers=headers, data=data)
-
-        # Check the response
+def load_config(config_file_path, config_name):
+    # Initialize the configparser and read the INI file
+    config = configparser.ConfigParser()
+    config.read(config_file_path)
+
+    if config_name in config:
+        url = strip_quotes(config[config_name].get("url"))
+        token = strip_quotes(config[config_name].get("token"))
+        org = strip_quotes(config[config_name].get("org"))
+    else:
+        raise ValueError(f"Configuration '{config_name}' not found in {config_file_path}")
+    return url, token, org
+
+# Error bodies of /api/v2/write name the rejected lines either by number ("line 3: ...")
+# or by quoting them ("unable to parse 'cpu,host=a value=': missing fields")
+LINE_NUMBER_RE = re.compile(r"\bline (\d+):")
+QUOTED_LINE_RE = re.compile(r"unable to parse '((?:[^'\\]|\\.)*)'")
+# 422 bodies only say how many points were dropped ("partial write: points beyond retention policy dropped=3")
+DROPPED_RE = re.compile(r"\bdropped=(\d+)")
+
+def find_rejected_lines(error_text, lines):
+    # Return the indexes of the lines the server refused, or an empty set if it didn't say
+    try:
+        message = json.loads(error_text).get("message", error_text)
+    except (ValueError, AttributeError):
+        message = error_text
+
+    rejected = set()
+    for number in LINE_NUMBER_RE.findall(message):
+        index = int(number) - 1
+        if 0 <= index < len(lines):
+            rejected.add(index)
+
+    quoted = set(QUOTED_LINE_RE.findall(message))
+    if quoted:
+        rejected.update(i for i, line in enumerate(lines) if line in quoted)
+
+    return rejected
+
+class InfluxWriter:
+    # Collects line protocol and sends it in batches over one keep-alive session.
+    # A batch is flushed when it reaches max_points, max_bytes or is older than linger seconds.
+    def __init__(self, url, token, org, bucket, *, max_points=5000, max_bytes=1 << 20,
+                 linger=1.0, use_gzip=False, echo=False, timeout=10):
+        precision = "ns"  # Precision for the timestamp (can be ns, ms, s, etc.)
+        self.write_url = f"{url}/api/v2/write?org={org}&bucket={bucket}&precision={precision}"
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.use_gzip = use_gzip
+        self.echo = echo
+        self.timeout = timeout
+
+        # One pooled session, so every batch reuses the same TCP/HTTP connection
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Token {token}",
+            "Content-Type": "text/plain; charset=utf-8"
+        })
+        if use_gzip:
+            self.session.headers["Content-Encoding"] = "gzip"
+
+        # Optional Spool that takes the batches which could not be delivered
+        self.spool = None
+        self.lock = threading.Lock()
+
+        self.lines = []
+        self.size = 0
+        self.first_added = None
+
+        # Optional metrics.Metrics for the write times and the latency until the server acknowledged
+        self.metrics = None
+
+        # Counters for the periodic summary
+        self.written = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self.spooled = 0
+
+    def add(self, line):
+        if not self.lines:
+            self.first_added = time.monotonic()
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if len(self.lines) >= self.max_points or self.size >= self.max_bytes:
+            self.flush()
+
+    def time_to_flush(self):
+        # Seconds until the linger deadline of the pending batch, None when nothing is pending
+        if not self.lines:
+            return None
+        return max(0.0, self.first_added + self.linger - time.monotonic())
+
+    def flush(self):
+        if not self.lines:
+            return True
+        lines = self.lines
+        first_added = self.first_added
+        self.lines = []
+        self.size = 0
+        self.first_added = None
+
+        if self.spool is not None and self.spool.has_backlog():
+            # The server is (or was just) unreachable: queue behind the backlog, the drainer sends it
+            self.spooled += len(lines)
+            return self.spool.append(lines)
+        if self.send(lines):
+            if self.metrics is not None:
+                self.observe_ack(lines, first_added)
+            return True
+        if self.spool is not None:
+            self.spooled += len(lines)
+            return self.spool.append(lines)
+        return False
+
+    def send(self, lines, retry=False):
+        # Used by both the main loop and the spool drainer thread
+        with self.lock:
+            return self.write_lines(lines, retry)
+
+    def resend(self, lines):
+        # For the spool: these lines were counted as failed when they were spooled
+        return self.send(lines, retry=True)
+
+    def post(self, lines):
+        body = ("\n".join(lines)).encode("utf-8")
+        if self.use_gzip:
+            body = gzip.compress(body, compresslevel=1)
+        if self.metrics is None:
+            return self.session.post(self.write_url, data=body, timeout=self.timeout)
+        start = time.perf_counter()
+        try:
+            return self.session.post(self.write_url, data=body, timeout=self.timeout)
+        finally:
+            self.metrics.observe("write", time.perf_counter() - start)
+
+    def observe_ack(self, lines, first_added):
+        # From reading the oldest line of the batch to the server's acknowledgement, and how old the newest point is by then
+        self.metrics.observe("ack", time.monotonic() - first_added)
+        timestamp = lines[-1].rsplit(" ", 1)[-1]
+        if timestamp.isdigit():
+            self.metrics.gauge("staleness_s", time.time() - int(timestamp) / 1e9)
+
+    def instrument(self, metrics):
+        self.metrics = metrics
+        metrics.watch("lines_out", lambda: self.written)
+        metrics.watch("rejected", lambda: self.rejected)
+        metrics.watch("failed", lambda: self.failed)
+        metrics.watch("requests", lambda: self.batches)
+        metrics.watch("pending", lambda: len(self.lines))
+        if self.spool is not None:
+            metrics.watch("spooled", lambda: self.spooled)
+            metrics.watch("spool_bytes", lambda: self.spool.total_bytes)
+
+    def report(self, message):
+        # Line by line (echo) the errors go to stdout next to the Wrote: lines, as they always have;
+        # batch mode keeps stdout for the summaries
+        print(message, file=sys.stdout if self.echo else sys.stderr)
+
+    def write_lines(self, lines, retry=False):
+        # Returns False when the batch could not be delivered (network or server error).
+        # A retry of spooled lines doesn't count them as failed again.
+        try:
+            response = self.post(lines)
+        except requests.RequestException as e:
+            self.report(f"Failed to write data: {e}")
+            if not retry:
+                self.failed += len(lines)
+            return False
+        self.batches += 1
+
         if response.status_code == 204:
-            print(f"Wrote: {data}", flush=True)
-        else:
-            print(f"Failed to write data: {response.status_code}, {response.text}")
\ No newline at end of file
+            self.written += len(lines)
+            if self.echo:
+                for line in lines:
+                    print(f"Wrote: {line}")
+            return True
+
+        if response.status_code in (400, 413) and len(lines) > 1:
+            return self.handle_partial_write(lines, response, retry)
+
+        if response.status_code == 422 and len(lines) > 1:
+            return self.accept_partial_write(lines, response)
+
+        if response.status_code in (400, 413, 422):
+            # One line the server won't take: sending it again would only hold up the lines after it
+            if self.echo:
+                self.report(f"Failed to write data: {response.status_code}, {response.text}")
+            else:
+                print(f"Rejected: {lines[0]}: {response.text}", file=sys.stderr)
+            self.rejected += 1
+            return True
+
+        self.report(f"Failed to write data: {response.status_code}, {response.text}")
+        if not retry:
+            self.failed += len(lines)
+        return False
+
+    def accept_partial_write(self, lines, response):
+        # 422: the server stored the batch except for the points it dropped (e.g. beyond the retention
+        # policy). Nothing to send again; count the dropped ones, by line when the error names them.
+        rejected = find_rejected_lines(response.text, lines)
+        for index in sorted(rejected):
+            print(f"Rejected: {lines[index]}", file=sys.stderr)
+        dropped = len(rejected)
+        if not dropped:
+            match = DROPPED_RE.search(response.text)
+            dropped = min(int(match.group(1)), len(lines)) if match else len(lines)
+            print(f"Rejected: {dropped} of {len(lines)} lines: {response.text}", file=sys.stderr)
+        self.rejected += dropped
+        self.written += len(lines) - dropped
+        return True
+
+    def handle_partial_write(self, lines, response, retry=False):
+        # Drop the lines the server complained about and resend the rest.
+        # Points are keyed by series and timestamp, so resending one already stored is harmless.
+        rejected = find_rejected_lines(response.text, lines) if response.status_code == 400 else set()
+        if rejected:
+            for index in sorted(rejected):
+                print(f"Rejected: {lines[index]}", file=sys.stderr)
+            self.rejected += len(rejected)
+            remaining = [line for i, line in enumerate(lines) if i not in rejected]
+            return self.write_lines(remaining, retry) if remaining else True
+
+        # The error didn't name the bad lines (or the body was too large): bisect the batch
+        middle = len(lines) // 2
+        first_ok = self.write_lines(lines[:middle], retry)
+        second_ok = self.write_lines(lines[middle:], retry)
+        return first_ok and second_ok
+
+    def summary(self):
+        summary = f"Wrote: {self.written} points in {self.batches} requests, rejected {self.rejected}, failed {self.failed}"
+        if self.spool is not None:
+            summary += f", spooled {self.spooled}, backlog {self.spool.total_bytes} bytes"
+        return summary
+
+    def use_spool(self, spool, max_points=5000, max_bytes=1 << 20):
+        # Undelivered batches go to the spool, a background thread sends them once the server is back
+        self.spool = spool
+        self.stop_drainer = threading.Event()
+        self.drainer = start_drainer(spool, self.resend, self.stop_drainer, max_points=max_points, max_bytes=max_bytes)
+
+    def close(self):
+        self.flush()
+        if self.spool is not None:
+            self.stop_drainer.set()
+            self.drainer.join()
+            # One last attempt to deliver the backlog, whatever is left stays for the next run
+            drain(self.spool, self.resend, max_points=self.max_points, max_bytes=self.max_bytes)
+            self.spool.close()
+        self.session.close()
+
+def add_arguments(parser):
+    parser.add_argument('--bucket', required=True, help='The InfluxDB bucket to write data to')
+    parser.add_argument('--config-file', default=os.path.expanduser('~/.influxdbv2/configs'),
+                        help='Path to the INI config file (default: ~/.influxdbv2/configs)')
+    parser.add_argument('--config-name', default='onboarding',
+                        help='Configuration profile name in the INI file (default: onboarding)')
+    parser.add_argument('--batch', action='store_true',
+                        help='Batch points instead of sending one request per line')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='Flush a batch after this many points (default: 5000)')
+    parser.add_argument('--batch-bytes', type=int, default=1 << 20,
+                        help='Flush a batch after this many bytes (default: 1 MiB)')
+    parser.add_argument('--linger', type=float, default=1.0,
+                        help='Flush a batch after it is this many seconds old (default: 1.0)')
+    parser.add_argument('--gzip', action='store_true', help='Gzip the request bodies')
+    parser.add_argument('--echo', action=argparse.BooleanOptionalAction, default=None,
+                        help='Print every written line (default: on without --batch, off with it)')
+    parser.add_argument('--summary-interval', type=float, default=10,
+                        help='Seconds between "Wrote:" summaries in batch mode, 0 to disable (default: 10)')
+    parser.add_argument('--spool', help='Directory for a disk spool that keeps undelivered points until the server is back')
+    parser.add_argument('--spool-max-bytes', type=int, default=512 << 20,
+                        help='Disk space the spool may use (default: 512 MiB)')
+    parser.add_argument('--spool-segment-bytes', type=int, default=8 << 20,
+                        help='Size of one spool segment file (default: 8 MiB)')
+    parser.add_argument('--spool-drop', choices=['oldest', 'newest'], default='oldest',
+                        help='What to drop when the spool is full (default: oldest)')
+    parser.add_argument('--spool-fsync', action='store_true',
+                        help='fsync every spool write, survives power loss at the cost of throughput')
+
+def parse_arguments():
+    # Parse command-line arguments for the bucket name, config file, and config profile
+    parser = argparse.ArgumentParser(description="Send line protocol data to InfluxDB")
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    return parser.parse_args()
+
+def make_writer(args):
+    # Get the config file and config profile from the command-line argument or default values
+    url, token, org = load_config(args.config_file, args.config_name)
+
+    echo = args.echo if args.echo is not None else not args.batch
+    if args.batch:
+        writer = InfluxWriter(url, token, org, args.bucket, max_points=args.batch_size,
+                              max_bytes=args.batch_bytes, linger=args.linger,
+                              use_gzip=args.gzip, echo=echo)
+    else:
+        # One point per request, as before, but over a kept-alive connection
+        writer = InfluxWriter(url, token, org, args.bucket, max_points=1, linger=0,
+                              use_gzip=args.gzip, echo=echo)
+
+    if args.spool:
+        writer.use_spool(Spool(args.spool, segment_bytes=args.spool_segment_bytes, max_bytes=args.spool_max_bytes,
+                               drop_policy=args.spool_drop, fsync=args.spool_fsync),
+                         max_points=args.batch_size, max_bytes=args.batch_bytes)
+    return writer
+
+def main():
+    args = parse_arguments()
+    writer = make_writer(args)
+    stats = metrics.setup(args, "influx_write_by_line")
+    writer.instrument(stats)
+    echo = writer.echo
+
+    summary_interval = args.summary_interval if args.batch else 0
+    next_summary = time.monotonic() + summary_interval
+
+    # Read line protocol data from standard input and send it to InfluxDB
+    reader = StdinLines()
+    try:
+        while True:
+            timeout = writer.time_to_flush()
+            if summary_interval:
+                until_summary = max(0.0, next_summary - time.monotonic())
+                timeout = until_summary if timeout is None else min(timeout, until_summary)
+
+            lines = reader.read(timeout)
+            if lines is None:
+                break
+            stats.count("lines_in", len(lines))
+            for data in lines:
+                if data:  # Only send non-empty lines
+                    writer.add(data)
+
+            if writer.time_to_flush() == 0:
+                writer.flush()
+            if summary_interval and time.monotonic() >= next_summary:
+                print(writer.summary(), flush=True)
+                next_summary = time.monotonic() + summary_interval
+            elif echo:
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        if summary_interval:
+            print(writer.summary(), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import re
+
+# InfluxDB line protocol: measurement[,tag=value...] field=value[,field=value...] [timestamp]
+#
+# A parsed line is a dict like the ones the scripts always passed around:
+#   {'measurement': 'probe', 'tag': 'printer=vc4-400', 'fields': {'range': 0.0025}, 'timestamp': 1728...}
+# 'tag' is the tag set exactly as it was written (still escaped, None without tags), which is what
+# the scripts use as series key and write back out; parse_tags() turns it into a dict when needed.
+# Field values are typed: float, int (123i / 123u), bool or str. InfluxDB refuses NaN and infinity,
+# so lines with them don't parse and fields with them aren't written.
+
+TRUE_VALUES = {"t", "T", "true", "True", "TRUE"}
+FALSE_VALUES = {"f", "F", "false", "False", "FALSE"}
+
+MEASUREMENT_ESCAPE_RE = re.compile(r"([, \\])")
+KEY_ESCAPE_RE = re.compile(r"([,= \\])")
+UNESCAPE_RE = re.compile(r"\\(.)")
+STRING_UNESCAPES = {"n": "\n"}
+
+def unescape_string(match):
+    character = match.group(1)
+    return STRING_UNESCAPES.get(character, character)
+
+def parse_value(value):
+    last = value[-1:]
+    if last == "i" or last == "u":
+        return int(value[:-1])
+    if last == '"':
+        if len(value) < 2 or value[0] != '"':
+            raise ValueError(f"Unterminated string: {value}")
+        value = value[1:-1]
+        return UNESCAPE_RE.sub(unescape_string, value) if "\\" in value else value
+    try:
+        number = float(value)
+    except ValueError:
+        if value in TRUE_VALUES:
+            return True
+        if value in FALSE_VALUES:
+            return False
+        raise
+    if number - number != 0:
+        raise ValueError(f"Not a finite number: {value}")
+    return number
+
+# Tokens between unescaped separators, a double-quoted string counts as one piece
+SPACE_TOKEN_RE = re.compile(r'(?:[^ "\\]|\\.|"(?:[^"\\]|\\.)*")+')
+COMMA_TOKEN_RE = re.compile(r'(?:[^,"\\]|\\.|"(?:[^"\\]|\\.)*")+')
+KEY_VALUE_RE = re.compile(r'((?:[^=\\]|\\.)+)=(.*)', re.DOTALL)
+HEAD_RE = re.compile(r'((?:[^,\\]|\\.)+)(?:,(.*))?', re.DOTALL)
+
+def unescape(text):
+    return UNESCAPE_RE.sub(r"\1", text) if "\\" in text else text
+
+def parse_line_slow(line):
+    # Handles escaped characters and string fields that may contain spaces, commas and equal signs
+    parts = SPACE_TOKEN_RE.findall(line)
+    if len(parts) == 3:
+        head, fields_part, timestamp = parts[0], parts[1], int(parts[2])
+    elif len(parts) == 2:
+        head, fields_part, timestamp = parts[0], parts[1], None
+    else:
+        return None
+
+    match = HEAD_RE.fullmatch(head)
+    if not match:
+        return None
+    measurement = unescape(match.group(1))
+    tag = match.group(2) or None
+
+    fields = {}
+    for item in COMMA_TOKEN_RE.findall(fields_part):
+        match = KEY_VALUE_RE.fullmatch(item)
+        if not match:
+            return None
+        fields[unescape(match.group(1))] = parse_value(match.group(2))
+
+    return {'measurement': measurement, 'tag': tag, 'fields': fields, 'timestamp': timestamp}
+
+def parse_line(line):
+    # Returns None for blank lines, comments and lines that are not valid line protocol
+    line = line.strip()
+    if not line or line[0] == "#":
+        return None
+    try:
+        if "\\" in line or '"' in line:
+            return parse_line_slow(line)
+
+        # Fast path: no escaping and no strings, plain str.split does the work
+        parts = line.split(" ")
+        if len(parts) == 3:
+            head, fields_part, timestamp = parts
+            timestamp = int(timestamp)
+        elif len(parts) == 2:
+            head, fields_part = parts
+            timestamp = None
+        else:
+            return None
+
+        measurement, _, tag = head.partition(",")
+        fields = {}
+        for item in fields_part.split(","):
+            key, separator, value = item.partition("=")
+            if not separator or not key:
+                return None
+            # Plain floats are by far the most common, try them first; NaN and inf fail the check
+            try:
+                number = float(value)
+                if number - number != 0:
+                    raise ValueError(value)
+                fields[key] = number
+            except ValueError:
+                fields[key] = parse_value(value)
+    except ValueError:
+        return None
+
+    return {'measurement': measurement, 'tag': tag or None, 'fields': fields, 'timestamp': timestamp}
+
+def parse_lines(buffer):
+    # Batch API: parse a whole buffer (str or bytes) of newline separated lines, skipping invalid ones
+    if isinstance(buffer, (bytes, bytearray, memoryview)):
+        buffer = bytes(buffer).decode("utf-8", errors="replace")
+    points = []
+    append = points.append
+    for line in buffer.split("\n"):
+        point = parse_line(line)
+        if point is not None:
+            append(point)
+    return points
+
+def parse_tags(tag):
+    # 'host=ratos2.local,printer=vc4' -> {'host': 'ratos2.local', 'printer': 'vc4'}
+    tags = {}
+    for item in COMMA_TOKEN_RE.findall(tag or ""):
+        match = KEY_VALUE_RE.fullmatch(item)
+        if match:
+            tags[unescape(match.group(1))] = unescape(match.group(2))
+    return tags
+
+def escape_measurement(name):
+    return MEASUREMENT_ESCAPE_RE.sub(r"\\\1", name)
+
+def escape_key(key):
+    return KEY_ESCAPE_RE.sub(r"\\\1", key)
+
+def format_tags(tags):
+    # {'printer': 'vc4 400'} -> 'printer=vc4\ 400', sorted by key as InfluxDB prefers
+    return ",".join(f"{escape_key(key)}={escape_key(str(value))}" for key, value in sorted(tags.items()))
+
+def format_value(value, precision=None):
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        if precision is None:
+            return repr(value)
+        # Up to precision decimals, without trailing zeros
+        return f"{value:.{precision}f}".rstrip("0").rstrip(".")
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{value}"'
+
+# Escaped "key=" prefixes of the field keys seen so far, field names repeat on every line
+FIELD_PREFIXES = {}
+
+def format_fields(fields, precision=None):
+    parts = []
+    append = parts.append
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, float) and value - value != 0:
+            # NaN or infinity, InfluxDB would refuse the whole batch
+            continue
+        prefix = FIELD_PREFIXES.get(key)
+        if prefix is None:
+            if len(FIELD_PREFIXES) > 4096:
+                FIELD_PREFIXES.clear()
+            prefix = FIELD_PREFIXES[key] = escape_key(key) + "="
+        if precision is None and type(value) is float:
+            append(prefix + repr(value))
+        else:
+            append(prefix + format_value(value, precision))
+    return ",".join(parts)
+
+def format_line(measurement, tag, fields, timestamp=None, precision=None):
+    # tag is either an already formatted tag set string (as found in parsed lines) or a dict.
+    # Fields set to None, NaN or infinity are left out.
+    if isinstance(tag, dict):
+        tag = format_tags(tag)
+    head = escape_measurement(measurement) if " " in measurement or "," in measurement else measurement
+    if tag:
+        head = f"{head},{tag}"
+    field_part = format_fields(fields, precision)
+    if timestamp is None:
+        return f"{head} {field_part}"
+    return f"{head} {field_part} {timestamp}"
@@ -0,0 +1,178 @@
+import atexit
+import cProfile
+import signal
+import socket
+import sys
+import threading
+import time
+
+from lineprotocol import format_line
+
+# Self-metrics of a stage: counters (lines in, out, skipped, failed, reconnects, ...), gauges (queue depths,
+# spool backlog) and time histograms (parse, write, ack latency). Counting is a dict update under a lock,
+# timing two perf_counter() calls, so it stays on all the time; the numbers are written as line protocol to
+# stderr or a file whenever the process gets SIGUSR1, and with --stats-interval or --stats-output every
+# --stats-interval seconds and at exit:
+#
+#   zhopper_stats,host=pi,stage=convert_to_influx lines_in=1200i,lines_out=1180i,skipped=20i,parse_p99_ms=0.25,...
+
+MEASUREMENT = "zhopper_stats"
+
+class Histogram:
+    # Counts per power-of-two bucket of microseconds: bucket n holds durations below 2**n us
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * 40
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[min(39, int(seconds * 1e6).bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction):
+        # Interpolated within the bucket the quantile falls in, in seconds
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                low = (1 << bucket) / 2e6 if bucket else 0.0
+                high = (1 << bucket) / 1e6
+                return min(self.max, low + (high - low) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+class Metrics:
+    def __init__(self, stage, tags=None):
+        self.stage = stage
+        self.tags = {'stage': stage, 'host': socket.gethostname(), **(tags or {})}
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_functions = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+        self.output = sys.stderr
+        # Taken for every update too, as the reporter thread reads the dicts while the stage adds names.
+        # Reentrant: SIGUSR1 may arrive while the main thread holds it
+        self.lock = threading.RLock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def watch(self, name, function):
+        # A value read when the stats are written, e.g. lambda: queue.qsize() or a counter kept elsewhere
+        with self.lock:
+            self.gauge_functions[name] = function
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def fields(self):
+        fields = {'uptime_s': time.monotonic() - self.started}
+        with self.lock:
+            fields.update(self.counters)
+            gauges = dict(self.gauges)
+            gauge_functions = list(self.gauge_functions.items())
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                if not histogram.count:
+                    continue
+                histograms[f"{name}_count"] = histogram.count
+                histograms[f"{name}_mean_ms"] = histogram.total / histogram.count * 1e3
+                histograms[f"{name}_p50_ms"] = histogram.quantile(0.5) * 1e3
+                histograms[f"{name}_p99_ms"] = histogram.quantile(0.99) * 1e3
+                histograms[f"{name}_max_ms"] = histogram.max * 1e3
+        for name, function in gauge_functions:
+            try:
+                gauges[name] = function()
+            except Exception:
+                continue
+        for name, value in gauges.items():
+            # Counts stay integers, anything else is a float
+            fields[name] = value if type(value) is int else float(value)
+        fields.update(histograms)
+        return fields
+
+    def line(self):
+        return format_line(MEASUREMENT, self.tags, self.fields(), time.time_ns(), precision=3)
+
+    def report(self):
+        with self.lock:
+            try:
+                self.output.write(self.line() + "\n")
+                self.output.flush()
+            except (OSError, ValueError):
+                pass
+
+class NullMetrics:
+    # For library callers that don't collect metrics
+    def count(self, name, amount=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def watch(self, name, function):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+NO_METRICS = NullMetrics()
+
+def add_arguments(parser):
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="Write the stage's own counters and timings as line protocol every this many seconds "
+                             "(default: 0, only on SIGUSR1)")
+    parser.add_argument("--stats-output", help="File to append the stats to (default: stderr)")
+    parser.add_argument("--profile", help="Run under cProfile and write the profile to this file at exit (read it with pstats)")
+
+def start_reporter(metrics, interval):
+    # A daemon thread, so the stats keep coming while the stage is blocked reading its input
+    def report():
+        while True:
+            time.sleep(interval)
+            metrics.report()
+    thread = threading.Thread(target=report, name="stats", daemon=True)
+    thread.start()
+    return thread
+
+def start_profile(path):
+    profile = cProfile.Profile()
+    profile.enable()
+
+    def dump():
+        profile.disable()
+        profile.dump_stats(path)
+    atexit.register(dump)
+    return profile
+
+def setup(args, stage, tags=None):
+    # The Metrics of this process, reporting as the command line asked
+    metrics = Metrics(stage, tags)
+    if getattr(args, "stats_output", None):
+        metrics.output = open(args.stats_output, "a")
+    if getattr(args, "profile", None):
+        start_profile(args.profile)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: metrics.report())
+    if getattr(args, "stats_interval", 0):
+        start_reporter(metrics, args.stats_interval)
+    if getattr(args, "stats_interval", 0) or getattr(args, "stats_output", None):
+        # Only when asked for, so interactive pipes don't get a stats line from every stage
+        atexit.register(metrics.report)
+    return metrics
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# A stand-in for Moonraker's websocket, for trying out and benchmarking the collectors without a printer.
+# It answers printer.objects.subscribe and sends notify_status_update and notify_gcode_response,
+# either synthetic (heaters drifting around their targets, PROBE_ACCURACY loops like genprobeaccuracy.py
+# runs them) or replayed from a templogger.py line protocol capture and a gcode_response_spy.py log.
+# Every connection is an independent printer; --printers listens on several consecutive ports.
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import random
+import signal
+import time
+
+import websockets
+
+from convert_to_influx import TimestampParser
+from lineprotocol import parse_line
+
+# templogger.py field suffixes -> Moonraker status keys
+FIELD_KEYS = {"_temp": "temperature", "_target": "target", "_pwm": "power"}
+
+def object_names(objects, count=None):
+    # The given objects, then extruder1, extruder2, ... up to count
+    names = list(objects)
+    extra = itertools.count(1)
+    while count is not None and len(names) < count:
+        name = f"extruder{next(extra)}"
+        if name not in names:
+            names.append(name)
+    return names[:count] if count is not None else names
+
+class SyntheticStatus:
+    # Heaters at their target with some noise, the PWM following the error
+    def __init__(self, names, seed=None):
+        self.rng = random.Random(seed)
+        self.state = {}
+        for name in names:
+            target = 60.0 if "bed" in name else 200.0
+            self.state[name] = {"temperature": target, "target": target, "power": 0.3}
+
+    def update(self, subscribed):
+        delta = {}
+        for name in subscribed:
+            heater = self.state.get(name)
+            if heater is None:
+                continue
+            heater["temperature"] = round(heater["target"] + self.rng.gauss(0, 0.3), 2)
+            heater["power"] = round(min(1.0, max(0.0, 0.3 + (heater["target"] - heater["temperature"]) * 0.2)), 3)
+            delta[name] = {"temperature": heater["temperature"], "power": heater["power"]}
+        return delta
+
+def synthetic_gcode(samples=10, loops=100):
+    # The responses of genprobeaccuracy.py's G-code, loop after loop
+    rng = random.Random(1)
+    for loop in itertools.cycle(range(1, loops + 1)):
+        zs = [round(2.5 + rng.gauss(0, 0.003), 4) for _ in range(samples)]
+        for z in zs:
+            yield f"// probe at 150.000,150.000 is z={z:.6f}"
+        zs.sort()
+        average = sum(zs) / len(zs)
+        deviation = (sum((z - average) ** 2 for z in zs) / len(zs)) ** 0.5
+        yield (f"// probe accuracy results: maximum {zs[-1]:.6f}, minimum {zs[0]:.6f}, range {zs[-1] - zs[0]:.6f}, "
+               f"average {average:.6f}, median {zs[len(zs) // 2]:.6f}, standard deviation {deviation:.6f}")
+        yield f"Loop count: {loop}"
+        if loop == loops // 2:
+            yield "Midpoint reached"
+
+def load_status_capture(path):
+    # templogger.py output -> [(seconds since the first line, {obj: {"temperature": ...}})]
+    events = []
+    first = None
+    with open(path) as f:
+        for line in f:
+            parsed = parse_line(line)
+            if parsed is None or parsed['timestamp'] is None:
+                continue
+            status = {}
+            for key, value in parsed['fields'].items():
+                for suffix, status_key in FIELD_KEYS.items():
+                    if key.endswith(suffix):
+                        status.setdefault(key[:-len(suffix)], {})[status_key] = value
+            if first is None:
+                first = parsed['timestamp']
+            events.append(((parsed['timestamp'] - first) / 1e9, status))
+    return events
+
+def load_gcode_log(path):
+    # gcode_response_spy.py log -> [(seconds since the first line, response)]
+    parse_timestamp = TimestampParser()
+    events = []
+    first = None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            try:
+                timestamp = parse_timestamp(line[:19])
+            except ValueError:
+                continue
+            if first is None:
+                first = timestamp
+            events.append(((timestamp - first) / 1e9, line[20:]))
+    return events
+
+async def paced(events, speed):
+    # Yields the items of (offset in seconds, item) at their offsets divided by speed, 0 for as fast as possible
+    start = time.monotonic()
+    for count, (offset, item) in enumerate(events):
+        delay = start + offset / speed - time.monotonic() if speed else 0
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif count % 100 == 0:
+            # Behind schedule or unpaced, still let the other connections have a turn
+            await asyncio.sleep(0)
+        yield item
+
+def rate_events(rate, items=None):
+    # (offset, item) at rate per second, items defaults to None forever
+    items = itertools.repeat(None) if items is None else items
+    return ((i / rate, item) for i, item in enumerate(items))
+
+class Printer:
+    def __init__(self, args, seed):
+        self.args = args
+        self.status = SyntheticStatus(object_names(args.obj, args.objects), seed)
+        self.capture = None
+        if args.replay_status:
+            # The objects of the capture, starting in their first recorded state
+            self.capture = load_status_capture(args.replay_status)
+            self.status.state = {}
+            for _, status in self.capture:
+                for name, values in status.items():
+                    self.status.state.setdefault(name, {}).update(values)
+        self.sent = 0
+
+    async def send(self, websocket, method, params):
+        await websocket.send(json.dumps({"jsonrpc": "2.0", "method": method, "params": params}))
+        self.sent += 1
+
+    async def status_updates(self, websocket, subscribed):
+        if self.capture is not None:
+            async for status in paced(self.capture, self.args.speed):
+                status = {name: values for name, values in status.items() if name in subscribed}
+                if status:
+                    await self.send(websocket, "notify_status_update", [status, time.monotonic()])
+        elif self.args.rate:
+            async for _ in paced(rate_events(self.args.rate), 1):
+                await self.send(websocket, "notify_status_update", [self.status.update(subscribed), time.monotonic()])
+
+    async def gcode_responses(self, websocket):
+        if self.args.replay_gcode:
+            events = load_gcode_log(self.args.replay_gcode)
+            speed = self.args.speed
+        elif self.args.gcode_rate:
+            events = rate_events(self.args.gcode_rate, synthetic_gcode(self.args.samples, self.args.loops))
+            speed = 1
+        else:
+            return
+        async for response in paced(events, speed):
+            await self.send(websocket, "notify_gcode_response", [response])
+
+    async def handle(self, websocket):
+        tasks = [asyncio.create_task(self.gcode_responses(websocket))]
+        try:
+            async for message in websocket:
+                request = json.loads(message)
+                if request.get("method") == "printer.objects.subscribe":
+                    subscribed = [name for name in request["params"]["objects"] if name in self.status.state]
+                    status = {name: dict(self.status.state[name]) for name in subscribed}
+                    await websocket.send(json.dumps({"jsonrpc": "2.0", "id": request.get("id"),
+                                                     "result": {"eventtime": time.monotonic(), "status": status}}))
+                    tasks.append(asyncio.create_task(self.status_updates(websocket, subscribed)))
+                elif "id" in request:
+                    await websocket.send(json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": "ok"}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Stand-in Moonraker websocket sending synthetic or recorded printer traffic.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=7125, help="Port of the first printer (default: 7125)")
+    parser.add_argument("--printers", type=int, default=1, help="Number of printers, one per port from --port on (default: 1)")
+    parser.add_argument("--obj", nargs='+', default=["extruder", "heater_bed"],
+                        help="Heater objects of each printer (default: extruder heater_bed)")
+    parser.add_argument("--objects", type=int, help="Number of heater objects, more than --obj adds extruder1, extruder2, ...")
+    parser.add_argument("--rate", type=float, default=4.0,
+                        help="Status updates per second per printer, 0 for none (default: 4, Moonraker's usual rate)")
+    parser.add_argument("--gcode-rate", type=float, default=0.0,
+                        help="Synthetic PROBE_ACCURACY responses per second per printer (default: 0, none)")
+    parser.add_argument("--samples", type=int, default=10, help="Probe samples per synthetic PROBE_ACCURACY (default: 10)")
+    parser.add_argument("--loops", type=int, default=100, help="Synthetic loops before the loop count starts over (default: 100)")
+    parser.add_argument("--replay-status", help="Send the states of this templogger.py line protocol capture instead")
+    parser.add_argument("--replay-gcode", help="Send the responses of this gcode_response_spy.py log instead")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed, 2 for twice as fast, 0 for as fast as possible (default: 1)")
+    return parser.parse_args()
+
+async def serve(args):
+    printers = []
+    async with contextlib.AsyncExitStack() as stack:
+        for number in range(args.printers):
+            printer = Printer(args, seed=number)
+            printers.append(printer)
+            await stack.enter_async_context(websockets.serve(printer.handle, args.host, args.port + number))
+        print(f"Serving {args.printers} printer(s) on ws://{args.host}:{args.port}"
+              f"{f'-{args.port + args.printers - 1}' if args.printers > 1 else ''}/websocket", flush=True)
+        try:
+            await asyncio.Future()
+        finally:
+            print(f"Sent {sum(printer.sent for printer in printers)} notifications", flush=True)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    # SIGTERM ends the simulator like Ctrl-C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+# Runs a chain of the stages in one process, handing parsed records from one to the next
+# instead of formatting line protocol and parsing it again at every pipe:
+#
+#   ./pipeline.py temps --host ratos2.local --obj extruder heater_bed --measurement ratos2 :: summarize --interval 30 :: humanread
+#
+# A record is a dict like the parsed lines: {'measurement', 'tag', 'fields', 'timestamp'}, or
+# {'text', 'timestamp'} for G-code responses and log lines that are not converted yet.
+# Stages pass lists of records (whatever they have at hand, a whole stdin block at a time) over
+# bounded queues: a slow stage makes the ones before it wait.
+import argparse
+import asyncio
+import signal
+import sys
+import time
+from datetime import datetime
+
+import websockets
+
+from convert_to_influx import TimestampParser, make_timezone, parse_results
+from gcode_response_spy import RESULT_HEADERS, ProbeExtractor, gcode_responses
+import humanread
+from lineprotocol import format_line, parse_line
+from streamio import StdinLines
+from templogger import sample_status, temperature_fields
+import capture
+import compress
+import influx_write_by_line
+import metrics
+import summarizer
+import thermal_join
+
+STAGE_SEPARATOR = "::"
+# Put downstream when a stage is done
+END = None
+
+class StageQueue(asyncio.Queue):
+    # Counts the records that go through it, its depth is watched by the metrics
+    def __init__(self, maxsize, stats, name):
+        super().__init__(maxsize=maxsize)
+        self.stats = stats
+        self.counter = f"{name}_records"
+        # Set when the stage reading it failed: nothing takes from it any more, puts are dropped
+        self.closed = False
+
+    async def put(self, batch):
+        if not self.closed:
+            await super().put(batch)
+
+    def put_nowait(self, batch):
+        if batch is not END:
+            self.stats.count(self.counter, len(batch))
+        super().put_nowait(batch)
+
+async def receive(inbox, timeout=None):
+    # The next list of records, [] after timeout seconds without any, END when the stage before is done
+    try:
+        return await asyncio.wait_for(inbox.get(), timeout) if inbox.empty() else inbox.get_nowait()
+    except asyncio.TimeoutError:
+        return []
+
+# Sources
+
+def temps_arguments(parser):
+    parser.add_argument("--host", required=True, help="Hostname or IP address of the Moonraker server.")
+    parser.add_argument("--obj", required=True, nargs='+', help="Objects to monitor (e.g., heater_bed extruder).")
+    parser.add_argument("--measurement", required=True, help="The measurement name for the records.")
+    parser.add_argument("--tag", help="Optional tag in the format key=value.")
+    parser.add_argument("--rate", type=float, help="Sample the current state this many times per second instead of on every update.")
+    parser.add_argument("--on-change", action="store_true", help="Only pass on states where a value changed.")
+
+async def temps_source(args, inbox, outbox):
+    try:
+        async for status_data in sample_status(args.host, args.obj, rate=args.rate, on_change=args.on_change, stats=args.stats):
+            fields = temperature_fields(args.obj, status_data)
+            if fields:
+                await outbox.put([{'measurement': args.measurement, 'tag': args.tag, 'fields': fields, 'timestamp': time.time_ns()}])
+    except websockets.ConnectionClosedOK:
+        # Moonraker shut down cleanly, the end of the input
+        pass
+
+def gcode_arguments(parser):
+    parser.add_argument("--host", required=True, help="Hostname or IP address of the Moonraker server.")
+    parser.add_argument("--probe", action="store_true",
+                        help="Pass on PROBE_ACCURACY results and loop markers as records instead of the raw text.")
+    parser.add_argument("--measurement", default="probe", help="Measurement name for --probe (default: probe, markers go to probe_marker).")
+    parser.add_argument("--tag", help="Optional tag in the format key=value for --probe.")
+    parser.add_argument("--result-header", nargs='+', default=RESULT_HEADERS,
+                        help="Texts that start a result line (default: '// Result is' and '// probe accuracy results:').")
+    parser.add_argument("--raw-log", help="Also append the raw text responses to this file.")
+
+async def gcode_source(args, inbox, outbox):
+    extractor = ProbeExtractor(args.measurement, args.tag, args.result_header) if args.probe else None
+    raw_log = open(args.raw_log, "a", buffering=1) if args.raw_log else None
+    try:
+        async for response, received_ns in gcode_responses(args.host, args.stats):
+            if raw_log:
+                timestamp = datetime.fromtimestamp(received_ns / 1e9).strftime("%Y-%m-%d %H:%M:%S")
+                raw_log.write(f"{timestamp} {response}\n")
+            if extractor is None:
+                await outbox.put([{'text': response, 'timestamp': received_ns}])
+                continue
+            extracted = extractor.extract(response, received_ns)
+            if extracted:
+                await outbox.put([{'measurement': measurement, 'tag': args.tag, 'fields': fields, 'timestamp': timestamp}
+                                  for measurement, fields, timestamp in extracted])
+    except websockets.ConnectionClosedOK:
+        pass
+    finally:
+        if extractor and extractor.held:
+            await outbox.put([{'measurement': measurement, 'tag': args.tag, 'fields': fields, 'timestamp': timestamp}
+                              for measurement, fields, timestamp in extractor.flush()])
+
+def lines_arguments(parser):
+    parser.add_argument("--format", choices=["lp", "text"], default="lp",
+                        help="stdin holds line protocol, or text log lines for the convert stage (default: lp)")
+
+async def lines_source(args, inbox, outbox):
+    reader = StdinLines()
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    try:
+        loop.add_reader(reader.fd, ready.set)
+    except PermissionError:
+        # A regular file, always readable
+        ready = None
+    try:
+        while True:
+            if ready is not None:
+                await ready.wait()
+                ready.clear()
+            lines = reader.read(0)
+            if lines is None:
+                break
+            if args.format == "text":
+                records = [{'text': line, 'timestamp': None} for line in lines if line]
+            else:
+                records = [parsed for parsed in map(parse_line, lines) if parsed]
+            if records:
+                await outbox.put(records)
+            # Let the other stages run between blocks
+            await asyncio.sleep(0)
+    finally:
+        if ready is not None:
+            loop.remove_reader(reader.fd)
+
+# Transforms
+
+def convert_arguments(parser):
+    parser.add_argument("--result-header", required=True, help="The header used to split the text and extract results.")
+    parser.add_argument("--measurement", required=True, help="The measurement name for the records.")
+    parser.add_argument("--tag", help="Optional tag in the format key=value.")
+    parser.add_argument("--timezone", default="local",
+                        help="Time zone of log line timestamps: 'local', 'UTC' or a name like Europe/Helsinki (default: local)")
+
+async def convert_stage(args, inbox, outbox):
+    # Text records with the result header become records, like convert_to_influx.py; other records pass through
+    parse_timestamp = TimestampParser(make_timezone(args.timezone))
+    while (batch := await receive(inbox)) is not END:
+        converted = []
+        for record in batch:
+            text = record.get('text')
+            if text is None:
+                converted.append(record)
+                continue
+            if args.result_header not in text:
+                continue
+            time_str, data_str = text.split(args.result_header, 1)
+            timestamp = record['timestamp']
+            if timestamp is None:
+                # A log line, the time is in front of the result
+                try:
+                    timestamp = parse_timestamp(time_str.strip())
+                except ValueError:
+                    print(f"Invalid timestamp format: {time_str.strip()}", file=sys.stderr)
+                    continue
+            fields = parse_results(data_str)
+            if fields:
+                converted.append({'measurement': args.measurement, 'tag': args.tag, 'fields': fields, 'timestamp': timestamp})
+        if converted:
+            await outbox.put(converted)
+
+def summarize_arguments(parser):
+    summarizer.add_arguments(parser)
+
+async def summarize_stage(args, inbox, outbox):
+    windows = summarizer.make_summarizer(args)
+
+    def output(aggregates, records):
+        for level, measurement, tag, results, timestamp in aggregates:
+            fields = {field: float(value) for field, value in results.items() if value is not None}
+            if fields:
+                # Same precision as summarizer.py writes
+                records.append({'measurement': measurement, 'tag': tag, 'fields': fields, 'timestamp': timestamp, 'precision': 3})
+
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time() + windows.tick_interval
+    while (batch := await receive(inbox, max(0.0, next_tick - loop.time()))) is not END:
+        records = []
+        for record in batch:
+            if 'text' in record or record['timestamp'] is None:
+                continue
+            output(windows.add({**record, 'fields': summarizer.numeric_fields(record['fields'])}), records)
+        if loop.time() >= next_tick:
+            output(windows.tick(), records)
+            next_tick = loop.time() + windows.tick_interval
+        if records:
+            await outbox.put(records)
+
+    records = []
+    output(windows.flush(), records)
+    if records:
+        await outbox.put(records)
+    if windows.series.late:
+        print(f"{windows.series.late} records arrived after their window was closed", file=sys.stderr)
+
+def join_arguments(parser):
+    thermal_join.add_stream_arguments(parser)
+
+async def join_stage(args, inbox, outbox):
+    # Probe results wait in the joiner for the temperatures around them, everything else passes through
+    joiner = thermal_join.make_stream_join(args)
+    args.stats.watch("join_pending", lambda: len(joiner.pending))
+    while (batch := await receive(inbox, 0.5)) is not END:
+        records = []
+        for record in batch:
+            if 'text' in record:
+                records.append(record)
+            else:
+                records += joiner.add(record)
+        records += joiner.release()
+        if records:
+            await outbox.put(records)
+    records = joiner.flush()
+    if records:
+        await outbox.put(records)
+
+def compress_arguments(parser):
+    compress.add_arguments(parser)
+
+async def compress_stage(args, inbox, outbox):
+    compressor = compress.make_compressor(args)
+    args.stats.watch("compress_values_in", lambda: compressor.values_in)
+    args.stats.watch("compress_values_out", lambda: compressor.values_out)
+    while (batch := await receive(inbox, 1.0)) is not END:
+        records = []
+        for record in batch:
+            if 'text' in record:
+                records.append(record)
+            else:
+                records += compressor.add(record)
+        records += compressor.tick()
+        if records:
+            await outbox.put(records)
+    records = compressor.flush()
+    if records:
+        await outbox.put(records)
+
+# Sinks
+
+def format_record(record):
+    if 'text' in record:
+        timestamp = datetime.fromtimestamp(record['timestamp'] / 1e9) if record['timestamp'] else datetime.now()
+        return f"{timestamp.strftime('%Y-%m-%d %H:%M:%S')} {record['text']}"
+    return format_line(record['measurement'], record['tag'], record['fields'], record['timestamp'],
+                       precision=record.get('precision'))
+
+def print_arguments(parser):
+    pass
+
+async def print_sink(args, inbox, outbox):
+    # Line protocol (text records as log lines) on stdout, one write per batch
+    while (batch := await receive(inbox)) is not END:
+        sys.stdout.write("".join(format_record(record) + "\n" for record in batch))
+        sys.stdout.flush()
+
+def humanread_arguments(parser):
+    humanread.add_arguments(parser)
+
+async def humanread_sink(args, inbox, outbox):
+    # Scrolling rows, written once per batch, or with --live the latest rows of every series redrawn in place
+    view = humanread.LiveView(args.rows, args.refresh, args.max_series) if args.live else None
+    table = humanread.Table(args.format)
+    while (batch := await receive(inbox, view.timeout() if view else None)) is not END:
+        for record in batch:
+            if 'text' not in record and record['timestamp'] is not None:
+                if view:
+                    view.add(record)
+                else:
+                    table.show(humanread.format_entry(record, args.format))
+        if view:
+            view.draw()
+        else:
+            sys.stdout.flush()
+    if view:
+        view.draw(force=True)
+
+def influx_arguments(parser):
+    influx_write_by_line.add_arguments(parser)
+
+async def influx_sink(args, inbox, outbox):
+    writer = influx_write_by_line.make_writer(args)
+    writer.instrument(args.stats)
+
+    def add_lines(lines):
+        for line in lines:
+            writer.add(line)
+
+    try:
+        while (batch := await receive(inbox, writer.time_to_flush())) is not END:
+            lines = [format_record(record) for record in batch if 'text' not in record]
+            # Requests block, keep them off the event loop
+            if lines:
+                await asyncio.to_thread(add_lines, lines)
+            if writer.time_to_flush() == 0.0:
+                await asyncio.to_thread(writer.flush)
+    finally:
+        await asyncio.to_thread(writer.close)
+        print(writer.summary(), file=sys.stderr)
+
+def capture_arguments(parser):
+    parser.add_argument("path", help="Capture directory, appended to (see capture.py)")
+    parser.add_argument("--chunk-rows", type=int, default=1 << 16, help="Points per chunk file for a new capture (default: 65536)")
+
+async def capture_sink(args, inbox, outbox):
+    writer = capture.CaptureWriter(args.path, chunk_rows=args.chunk_rows)
+    try:
+        while (batch := await receive(inbox, writer.flush_interval)) is not END:
+            for record in batch:
+                if 'text' not in record and record['timestamp'] is not None:
+                    writer.add(record['measurement'], record['tag'], record['fields'], record['timestamp'])
+            if not batch and writer.buffered:
+                # Quiet for a while, write out what there is
+                writer.flush()
+    finally:
+        writer.close()
+
+# name: (kind, add_arguments, stage)
+STAGES = {
+    'temps': ('source', temps_arguments, temps_source),
+    'gcode': ('source', gcode_arguments, gcode_source),
+    'lines': ('source', lines_arguments, lines_source),
+    'convert': ('transform', convert_arguments, convert_stage),
+    'summarize': ('transform', summarize_arguments, summarize_stage),
+    'join': ('transform', join_arguments, join_stage),
+    'compress': ('transform', compress_arguments, compress_stage),
+    'print': ('sink', print_arguments, print_sink),
+    'humanread': ('sink', humanread_arguments, humanread_sink),
+    'influx': ('sink', influx_arguments, influx_sink),
+    'capture': ('sink', capture_arguments, capture_sink),
+}
+
+def split_stages(argv):
+    stages = [[]]
+    for arg in argv:
+        if arg == STAGE_SEPARATOR:
+            stages.append([])
+        else:
+            stages[-1].append(arg)
+    return stages
+
+def parse_arguments():
+    stage_help = ", ".join(f"{name} ({kind})" for name, (kind, _, _) in STAGES.items())
+    parser = argparse.ArgumentParser(
+        description="Run a source, transforms and a sink in one process. Stages are separated by '::', "
+                    "each takes the options of the script it comes from; use '<stage> --help' for them.",
+        epilog=f"Stages: {stage_help}")
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="Batches of records buffered between two stages before the earlier one waits (default: 64)")
+    metrics.add_arguments(parser)
+    parser.add_argument("stage", choices=STAGES, help="The source stage")
+    parser.add_argument("options", nargs=argparse.REMAINDER, help="Source options, then ':: <stage> [options]' ...")
+
+    stages = split_stages(sys.argv[1:])
+    args = parser.parse_args(stages[0])
+    stages[0] = [args.stage, *args.options]
+
+    pipeline = []
+    for position, stage_argv in enumerate(stages):
+        if not stage_argv or stage_argv[0] not in STAGES:
+            parser.error(f"unknown stage: {' '.join(stage_argv) or '(empty)'}")
+        name = stage_argv[0]
+        kind, add_arguments, stage = STAGES[name]
+        expected = "source" if position == 0 else "sink" if position == len(stages) - 1 else "transform"
+        if kind != expected:
+            parser.error(f"{name} is a {kind}, expected a {expected} at position {position + 1}")
+        stage_parser = argparse.ArgumentParser(prog=f"{parser.prog} ... {name}")
+        add_arguments(stage_parser)
+        stage_args = stage_parser.parse_args(stage_argv[1:])
+        if name == "summarize":
+            try:
+                summarizer.make_summarizer(stage_args)
+            except ValueError as e:
+                stage_parser.error(str(e))
+        if name == "humanread":
+            humanread.check_arguments(stage_parser, stage_args)
+        if name == "compress":
+            try:
+                compress.make_settings(stage_args.door, stage_args.deadband)
+            except ValueError as e:
+                stage_parser.error(str(e))
+        pipeline.append((name, stage, stage_args))
+    return args, pipeline
+
+async def run_stage(stage, args, inbox, outbox):
+    try:
+        await stage(args, inbox, outbox)
+    finally:
+        # Also when cancelled or failed, so the stages after it finish what they have
+        if outbox is not None:
+            await outbox.put(END)
+
+async def run_pipeline(pipeline, queue_size, stats=metrics.NO_METRICS):
+    queues = []
+    for name, _, _ in pipeline[:-1]:
+        queue = StageQueue(queue_size, stats, name)
+        stats.watch(f"{name}_queue", queue.qsize)
+        queues.append(queue)
+    inboxes = [None] + queues
+    outboxes = queues + [None]
+    tasks = []
+    for (name, stage, args), inbox, outbox in zip(pipeline, inboxes, outboxes):
+        args.stats = stats
+        tasks.append(asyncio.create_task(run_stage(stage, args, inbox, outbox)))
+
+    # Ctrl-C / SIGTERM stop the source; the rest drain, the summarizer flushes its windows, the writer its batch
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, tasks[0].cancel)
+
+    failed = False
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.cancelled() or task.exception() is None:
+                continue
+            print(f"Stage failed: {task.exception()!r}", file=sys.stderr)
+            failed = True
+            # The stages before it would wait forever on its full inbox: stop them. The ones after it
+            # got END and finish what they have.
+            index = tasks.index(task)
+            for queue in queues[:index]:
+                queue.closed = True
+            for upstream in tasks[:index]:
+                upstream.cancel()
+    return 1 if failed else 0
+
+def main():
+    args, pipeline = parse_arguments()
+    stats = metrics.setup(args, "pipeline")
+    sys.exit(asyncio.run(run_pipeline(pipeline, args.queue_size, stats)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# Z drift of PROBE_ACCURACY runs (see genprobeaccuracy.py), computed over whole captures at once with NumPy:
+# rolling mean and standard deviation over the loops, the linear drift rate per loop and per hour,
+# the jump across the G0 Z390 midpoint excursion and the results that stand out.
+#
+#   ./probe_drift.py ~/tmp/drift
+#   ./probe_drift.py ~/tmp/drift --report points --window 20 --format line | ./influx_write_by_line.py --bucket r3 --batch
+#   ./probe_drift.py probe.lp --fields average range --report outliers
+#
+# The input is a capture (capture.py) or a line protocol file of the probe results, from
+# gcode_response_spy.py --probe or convert_to_influx.py. Which results come after the midpoint is
+# taken from their after_midpoint field, else from the midpoint marker in <measurement>_marker,
+# else from --midpoint-loop. The results of a gcodeplan.py sweep carry their run number, and every
+# run is analysed on its own.
+import argparse
+import csv
+import sys
+import time
+
+import numpy as np
+
+from capture import load_series
+from lineprotocol import escape_key, format_line
+
+DEFAULT_FIELDS = ["average", "range", "standard_deviation"]
+SUMMARY_COLUMNS = ["count", "mean", "std", "min", "max", "drift_per_loop", "drift_per_hour", "r2",
+                   "before_count", "before_mean", "before_std", "after_count", "after_mean", "after_std",
+                   "midpoint_jump", "midpoint_t", "midpoint_step", "outliers"]
+NS_PER_HOUR = 3600 * 10**9
+
+def window_sums(x, window):
+    # Sum of the last `window` values at every position, by differences of the cumulative sum
+    sums = np.cumsum(x)
+    sums[window:] -= sums[:-window].copy()
+    return sums
+
+def rolling(values, window):
+    # Mean and standard deviation of the last `window` results at every result, NaNs left out.
+    # Centered first, so the sums of squares don't lose the micrometers.
+    valid = ~np.isnan(values)
+    if valid.all():
+        # Full windows after the first few
+        count = np.full(len(values), float(window))
+        count[:window] = np.arange(1, min(window, len(values)) + 1)
+        shift = values.mean()
+        centered = values - shift
+    elif valid.any():
+        count = window_sums(valid.astype(np.float64), window)
+        shift = values[valid].mean()
+        centered = np.where(valid, values - shift, 0.0)
+    else:
+        return np.full(len(values), np.nan), np.full(len(values), np.nan)
+    total = window_sums(centered, window)
+    squares = window_sums(np.square(centered, out=centered), window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.divide(total, count, out=total)
+        variance = np.subtract(squares, mean * mean * count, out=squares)
+        variance /= count - 1
+    np.maximum(variance, 0.0, out=variance)
+    variance[count < 2] = np.nan
+    mean += shift
+    mean[count == 0] = np.nan
+    return mean, np.sqrt(variance, out=variance)
+
+def drift_fit(x, y, segments):
+    # Least squares with one slope and an intercept per segment (slices before and after the midpoint),
+    # so the excursion's step doesn't count as drift: (slope, [intercept per segment], r squared)
+    has_nan = np.isnan(y).any()
+    sxx = sxy = 0.0
+    means = []
+    for segment in segments:
+        xs, ys = x[segment], y[segment]
+        if has_nan:
+            valid = ~np.isnan(ys)
+            xs, ys = xs[valid], ys[valid]
+        if not len(ys):
+            means.append((np.nan, np.nan))
+            continue
+        x_mean = xs.mean()
+        y_mean = ys.mean()
+        dx = xs - x_mean
+        sxx += dx @ dx
+        sxy += dx @ (ys - y_mean)
+        means.append((x_mean, y_mean))
+    if sxx == 0:
+        return np.nan, [np.nan] * len(segments), np.nan
+    slope = sxy / sxx
+    intercepts = [y_mean - slope * x_mean for x_mean, y_mean in means]
+    residuals = fit_residuals(x, y, slope, intercepts, segments)
+    total = y - (np.nanmean(y) if has_nan else y.mean())
+    if has_nan:
+        residuals = residuals[~np.isnan(residuals)]
+        total = total[~np.isnan(total)]
+    ss_total = total @ total
+    return slope, intercepts, 1.0 - (residuals @ residuals) / ss_total if ss_total else np.nan
+
+def fit_residuals(x, y, slope, intercepts, segments):
+    residuals = np.empty(len(y))
+    for segment, intercept in zip(segments, intercepts):
+        np.subtract(y[segment], slope * x[segment] + intercept, out=residuals[segment])
+    return residuals
+
+def describe(values):
+    # (count, mean, standard deviation) of the non-NaN values
+    if np.isnan(values).any():
+        values = values[~np.isnan(values)]
+    if not len(values):
+        return 0, np.nan, np.nan
+    return len(values), values.mean(), values.std(ddof=1) if len(values) > 1 else np.nan
+
+def compare_midpoint(values, segments):
+    # Before and after the midpoint excursion: the jump between their means (drift included) and Welch's t for it
+    before, after = segments
+    before_count, before_mean, before_std = describe(values[before])
+    after_count, after_mean, after_std = describe(values[after])
+    jump = after_mean - before_mean
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = jump / np.sqrt(before_std ** 2 / before_count + after_std ** 2 / after_count) if before_count and after_count else np.nan
+    return {'before_count': before_count, 'before_mean': before_mean, 'before_std': before_std,
+            'after_count': after_count, 'after_mean': after_mean, 'after_std': after_std,
+            'midpoint_jump': jump, 'midpoint_t': t}
+
+def robust_scores(residuals):
+    # Modified z-scores, 0.6745 * deviation / MAD, of the residuals from the drift fit:
+    # neither the drift nor the midpoint step makes the results on one side stand out
+    valid = residuals[~np.isnan(residuals)] if np.isnan(residuals).any() else residuals
+    if not len(valid):
+        return residuals
+    median = np.median(valid)
+    mad = np.median(np.abs(valid - median))
+    if mad == 0:
+        return np.where(np.isnan(residuals), np.nan, 0.0)
+    return (residuals - median) * (0.6745 / mad)
+
+def midpoint_mask(series, timestamps, columns, loops, markers, midpoint_loop):
+    # True for the results after the midpoint, None when it is unknown
+    if 'after_midpoint' in columns and not np.isnan(columns['after_midpoint']).all():
+        return columns['after_midpoint'] == 1.0
+    marker = markers.get(series['tag'])
+    if marker is not None:
+        return timestamps > marker
+    if midpoint_loop is not None:
+        return loops > midpoint_loop
+    return None
+
+def midpoint_markers(series_list):
+    # Time of the first midpoint marker per tag set
+    markers = {}
+    for series, timestamps, columns in series_list:
+        midpoint = columns.get('midpoint')
+        if midpoint is not None:
+            reached = timestamps[midpoint == 1.0]
+            if len(reached):
+                markers[series['tag']] = reached.min()
+    return markers
+
+def split_runs(series, timestamps, columns):
+    # One (series, timestamps, columns) per run of a sweep, with run=<n> added to the tag set; the
+    # results without a run stay under the series' own tag set
+    runs = columns.get('run')
+    if runs is None or np.isnan(runs).all():
+        return [(series, timestamps, columns)]
+    parts = []
+    missing = np.isnan(runs)
+    if missing.any():
+        parts.append((series, timestamps[missing], {field: values[missing] for field, values in columns.items()}))
+    for run in np.unique(runs[~missing]):
+        rows = runs == run
+        run_series = dict(series, tag=with_tag(series['tag'], "run", f"{run:g}"))
+        parts.append((run_series, timestamps[rows], {field: values[rows] for field, values in columns.items()}))
+    return parts
+
+def reorder(order, timestamps, columns):
+    return timestamps[order], {field: values[order] for field, values in columns.items()}
+
+def analyse(series, timestamps, columns, fields, window, threshold, markers, midpoint_loop):
+    # Summary per field, and the rolling statistics and scores per result, in time order
+    if len(timestamps) > 1 and (timestamps[1:] < timestamps[:-1]).any():
+        timestamps, columns = reorder(np.argsort(timestamps, kind="stable"), timestamps, columns)
+    if 'loop' in columns and not np.isnan(columns['loop']).any():
+        loops = columns['loop']
+    else:
+        loops = np.arange(1, len(timestamps) + 1, dtype=np.float64)
+    hours = (timestamps - timestamps[0]) / NS_PER_HOUR
+    after = midpoint_mask(series, timestamps, columns, loops, markers, midpoint_loop)
+    if after is None:
+        segments = [slice(None)]
+    else:
+        split = len(after) - int(after.sum())
+        if not after[split:].all():
+            # Results on both sides mixed up in time: the ones before the midpoint first
+            order = np.argsort(after, kind="stable")
+            timestamps, columns = reorder(order, timestamps, columns)
+            loops, hours = loops[order], hours[order]
+        segments = [slice(0, split), slice(split, None)]
+
+    summary = {}
+    points = {'timestamp': timestamps, 'loop': loops}
+    for field in fields:
+        values = columns[field]
+        count, mean, std = describe(values)
+        drift_per_loop, intercepts, r2 = drift_fit(loops, values, segments)
+        drift_per_hour, _, _ = drift_fit(hours, values, segments)
+        if np.isnan(drift_per_loop):
+            # Fewer than two results: against their mean
+            residuals = values - np.nanmean(values) if count else values
+        else:
+            residuals = fit_residuals(loops, values, drift_per_loop, intercepts, segments)
+        scores = robust_scores(residuals)
+        with np.errstate(invalid="ignore"):
+            outliers = np.abs(scores) > threshold
+        row = {'count': count, 'mean': mean, 'std': std,
+               'min': np.nanmin(values) if count else np.nan, 'max': np.nanmax(values) if count else np.nan,
+               'drift_per_loop': drift_per_loop, 'drift_per_hour': drift_per_hour, 'r2': r2,
+               'outliers': int(outliers.sum())}
+        if after is not None:
+            row.update(compare_midpoint(values, segments))
+            # The step at the excursion, with the drift before and after taken out
+            row['midpoint_step'] = intercepts[1] - intercepts[0]
+        summary[field] = row
+        points[field] = values
+        points[f"{field}_mean"], points[f"{field}_std"] = rolling(values, window)
+        points[f"{field}_z"] = scores
+        points[f"{field}_outlier"] = outliers
+    return summary, points
+
+def with_tag(tag, key, value):
+    return ",".join(part for part in (tag, f"{key}={escape_key(value)}") if part)
+
+def clean(value):
+    # Plain Python numbers, None for NaN
+    value = value.item() if isinstance(value, np.generic) else value
+    return None if isinstance(value, float) and value != value else value
+
+def write_summary(results, output_format, out):
+    if output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(["measurement", "tag", "field", *SUMMARY_COLUMNS])
+        for series, summary, points in results:
+            for field, row in summary.items():
+                writer.writerow([series['measurement'], series['tag'] or "", field,
+                                 *("" if clean(row.get(column, np.nan)) is None else clean(row[column]) for column in SUMMARY_COLUMNS)])
+        return
+    for series, summary, points in results:
+        for field, row in summary.items():
+            fields = {column: clean(row[column]) for column in SUMMARY_COLUMNS if column in row}
+            fields = {column: value for column, value in fields.items() if value is not None}
+            out.write(format_line(f"{series['measurement']}_drift", with_tag(series['tag'], "field", field), fields,
+                                  int(points['timestamp'][-1])) + "\n")
+
+def write_points(results, output_format, out, only_outliers=False):
+    header_written = False
+    for series, summary, points in results:
+        names = [name for name in points if name not in ('timestamp', 'loop')]
+        rows = np.ones(len(points['timestamp']), dtype=bool)
+        if only_outliers:
+            rows = np.logical_or.reduce([points[f"{field}_outlier"] for field in summary])
+        columns = [points['timestamp'][rows].tolist(), points['loop'][rows].tolist()]
+        columns += [points[name][rows].tolist() for name in names]
+        if output_format == "csv":
+            writer = csv.writer(out)
+            if not header_written:
+                # Same fields for every series, they all come from --fields
+                writer.writerow(["measurement", "tag", "timestamp", "loop", *names])
+                header_written = True
+            prefix = [series['measurement'], series['tag'] or ""]
+            writer.writerows([*prefix, timestamp, int(loop), *("" if value != value else value for value in values)]
+                             for timestamp, loop, *values in zip(*columns))
+            continue
+        measurement = f"{series['measurement']}_rolling"
+        for timestamp, loop, *values in zip(*columns):
+            fields = {'loop': int(loop)}
+            fields.update((name, value) for name, value in zip(names, values) if value == value)
+            out.write(format_line(measurement, series['tag'], fields, timestamp) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse the Z drift of PROBE_ACCURACY results.")
+    parser.add_argument("input", help="Capture directory or line protocol file ('-' for stdin)")
+    parser.add_argument("--measurement", default="probe", help="Measurement of the results (default: probe)")
+    parser.add_argument("--tag", help="Only the series with exactly this tag set, e.g. printer=vc4-400")
+    parser.add_argument("--fields", nargs='+', default=DEFAULT_FIELDS,
+                        help="Result fields to analyse (default: average range standard_deviation)")
+    parser.add_argument("--window", type=int, default=10, help="Results in the rolling mean and standard deviation (default: 10)")
+    parser.add_argument("--threshold", type=float, default=3.5,
+                        help="Modified z-score above which a result is an outlier (default: 3.5)")
+    parser.add_argument("--midpoint-loop", type=int,
+                        help="Last loop before the midpoint excursion, when the results carry no midpoint information")
+    parser.add_argument("--report", choices=["summary", "points", "outliers"], default="summary",
+                        help="A summary per series and field, the rolling statistics of every result, or only the outliers (default: summary)")
+    parser.add_argument("--format", choices=["csv", "line"], default="csv", help="Output format (default: csv)")
+    args = parser.parse_args()
+    if args.window < 1:
+        parser.error("--window must be at least 1")
+
+    start = time.perf_counter()
+    loaded = load_series(args.input)
+    markers = midpoint_markers(entry for entry in loaded if entry[0]['measurement'] == f"{args.measurement}_marker")
+    selected = [entry for entry in loaded
+                if entry[0]['measurement'] == args.measurement and (args.tag is None or entry[0]['tag'] == args.tag)]
+    loaded_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = []
+    count = 0
+    for series, timestamps, columns in (part for entry in selected for part in split_runs(*entry)):
+        fields = [field for field in args.fields if field in columns]
+        if not fields or not len(timestamps):
+            print(f"{series['measurement']},{series['tag']}: none of the fields {', '.join(args.fields)}", file=sys.stderr)
+            continue
+        summary, points = analyse(series, timestamps, columns, fields, args.window, args.threshold, markers, args.midpoint_loop)
+        results.append((series, summary, points))
+        count += len(timestamps)
+    if not results:
+        sys.exit(f"No {args.measurement} results in {args.input}")
+    print(f"Analysed {count} results of {len(results)} series in {time.perf_counter() - start:.3f} s "
+          f"(loading took {loaded_s:.3f} s)", file=sys.stderr)
+
+    try:
+        if args.report == "summary":
+            write_summary(results, args.format, sys.stdout)
+        else:
+            write_points(results, args.format, sys.stdout, only_outliers=args.report == "outliers")
+    except BrokenPipeError:
+        pass
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Writes the points of a capture (see capture.py) as line protocol, in time order across all series,
+# at the pace they were recorded, faster, or as fast as possible:
+#
+#   ./replay.py ~/tmp/drift --speed 0 | ./summarizer.py --interval 60 | ./humanread.py
+#   ./replay.py ~/tmp/drift --speed 10 --rebase | ./influx_write_by_line.py --bucket r3 --batch
+import argparse
+import heapq
+import sys
+import time
+from datetime import datetime
+
+from capture import FLOAT, CaptureReader, restore
+from lineprotocol import format_line
+
+def parse_time(value):
+    # Nanoseconds, or a local date and time like "2024-10-16 12:00:00"
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp()) * 1_000_000_000
+
+def series_points(reader, series, start, end):
+    # (timestamp, measurement, tag, fields) of one series, NaN fields left out, integers and booleans as they were
+    fields = list(zip(series['fields'], series.get('types') or [FLOAT] * len(series['fields'])))
+    for timestamp, values in reader.rows(series):
+        if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+            continue
+        point = {field: restore(value, kind) for (field, kind), value in zip(fields, values) if value == value}
+        if point:
+            yield timestamp, series['measurement'], series['tag'], point
+
+def replay(reader, series, out, speed=1.0, start=None, end=None, rebase=False):
+    points = heapq.merge(*(series_points(reader, s, start, end) for s in series), key=lambda point: point[0])
+    first = None
+    started = time.monotonic()
+    shift = 0
+    for timestamp, measurement, tag, fields in points:
+        if first is None:
+            first = timestamp
+            if rebase:
+                # Move the capture to now, e.g. to write it into a bucket with a short retention
+                shift = time.time_ns() - first
+        if speed:
+            delay = started + (timestamp - first) / 1e9 / speed - time.monotonic()
+            if delay > 0:
+                out.flush()
+                time.sleep(delay)
+        out.write(format_line(measurement, tag, fields, timestamp + shift) + "\n")
+    out.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a capture as line protocol.")
+    parser.add_argument("path", help="Capture directory")
+    parser.add_argument("--measurement", help="Only the series of this measurement")
+    parser.add_argument("--tag", help="Only the series with exactly this tag set, e.g. printer=vc4")
+    parser.add_argument("--start", help="Skip points before this time (ns or 'YYYY-MM-DD HH:MM:SS' local time)")
+    parser.add_argument("--end", help="Stop at this time (ns or 'YYYY-MM-DD HH:MM:SS' local time)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Pace relative to the recording, 60 for a minute per second, 0 for as fast as possible (default: 1)")
+    parser.add_argument("--rebase", action="store_true", help="Shift the timestamps so that the first point is now")
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.path)
+    series = reader.find(args.measurement, args.tag)
+    if not series:
+        parser.error("no series match")
+    try:
+        replay(reader, series, sys.stdout, speed=args.speed, start=parse_time(args.start) if args.start else None,
+               end=parse_time(args.end) if args.end else None, rebase=args.rebase)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
@@ -0,0 +1,193 @@
+import os
+import random
+import re
+import sys
+import threading
+
+SEGMENT_RE = re.compile(r"^(\d{12})\.lp$")
+ACK_FILE = "ack"
+
+class Spool:
+    # Durable, segmented, append-only queue of line protocol lines.
+    # Lines are appended to numbered segment files; the read position of the oldest
+    # unacknowledged line is kept in the "ack" file so a restart resumes where the last
+    # successful write left off. Fully acknowledged segments are deleted.
+    def __init__(self, directory, *, segment_bytes=8 << 20, max_bytes=512 << 20, drop_policy="oldest", fsync=False):
+        if drop_policy not in ("oldest", "newest"):
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.drop_policy = drop_policy
+        self.fsync = fsync
+        self.dropped_bytes = 0
+        self.condition = threading.Condition()
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, f"{seq:012d}.lp")
+
+    def list_segments(self):
+        return sorted(int(m.group(1)) for m in map(SEGMENT_RE.match, os.listdir(self.directory)) if m)
+
+    def recover(self):
+        # Restore the acknowledged position, throw away what was already delivered
+        # and cut off a half-written line left behind by a crash
+        head_seq, head_offset = 0, 0
+        try:
+            with open(os.path.join(self.directory, ACK_FILE)) as f:
+                head_seq, head_offset = map(int, f.read().split())
+        except (OSError, ValueError):
+            pass
+
+        segments = self.list_segments()
+        for seq in segments:
+            if seq < head_seq:
+                os.remove(self.segment_path(seq))
+        segments = [seq for seq in segments if seq >= head_seq]
+
+        if not segments:
+            segments = [max(head_seq, 1)]
+            open(self.segment_path(segments[0]), "ab").close()
+            head_offset = 0
+        if segments[0] != head_seq:
+            head_seq, head_offset = segments[0], 0
+
+        last_path = self.segment_path(segments[-1])
+        with open(last_path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+        self.head_seq = head_seq
+        self.head_offset = head_offset
+        self.active_seq = segments[-1]
+        self.active = open(last_path, "ab")
+        self.segment_sizes = {seq: os.path.getsize(self.segment_path(seq)) for seq in segments}
+        self.total_bytes = sum(self.segment_sizes.values()) - head_offset
+
+    def has_backlog(self):
+        return self.total_bytes > 0
+
+    def roll(self):
+        self.active.close()
+        self.active_seq += 1
+        self.active = open(self.segment_path(self.active_seq), "ab")
+        self.segment_sizes[self.active_seq] = 0
+
+    def drop_head_segment(self):
+        if self.head_seq == self.active_seq:
+            self.roll()
+        self.dropped_bytes += self.segment_sizes[self.head_seq] - self.head_offset
+        self.total_bytes -= self.segment_sizes.pop(self.head_seq) - self.head_offset
+        os.remove(self.segment_path(self.head_seq))
+        self.head_seq, self.head_offset = self.head_seq + 1, 0
+        self.write_ack()
+
+    def append(self, lines):
+        # Returns False when the lines had to be dropped to keep within max_bytes
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        with self.condition:
+            if self.total_bytes + len(data) > self.max_bytes:
+                if self.drop_policy == "newest" or len(data) > self.max_bytes:
+                    self.dropped_bytes += len(data)
+                    print(f"Spool full, dropped {len(lines)} new lines", file=sys.stderr)
+                    return False
+                while self.total_bytes + len(data) > self.max_bytes:
+                    self.drop_head_segment()
+                print(f"Spool full, dropped oldest data ({self.dropped_bytes} bytes so far)", file=sys.stderr)
+
+            if self.segment_sizes[self.active_seq] and self.segment_sizes[self.active_seq] + len(data) > self.segment_bytes:
+                self.roll()
+            self.active.write(data)
+            self.active.flush()
+            if self.fsync:
+                os.fsync(self.active.fileno())
+            self.segment_sizes[self.active_seq] += len(data)
+            self.total_bytes += len(data)
+            self.condition.notify_all()
+        return True
+
+    def peek(self, max_points, max_bytes):
+        # Read the oldest unacknowledged lines, returns (lines, position to acknowledge them with)
+        with self.condition:
+            while self.head_seq != self.active_seq and self.head_offset >= self.segment_sizes[self.head_seq]:
+                self.drop_head_segment()
+            seq, offset = self.head_seq, self.head_offset
+
+            lines = []
+            size = 0
+            with open(self.segment_path(seq), "rb") as f:
+                f.seek(offset)
+                while len(lines) < max_points and size < max_bytes and offset + size < self.segment_sizes[seq]:
+                    line = f.readline()
+                    if not line:
+                        break
+                    size += len(line)
+                    line = line.decode("utf-8", errors="replace").strip()
+                    if line:
+                        lines.append(line)
+            return lines, (seq, offset + size)
+
+    def ack(self, position):
+        seq, offset = position
+        with self.condition:
+            # Ignore positions in segments that were dropped meanwhile
+            if seq != self.head_seq or offset <= self.head_offset:
+                return
+            self.total_bytes -= offset - self.head_offset
+            self.head_offset = offset
+            if seq != self.active_seq and offset >= self.segment_sizes[seq]:
+                self.drop_head_segment()
+            else:
+                self.write_ack()
+
+    def write_ack(self):
+        # Atomic replace, so a crash leaves either the old or the new position
+        path = os.path.join(self.directory, ACK_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{self.head_seq} {self.head_offset}\n")
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def wait(self, timeout):
+        with self.condition:
+            if not self.has_backlog():
+                self.condition.wait(timeout)
+
+    def close(self):
+        with self.condition:
+            self.active.close()
+            self.condition.notify_all()
+
+def drain(spool, send, *, max_points=5000, max_bytes=1 << 20):
+    # Send spooled lines until the spool is empty or a write fails, returns True when empty
+    while spool.has_backlog():
+        lines, position = spool.peek(max_points, max_bytes)
+        if lines and not send(lines):
+            return False
+        spool.ack(position)
+    return True
+
+def start_drainer(spool, send, stop, *, max_points=5000, max_bytes=1 << 20, min_backoff=1.0, max_backoff=60.0):
+    # Background thread that keeps draining the spool, backing off exponentially
+    # (with jitter) while the server is unreachable
+    def run():
+        backoff = min_backoff
+        while not stop.is_set():
+            spool.wait(timeout=1.0)
+            if stop.is_set():
+                break
+            if drain(spool, send, max_points=max_points, max_bytes=max_bytes):
+                backoff = min_backoff
+            else:
+                stop.wait(backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, max_backoff)
+
+    thread = threading.Thread(target=run, name="spool-drainer", daemon=True)
+    thread.start()
+    return thread
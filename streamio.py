@@ -0,0 +1,28 @@
+import os
+import select
+import sys
+
+class StdinLines:
+    # Reads stdin in large blocks and hands out complete lines, with a timeout,
+    # so time-driven work (flushing a batch, closing a window) still happens when the input is idle
+    def __init__(self, stream=None, block_size=1 << 16):
+        self.fd = (stream or sys.stdin).fileno()
+        self.block_size = block_size
+        self.pending = b""
+        self.eof = False
+
+    def read(self, timeout=None):
+        # Returns a list of lines (possibly empty on timeout), or None at end of input
+        if self.eof:
+            return None
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        block = os.read(self.fd, self.block_size)
+        if not block:
+            self.eof = True
+            rest = self.pending.decode("utf-8", errors="replace").strip()
+            self.pending = b""
+            return [rest] if rest else None
+        *lines, self.pending = (self.pending + block).split(b"\n")
+        return [line.decode("utf-8", errors="replace").strip() for line in lines]
@@ -1,109 +1,451 @@
 #!/usr/bin/env python3
 import sys
-import re
+import time
 import argparse
-from datetime import datetime
+from collections import OrderedDict
+
+import metrics
+from lineprotocol import format_line, parse_line
+from streamio import StdinLines
+
+def numeric_fields(fields):
+    # Store the values as floats for averaging, ignore non-numeric fields
+    if all(type(value) is float for value in fields.values()):
+        return fields
+    return {key: float(value) for key, value in fields.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)}
 
 def parse_line_protocol(line):
-    # Example line format: measurement,tag key1=value1,key2=value2 timestamp
-    pattern = r'(?P<measurement>[\w_]+)(?:,(?P<tag>[\w=]+))? (?P<fields>.+) (?P<timestamp>\d+)$'
-    match = re.match(pattern, line)
-    
-    if not match:
+    parsed_data = parse_line(line)
+    if parsed_data is None or parsed_data['timestamp'] is None:
         return None
 
-    # Parse components
-    measurement = match.group('measurement')
-    tag = match.group('tag')
-    timestamp = int(match.group('timestamp'))
-    fields = match.group('fields')
-    field_data = {}
-    
-    for field in fields.split(','):
-        key, value = field.split('=')
-        try:
-            # Store the value as a float for averaging
-            field_data[key] = float(value)
-        except ValueError:
-            continue  # Ignore non-numeric fields
-
-    return {
-        'measurement': measurement,
-        'tag': tag,
-        'fields': field_data,
-        'timestamp': timestamp
-    }
-
-def time_weighted_average(values, start_time, interval_ns):
-    # Calculate time-weighted averages for each field
-    weighted_sums = {}
-    weighted_times = {}
-    current_time = start_time
-    total_duration = interval_ns
-
-    for i in range(1, len(values)):
-        field_data = values[i-1]['fields']
-        time_diff = values[i]['timestamp'] - values[i-1]['timestamp']
-        
+    parsed_data['fields'] = numeric_fields(parsed_data['fields'])
+    parsed_data['line'] = line
+    return parsed_data
+
+class FieldStats:
+    # Constant-size running state of one field within one window
+    __slots__ = ("weighted_sum", "duration", "min", "max", "last", "count", "mean", "m2")
+
+    def __init__(self):
+        self.weighted_sum = 0.0
+        self.duration = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add_sample(self, value):
+        self.last = value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+        # Welford's online variance
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def carry(self, value):
+        # A value from an earlier window still in effect at the start of this one
+        self.last = value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+
+    def add_duration(self, value, duration):
+        # The value was in effect for this many nanoseconds
+        self.weighted_sum += value * duration
+        self.duration += duration
+
+    def merge(self, other):
+        # Combine with the state of an adjacent, later window (Chan et al. for the variance)
+        self.weighted_sum += other.weighted_sum
+        self.duration += other.duration
+        if other.min is not None:
+            self.min = other.min if self.min is None or other.min < self.min else self.min
+            self.max = other.max if self.max is None or other.max > self.max else self.max
+        if other.last is not None:
+            self.last = other.last
+        if other.count:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.mean += delta * other.count / count
+            self.count = count
+
+    def result(self, stat):
+        if stat == "mean":
+            # Time-weighted average, falls back to the last value for a window without duration
+            return self.weighted_sum / self.duration if self.duration else self.last
+        if stat == "stddev":
+            return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+        if stat == "variance":
+            return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+        if stat == "sample_mean":
+            return self.mean
+        if stat == "sum":
+            # Time-weighted sum in value-seconds
+            return self.weighted_sum / 1e9
+        if stat == "duration":
+            return self.duration / 1e9
+        return getattr(self, stat)
+
+STATS = ["mean", "min", "max", "last", "count", "stddev", "variance", "sample_mean", "sum", "duration"]
+
+class WindowAggregate:
+    # Incremental time-weighted aggregation of one window: every line costs O(fields),
+    # whatever the sample rate or the window length.
+    # Each value holds from its line's timestamp until the next line arrives; the values
+    # of the previous window's last line hold from the start of this window.
+    def __init__(self, start_time, interval_ns, carry_fields=None):
+        self.start_time = start_time
+        self.end_time = start_time + interval_ns
+        self.fields = {}
+        self.prev_fields = carry_fields or {}
+        self.prev_time = start_time
+        for field, value in self.prev_fields.items():
+            stats = self.fields[field] = FieldStats()
+            stats.carry(value)
+
+    def carry_to(self, timestamp):
+        # Weight the previous line's values up to timestamp, clipped to the end of the window
+        duration = min(timestamp, self.end_time) - self.prev_time
+        if duration > 0:
+            for field, value in self.prev_fields.items():
+                self.fields[field].add_duration(value, duration)
+        self.prev_time = max(self.prev_time, min(timestamp, self.end_time))
+
+    def add(self, timestamp, field_data):
+        # A line older than the previous one only counts as a sample, it doesn't rewrite history
+        in_order = timestamp >= self.prev_time
+        if in_order:
+            self.carry_to(timestamp)
         for field, value in field_data.items():
-            weighted_sums[field] = weighted_sums.get(field, 0) + value * time_diff
-            weighted_times[field] = weighted_times.get(field, 0) + time_diff
+            stats = self.fields.get(field)
+            if stats is None:
+                stats = self.fields[field] = FieldStats()
+            stats.add_sample(value)
+        if in_order:
+            self.prev_fields = field_data
+
+    def finish(self):
+        # Handle the final segment up to the end of the interval
+        self.carry_to(self.end_time)
+
+    def results(self, stats):
+        return field_results(self.fields, stats)
+
+def field_results(fields, stats):
+    results = {}
+    for field, field_stats in fields.items():
+        for stat in stats:
+            key = field if len(stats) == 1 else f"{field}_{stat}"
+            results[key] = field_stats.result(stat)
+    return results
+
+class RollupWindow:
+    # A coarser window made of the finished windows of the tier below
+    def __init__(self, start_time, interval_ns):
+        self.start_time = start_time
+        self.end_time = start_time + interval_ns
+        self.fields = {}
+
+    def merge(self, window):
+        for field, other in window.fields.items():
+            stats = self.fields.get(field)
+            if stats is None:
+                stats = self.fields[field] = FieldStats()
+            stats.merge(other)
+
+    def results(self, stats):
+        return field_results(self.fields, stats)
+
+class Rollups:
+    # Coarser tiers computed by merging the finished windows of the tier below, never from the raw
+    # lines. Every interval must be a multiple of the one below it.
+    def __init__(self, intervals_ns):
+        # Per tier: the open window and the end of the last closed one of every series
+        self.tiers = [(interval_ns, {}, {}) for interval_ns in intervals_ns]
+        self.late = 0
+
+    def add(self, measurement, tag, window):
+        # Feed a finished window of the finest tier, returns the (tier, measurement, tag, window)
+        # of the coarser windows that closed
+        closed = []
+        self.feed(0, (measurement, tag), window, closed)
+        return closed
+
+    def feed(self, level, key, window, closed):
+        if level == len(self.tiers):
+            return
+        interval_ns, open_windows, closed_until = self.tiers[level]
+        if window.start_time < closed_until.get(key, window.start_time):
+            # Its coarser window was already written out, don't open it again
+            self.late += 1
+            return
+        start_time = window.start_time - window.start_time % interval_ns
+        current = open_windows.get(key)
+        if current is not None and current.start_time != start_time:
+            self.close(level, key, closed)
+            current = None
+        if current is None:
+            current = open_windows[key] = RollupWindow(start_time, interval_ns)
+        current.merge(window)
+
+    def close(self, level, key, closed):
+        window = self.tiers[level][1].pop(key)
+        self.tiers[level][2][key] = window.end_time
+        closed.append((level + 1, *key, window))
+        self.feed(level + 1, key, window, closed)
+
+    def advance(self, watermarks):
+        # Close the windows the watermark of their series has passed, all of a series that was forgotten.
+        # Lower tiers first, so a window closing there can complete the one above in the same pass.
+        closed = []
+        for level, (interval_ns, open_windows, closed_until) in enumerate(self.tiers):
+            for key in [key for key, window in open_windows.items() if window.end_time <= watermarks.get(key, window.end_time)]:
+                self.close(level, key, closed)
+            for key in [key for key in closed_until if key not in watermarks and key not in open_windows]:
+                del closed_until[key]
+        return closed
+
+    def flush(self):
+        closed = []
+        for level, (interval_ns, open_windows, closed_until) in enumerate(self.tiers):
+            for key in list(open_windows):
+                self.close(level, key, closed)
+        return closed
 
-        current_time = values[i]['timestamp']
+class Watermark:
+    # Event time up to which all data is assumed to have arrived: the newest timestamp seen,
+    # moved on by the wall-clock time passed since, minus the allowed lateness.
+    # Advancing with the wall clock closes windows even when the stream stalls.
+    def __init__(self, lateness_ns=0):
+        self.lateness_ns = lateness_ns
+        self.latest = None
+        self.seen_at = None
 
-    # Handle the final segment up to the end of the interval
-    last_data = values[-1]['fields']
-    last_duration = total_duration - (current_time - start_time)
-    
-    for field, value in last_data.items():
-        weighted_sums[field] = weighted_sums.get(field, 0) + value * last_duration
-        weighted_times[field] = weighted_times.get(field, 0) + last_duration
+    def observe(self, timestamp):
+        if self.latest is None or timestamp > self.latest:
+            self.latest = timestamp
+            self.seen_at = time.monotonic_ns()
 
-    # Compute the average
-    averages = {}
-    for field, total_weighted_sum in weighted_sums.items():
-        averages[field] = total_weighted_sum / weighted_times[field] if weighted_times[field] else 0
+    def current(self):
+        if self.latest is None:
+            return None
+        return self.latest + (time.monotonic_ns() - self.seen_at) - self.lateness_ns
 
-    return averages
+class Series:
+    __slots__ = ("window", "carry_fields", "closed_until", "last_seen", "watermark")
+
+    def __init__(self, lateness_ns=0):
+        self.window = None
+        self.carry_fields = None
+        self.closed_until = None  # end of the last closed window, anything older is late
+        self.last_seen = None
+        # Its own, so a printer whose clock or stream lags another isn't late because of it
+        self.watermark = Watermark(lateness_ns)
+
+class SeriesWindows:
+    # One window per series, (measurement, tag set), so interleaved printers or measurements
+    # are aggregated separately. Windows are aligned to the epoch grid of interval_ns and close
+    # when the series moves past them or its watermark does. Series that stay silent for
+    # idle_ns are flushed and forgotten.
+    def __init__(self, interval_ns, idle_ns=None, lateness_ns=0, on_late=None):
+        self.interval_ns = interval_ns
+        self.idle_ns = idle_ns
+        self.lateness_ns = lateness_ns
+        self.on_late = on_late
+        self.late = 0
+        self.series = OrderedDict()  # least recently seen series first
+
+    def close_window(self, key, state):
+        window = state.window
+        state.carry_fields = window.prev_fields
+        state.closed_until = window.end_time
+        state.window = None
+        window.finish()
+        return (*key, window)
+
+    def add(self, parsed_data):
+        # Returns the (measurement, tag, window) of the windows that closed
+        closed = []
+        timestamp = parsed_data['timestamp']
+        key = (parsed_data['measurement'], parsed_data['tag'])
+        state = self.series.pop(key, None) or Series(self.lateness_ns)
+        self.series[key] = state
+
+        if state.closed_until is not None and timestamp < state.closed_until:
+            # Its window was already written out
+            self.late += 1
+            if self.on_late:
+                self.on_late(parsed_data)
+            return closed
+
+        # The series moved past its window, close it
+        if state.window is not None and timestamp >= state.window.end_time:
+            closed.append(self.close_window(key, state))
+
+        if state.window is None:
+            start_time = timestamp - timestamp % self.interval_ns
+            # Carry the last values into the next window only if it directly follows
+            carry = state.carry_fields if state.closed_until == start_time else None
+            state.window = WindowAggregate(start_time, self.interval_ns, carry)
+        state.window.add(timestamp, parsed_data['fields'])
+        state.last_seen = timestamp if state.last_seen is None else max(state.last_seen, timestamp)
+        state.watermark.observe(timestamp)
+        return closed
+
+    def watermarks(self):
+        # The current watermark of every series
+        return {key: state.watermark.current() for key, state in self.series.items()}
+
+    def advance(self, watermarks):
+        # Close every window the watermark of its series has passed and forget idle series
+        closed = []
+        for key, state in list(self.series.items()):
+            watermark = watermarks.get(key)
+            if watermark is None:
+                continue
+            if state.window is not None and state.window.end_time <= watermark:
+                closed.append(self.close_window(key, state))
+            if self.idle_ns and state.window is None and watermark - state.last_seen >= self.idle_ns:
+                del self.series[key]
+        return closed
+
+    def flush(self):
+        # End of input: close everything
+        closed = []
+        for key, state in self.series.items():
+            if state.window is not None:
+                closed.append(self.close_window(key, state))
+        return closed
 
 def format_line_protocol(measurement, tag, averages, timestamp):
-    # Format the output in the same line protocol format as the input
-    tag_part = f",{tag}" if tag else ""
-    field_part = ",".join([f"{field}={value:.3f}".rstrip('0').rstrip('.') for field, value in averages.items()])
-    return f"{measurement}{tag_part} {field_part} {timestamp}"
+    # Format the output in the same line protocol format as the input, all values as floats
+    fields = {field: float(value) for field, value in averages.items() if value is not None}
+    return format_line(measurement, tag, fields, timestamp, precision=3)
+
+class Summarizer:
+    # The windows of the finest interval and the rollups of the coarser ones as one unit.
+    # Aggregates come out as (level, measurement, tag, results, timestamp), level being the index
+    # of the interval, stamped with the end of their window.
+    def __init__(self, intervals, stats, idle_timeout=300, lateness=2.0, tier_suffix="_{interval}s", on_late=None):
+        self.intervals = sorted(intervals)
+        if any(coarse % fine for fine, coarse in zip(self.intervals, self.intervals[1:])):
+            raise ValueError("every interval must be a multiple of the one before it")
+        self.stats = stats
+        self.suffixes = [""] + [tier_suffix.format(interval=interval) for interval in self.intervals[1:]]
+        interval_ns = self.intervals[0] * 1_000_000_000  # Convert interval to nanoseconds
+        self.series = SeriesWindows(interval_ns, idle_ns=idle_timeout * 1_000_000_000,
+                                    lateness_ns=int(lateness * 1e9), on_late=on_late)
+        self.rollups = Rollups([interval * 1_000_000_000 for interval in self.intervals[1:]])
+        # Check the watermark a few times per interval, so output lags by at most interval + lateness
+        self.tick_interval = min(1.0, self.intervals[0] / 4)
+
+    def collect(self, closed, rolled_up=()):
+        aggregates = []
+        for measurement, tag, window in closed:
+            aggregates.append((0, measurement, tag, window.results(self.stats), window.end_time))
+            rolled_up = [*rolled_up, *self.rollups.add(measurement, tag, window)]
+        for level, measurement, tag, window in rolled_up:
+            aggregates.append((level, measurement + self.suffixes[level], tag, window.results(self.stats), window.end_time))
+        return aggregates
+
+    def add(self, parsed_data):
+        return self.collect(self.series.add(parsed_data))
+
+    def tick(self):
+        watermarks = self.series.watermarks()
+        closed = self.collect(self.series.advance(watermarks))
+        # Series forgotten just now are missing from the rollups' watermarks, their windows close too
+        watermarks = {key: watermarks[key] for key in self.series.series}
+        return closed + self.collect([], self.rollups.advance(watermarks))
+
+    def flush(self):
+        return self.collect(self.series.flush()) + self.collect([], self.rollups.flush())
+
+def add_arguments(parser):
+    parser.add_argument("--interval", type=int, nargs='+', default=[10],
+                        help="Averaging time period in seconds (default: 10). With several, e.g. 10 60 600, the coarser "
+                             "ones are rolled up from the finer ones; each must be a multiple of the one before.")
+    parser.add_argument("--stat", nargs='+', choices=STATS, default=["mean"],
+                        help="Statistics to output per field (default: the time-weighted mean). "
+                             "With more than one, output fields are named <field>_<stat>.")
+    parser.add_argument("--idle-timeout", type=int, default=300,
+                        help="Forget a series after this many seconds without data, 0 to keep all (default: 300)")
+    parser.add_argument("--lateness", type=float, default=2.0,
+                        help="Seconds to wait for late lines before a window is closed (default: 2)")
+    parser.add_argument("--late-output", help="File to append lines that arrive after their window was closed (default: drop them)")
+    parser.add_argument("--tier-suffix", default="_{interval}s",
+                        help="Appended to the measurement of every interval but the first, {interval} is the interval in seconds (default: _{interval}s)")
+
+def make_summarizer(args):
+    late_file = open(args.late_output, "a", buffering=1) if args.late_output else None
+
+    def write_late(parsed_data):
+        line = parsed_data.get('line') or format_line(parsed_data['measurement'], parsed_data['tag'],
+                                                      parsed_data['fields'], parsed_data['timestamp'])
+        late_file.write(line + "\n")
+
+    return Summarizer(args.interval, args.stat, idle_timeout=args.idle_timeout, lateness=args.lateness,
+                      tier_suffix=args.tier_suffix, on_late=write_late if late_file else None)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate time-weighted averages from InfluxDB line protocol input.")
-    parser.add_argument("--interval", type=int, default=10, help="Averaging time period in seconds (default: 10)")
+    add_arguments(parser)
+    parser.add_argument("--output", nargs='+',
+                        help="One output file per interval, '-' for stdout (default: everything to stdout)")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
-    
-    interval_ns = args.interval * 1e9  # Convert interval to nanoseconds
-    current_values = []
-    start_time = None
-
-    for line in sys.stdin:
-        line = line.strip()
-        parsed_data = parse_line_protocol(line)
-        
-        if parsed_data:
-            # Initialize start time
-            if start_time is None:
-                start_time = parsed_data['timestamp']
-            
-            # Collect values until the interval is reached
-            current_values.append(parsed_data)
-
-            # Calculate and display averages when interval is reached
-            if parsed_data['timestamp'] - start_time >= interval_ns:
-                averages = time_weighted_average(current_values, start_time, interval_ns)
-                output_line = format_line_protocol(
-                    parsed_data['measurement'],
-                    parsed_data['tag'],
-                    averages,
-                    parsed_data['timestamp']
-                )
-                print(output_line, flush=True)
-                
-                # Reset for the next interval
-                current_values = [parsed_data]
-                start_time = parsed_data['timestamp']
\ No newline at end of file
+    stats = metrics.setup(args, "summarizer")
+
+    try:
+        summarizer = make_summarizer(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.output and len(args.output) != len(args.interval):
+        parser.error("--output needs one file per --interval")
+    outputs = [sys.stdout if path == "-" else open(path, "a") for path in args.output] if args.output else [sys.stdout] * len(args.interval)
+
+    stats.watch("late", lambda: summarizer.series.late)
+    stats.watch("late_rollups", lambda: summarizer.rollups.late)
+    stats.watch("series", lambda: len(summarizer.series.series))
+
+    def emit(aggregates):
+        stats.count("lines_out", len(aggregates))
+        for level, measurement, tag, results, timestamp in aggregates:
+            outputs[level].write(format_line_protocol(measurement, tag, results, timestamp) + "\n")
+        if aggregates:
+            for output in set(outputs):
+                output.flush()
+
+    next_tick = time.monotonic() + summarizer.tick_interval
+    reader = StdinLines()
+    while True:
+        lines = reader.read(max(0.0, next_tick - time.monotonic()))
+        if lines is None:
+            break
+        start = time.perf_counter()
+        skipped = 0
+        for line in lines:
+            parsed_data = parse_line_protocol(line)
+            if parsed_data:
+                emit(summarizer.add(parsed_data))
+            else:
+                skipped += 1
+        # Per block of input, parsing and windowing together
+        stats.observe("parse", time.perf_counter() - start)
+        stats.count("lines_in", len(lines))
+        stats.count("skipped", skipped)
+        if time.monotonic() >= next_tick:
+            emit(summarizer.tick())
+            next_tick = time.monotonic() + summarizer.tick_interval
+
+    emit(summarizer.flush())
+    if summarizer.series.late:
+        print(f"{summarizer.series.late} lines arrived after their window was closed", file=sys.stderr)
+    if summarizer.rollups.late:
+        print(f"{summarizer.rollups.late} windows arrived after their coarser window was closed", file=sys.stderr)
@@ -2,74 +2,165 @@
 import asyncio
 import websockets
 import json
+import signal
+import time
 import argparse
 from datetime import datetime
 
-async def listen_temperatures(host="localhost", objects=None, measurement="temperature", tag=None, output_format="line"):
-    uri = f"ws://{host}/websocket"  # Moonraker WebSocket URL
-    
+import capture
+import metrics
+from lineprotocol import format_line
+
+def build_subscription(objects, request_id=1):
     # Build the subscription message with specified objects
     subscription_params = {obj: ["temperature", "target", "power"] for obj in objects}
-    subscription_message = {
+    return {
         "jsonrpc": "2.0",
         "method": "printer.objects.subscribe",
         "params": {
             "objects": subscription_params
         },
-        "id": 1
+        "id": request_id
     }
 
+def temperature_fields(objects, status_data):
+    fields = {}
+    for obj in objects:
+        obj_data = status_data.get(obj, {})
+        temp = obj_data.get("temperature")
+        target = obj_data.get("target", 0.0)
+        pwm = obj_data.get("power", 0.0)
+
+        if temp is not None:
+            # Always floats, so InfluxDB doesn't see an integer field one day and a float the next
+            fields[f"{obj}_temp"] = float(temp)
+            fields[f"{obj}_target"] = float(target)
+            fields[f"{obj}_pwm"] = float(pwm)
+    return fields
+
+def format_temperature_line(measurement, tag, objects, status_data, timestamp, capture=None):
+    # Append object data in InfluxDB line protocol format, with the measurement name and optional tag
+    fields = temperature_fields(objects, status_data)
+    if not fields:
+        return None
+    if capture:
+        capture.add(measurement, tag, fields, timestamp)
+    return format_line(measurement, tag, fields, timestamp)
+
+class StatusCache:
+    # Moonraker only sends the fields that changed, so keep the last known full state
+    # of every subscribed object and merge each delta into it
+    def __init__(self, objects):
+        self.state = {obj: {} for obj in objects}
+        self.changed = False
+
+    def update(self, status_data):
+        for obj, fields in status_data.items():
+            current = self.state.get(obj)
+            if current is None or not isinstance(fields, dict):
+                continue
+            for key, value in fields.items():
+                if current.get(key) != value:
+                    current[key] = value
+                    self.changed = True
+
+class EmitPolicy:
+    # Decides when the cached state is written out: on every update (default), only when it changed,
+    # at a fixed sample rate, or at a fixed rate but only if something changed since the last sample
+    def __init__(self, rate=None, on_change=False):
+        self.interval = 1.0 / rate if rate else None
+        self.on_change = on_change
+        self.next_tick = time.monotonic() + self.interval if self.interval else None
+
+    def timeout(self):
+        # How long to wait for the next message before a sample is due
+        if self.interval is None:
+            return None
+        return max(0.0, self.next_tick - time.monotonic())
+
+    def should_emit(self, cache, updated):
+        if self.interval is None:
+            return updated and (cache.changed or not self.on_change)
+        now = time.monotonic()
+        if now < self.next_tick:
+            return False
+        self.next_tick += self.interval
+        if self.next_tick <= now:
+            self.next_tick = now + self.interval
+        return cache.changed or not self.on_change
+
+async def receive(websocket, timeout):
+    # Next message, or None when the timeout expires first
+    try:
+        return await asyncio.wait_for(websocket.recv(), timeout)
+    except asyncio.TimeoutError:
+        return None
+
+async def sample_status(host, objects, rate=None, on_change=False, stats=metrics.NO_METRICS):
+    # Yields the merged state of the objects ({obj: {"temperature": ..., ...}}) whenever the
+    # emit policy says so. The dict is reused, copy what you keep.
+    uri = f"ws://{host}/websocket"  # Moonraker WebSocket URL
+    
+    subscription_message = build_subscription(objects)
+
     async with websockets.connect(uri) as websocket:
         await websocket.send(json.dumps(subscription_message))
 
+        cache = StatusCache(objects)
+        policy = EmitPolicy(rate=rate, on_change=on_change)
+
         # Continuously listen for temperature and PWM updates
         while True:
-            response = await websocket.recv()
-            data = json.loads(response)
-
-            # Process only 'notify_status_update' messages
-            if data.get("method") == "notify_status_update":
-                status_data = data["params"][0] if isinstance(data["params"][0], dict) else {}
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S") if output_format == "csv" else int(datetime.now().timestamp() * 1e9)
-                
-                # Prepare data for the selected format
-                if output_format == "line":
-                    # Start with the measurement name and optional tag
-                    line_parts = [f"{measurement}"]
-                    if tag:
-                        line_parts[0] += f",{tag}"
-                    
-                    # Append object data in InfluxDB line protocol format
-                    field_parts = []
-                    for obj in objects:
-                        obj_data = status_data.get(obj, {})
-                        temp = obj_data.get("temperature")
-                        target = obj_data.get("target", 0.0)
-                        pwm = obj_data.get("power", 0.0)
-                        
-                        if temp is not None:
-                            field_parts.append(f"{obj}_temp={temp},{obj}_target={target},{obj}_pwm={pwm}")
-                    
-                    if field_parts:
-                        line = " ".join([",".join(line_parts), ",".join(field_parts), str(timestamp)])
-                        print(line, flush=True)
-                    else:
-                        print("Warning: Temperature data is incomplete.", flush=True)
-                
-                elif output_format == "csv":
-                    # Build CSV format header for timestamp and fields
-                    csv_parts = [timestamp]
-                    for obj in objects:
-                        obj_data = status_data.get(obj, {})
-                        temp = obj_data.get("temperature", "")
-                        target = obj_data.get("target", "")
-                        pwm = obj_data.get("power", "")
-                        
-                        csv_parts.extend([temp, target, pwm])
-                    
-                    # Convert list to CSV line and print
-                    csv_line = ",".join(map(str, csv_parts))
-                    print(csv_line, flush=True)
+            response = await receive(websocket, policy.timeout())
+            updated = False
+            if response is not None:
+                stats.count("messages_in")
+                start = time.perf_counter()
+                data = json.loads(response)
+
+                # Merge 'notify_status_update' deltas, the subscribe reply seeds the cache with the full state
+                if data.get("method") == "notify_status_update":
+                    status_data = data["params"][0] if isinstance(data["params"][0], dict) else {}
+                    cache.update(status_data)
+                    updated = True
+                elif data.get("id") == subscription_message["id"] and "result" in data:
+                    cache.update(data["result"].get("status", {}))
+                    updated = True
+                stats.observe("parse", time.perf_counter() - start)
+
+            if not policy.should_emit(cache, updated):
+                continue
+            cache.changed = False
+            yield cache.state
+
+async def listen_temperatures(host="localhost", objects=None, measurement="temperature", tag=None, output_format="line", rate=None, on_change=False,
+                              stats=metrics.NO_METRICS, capture=None):
+    async for status_data in sample_status(host, objects, rate=rate, on_change=on_change, stats=stats):
+        stats.count("lines_out")
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S") if output_format == "csv" else int(datetime.now().timestamp() * 1e9)
+
+        # Prepare data for the selected format
+        if output_format == "line":
+            line = format_temperature_line(measurement, tag, objects, status_data, timestamp, capture)
+            if line:
+                print(line, flush=True)
+            else:
+                print("Warning: Temperature data is incomplete.", flush=True)
+
+        elif output_format == "csv":
+            # Build CSV format header for timestamp and fields
+            csv_parts = [timestamp]
+            for obj in objects:
+                obj_data = status_data.get(obj, {})
+                temp = obj_data.get("temperature", "")
+                target = obj_data.get("target", "")
+                pwm = obj_data.get("power", "")
+
+                csv_parts.extend([temp, target, pwm])
+
+            # Convert list to CSV line and print
+            csv_line = ",".join(map(str, csv_parts))
+            print(csv_line, flush=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Listen for temperature and PWM data from Moonraker.")
@@ -78,9 +169,25 @@ if __name__ == "__main__":
     parser.add_argument("--measurement", required=True, help="The measurement name to use in the InfluxDB line protocol.")
     parser.add_argument("--tag", help="Optional tag in the format key=value to add to the InfluxDB line protocol.")
     parser.add_argument("--format", choices=["csv", "line"], default="line", help="Output format: 'csv' or 'line' protocol (default: 'line').")
+    parser.add_argument("--rate", type=float, help="Write the current state this many times per second instead of on every update.")
+    parser.add_argument("--on-change", action="store_true", help="Only write when a value changed (combined with --rate: changed since the last sample).")
+    capture.add_arguments(parser)
+    metrics.add_arguments(parser)
     
     # Parse arguments
     args = parser.parse_args()
+    stats = metrics.setup(args, "templogger")
+    writer = capture.CaptureWriter(args.capture) if args.capture else None
+    if writer:
+        # Stopped like Ctrl-C, so the buffered points get written
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     # Run the WebSocket listener
-    asyncio.run(listen_temperatures(host=args.host, objects=args.obj, measurement=args.measurement, tag=args.tag, output_format=args.format))
\ No newline at end of file
+    try:
+        asyncio.run(listen_temperatures(host=args.host, objects=args.obj, measurement=args.measurement, tag=args.tag, output_format=args.format, rate=args.rate, on_change=args.on_change,
+                                        stats=stats, capture=writer))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer:
+            writer.close()
\ No newline at end of file
@@ -0,0 +1,42 @@
+import os
+
+from capture import FLOAT, INTEGER, CaptureReader, CaptureWriter, restore
+
+def points(path):
+    # [(timestamp, {field: value})] of the only series, as replay.py restores them
+    reader = CaptureReader(path)
+    [series] = reader.series
+    return [(timestamp, {field: restore(value, kind)
+                         for field, kind, value in zip(series['fields'], series['types'], values) if value == value})
+            for timestamp, values in reader.rows(series)]
+
+def test_reopening_cuts_a_point_written_in_part(tmp_path):
+    path = str(tmp_path)
+    writer = CaptureWriter(path, chunk_rows=4)
+    for i in range(6):
+        writer.add("probe", "printer=vc4", {"z": i * 0.5, "loop": i}, i)
+    writer.close()
+    # A crash in the middle of the next write
+    with open(os.path.join(path, "s0", "000001.ts"), "ab") as f:
+        f.write(b"\x07\x00\x00")
+    with open(os.path.join(path, "s0", "000001.0.f64"), "ab") as f:
+        f.write(b"\x00\x00\x00\x00\x00")
+
+    writer = CaptureWriter(path, chunk_rows=4)
+    for i in range(6, 9):
+        writer.add("probe", "printer=vc4", {"z": i * 0.5, "loop": i}, i)
+    writer.close()
+    assert points(path) == [(i, {"z": i * 0.5, "loop": i}) for i in range(9)]
+
+def test_integer_field_written_as_float_later(tmp_path):
+    path = str(tmp_path)
+    writer = CaptureWriter(path)
+    writer.add("temps", None, {"temp": 200, "target": 210}, 1)
+    writer.close()
+    assert CaptureReader(path).series[0]['types'] == [INTEGER, INTEGER]
+
+    writer = CaptureWriter(path)
+    writer.add("temps", None, {"temp": 200.5, "target": 210}, 2)
+    writer.close()
+    assert CaptureReader(path).series[0]['types'] == [FLOAT, INTEGER]
+    assert points(path) == [(1, {"temp": 200.0, "target": 210}), (2, {"temp": 200.5, "target": 210})]
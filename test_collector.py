@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+import websockets
+
+from collector import SUBSCRIBE_ID, collect_host
+
+def status(temperature):
+    return {"extruder": {"temperature": temperature, "target": 210.0, "power": 0.5}}
+
+async def printer(websocket):
+    # Junk between good updates
+    await websocket.recv()
+    await websocket.send(json.dumps({"id": SUBSCRIBE_ID, "result": {"status": status(200.0)}}))
+    await websocket.send("not json {")
+    await websocket.send(json.dumps({"method": "notify_status_update", "params": []}))
+    await websocket.send(json.dumps({"method": "notify_status_update"}))
+    await websocket.send(json.dumps(["a", "list"]))
+    await websocket.send(json.dumps({"id": SUBSCRIBE_ID, "result": {"status": ["not", "a", "dict"]}}))
+    await websocket.send(json.dumps({"method": "notify_status_update", "params": [status(201.5), 0]}))
+    await websocket.wait_closed()
+
+async def collect_until(capsys, text):
+    # Runs the collector against the printer until `text` is written; returns (stdout, stderr)
+    out = err = ""
+    async with websockets.serve(printer, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        task = asyncio.create_task(collect_host(f"127.0.0.1:{port}", ["extruder"], "farm"))
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            captured = capsys.readouterr()
+            out += captured.out
+            err += captured.err
+            if text in out or task.done():
+                break
+        assert not task.done(), task.exception()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    return out, err
+
+def test_bad_frames_are_skipped(capsys):
+    out, err = asyncio.run(collect_until(capsys, "extruder_temp=201.5"))
+    lines = out.splitlines()
+    assert len(lines) == 2
+    assert "extruder_temp=200.0" in lines[0]
+    assert "extruder_temp=201.5" in lines[1]
+    assert lines[1].startswith("farm,host=127.0.0.1:")
+    assert err.count("skipped a bad message") == 5
+    assert "connection lost" not in err
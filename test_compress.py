@@ -0,0 +1,79 @@
+import bisect
+import random
+
+from compress import Compressor, make_settings
+
+S = 10**9
+TOLERANCES = {"extruder_temp": 0.1, "extruder_pwm": 0.02}
+MAX_GAP = 60
+
+def soak(seed=3, samples=20000):
+    # A heater at 4 samples per second: set point changes with overshoot, noise, PWM jumping between
+    # levels, ten flat minutes and a 150 s pause in the stream
+    rng = random.Random(seed)
+    points = []
+    temp, speed, target, pwm = 25.0, 0.0, 210.0, 0.5
+    for i in range(samples):
+        t = i * S // 4
+        if 4000 * S <= t < 4150 * S:
+            continue
+        if i % 4000 == 0:
+            target = rng.choice([150.0, 210.0, 240.0])
+        if i % 120 == 0:
+            pwm = rng.choice([0.0, 0.3, 0.55, 1.0])
+        if 3000 * S <= t < 3600 * S:
+            fields = {"extruder_temp": 205.0, "extruder_pwm": 0.4}
+        else:
+            # Underdamped, so it overshoots the set point
+            speed += 0.004 * (target - temp) - 0.05 * speed
+            temp += speed
+            fields = {"extruder_temp": temp + rng.gauss(0, 0.02), "extruder_pwm": pwm + rng.uniform(-0.01, 0.01)}
+        points.append((t, fields))
+    return points
+
+def compress(points):
+    compressor = Compressor(make_settings(["*_temp=0.1"], ["*_pwm=0.02"]), max_gap=MAX_GAP)
+    records = []
+    for t, fields in points:
+        records += compressor.add({'measurement': "ratos2", 'tag': None, 'fields': dict(fields), 'timestamp': t})
+    records += compressor.flush()
+    kept = {field: [] for field in TOLERANCES}
+    for record in records:
+        for field, value in record['fields'].items():
+            kept[field].append((record['timestamp'], value))
+    return records, kept
+
+def linear(kept, t):
+    # Swinging door: straight lines between the kept samples
+    i = bisect.bisect_left(kept, (t,))
+    if kept[i][0] == t:
+        return kept[i][1]
+    (t0, v0), (t1, v1) = kept[i - 1], kept[i]
+    return v0 + (v1 - v0) * (t - t0) / (t1 - t0)
+
+def step(kept, t):
+    # Deadband: the last kept value holds until the next one
+    return kept[bisect.bisect_right(kept, (t, float("inf"))) - 1][1]
+
+def test_rebuilt_series_stay_within_the_tolerances():
+    # Across the whole soak, the points kept for --max-gap included
+    points = soak()
+    records, kept = compress(points)
+    timestamps = [record['timestamp'] for record in records]
+    assert timestamps == sorted(timestamps) and len(set(timestamps)) == len(timestamps)
+    for field, rebuild in (("extruder_temp", linear), ("extruder_pwm", step)):
+        # Both ends kept, and far fewer samples than came in
+        assert kept[field][0][0] == points[0][0] and kept[field][-1][0] == points[-1][0]
+        assert len(kept[field]) < len(points) / 4
+        worst = max(abs(rebuild(kept[field], t) - fields[field]) for t, fields in points)
+        assert worst <= TOLERANCES[field] + 1e-9, field
+
+def test_quiet_fields_get_a_point_every_max_gap():
+    points = soak()
+    records, kept = compress(points)
+    for field, samples in kept.items():
+        gaps = [(t0, t1) for (t0, _), (t1, _) in zip(samples, samples[1:]) if t1 - t0 > MAX_GAP * S]
+        # Only across the pause, where no sample came in at all; the first one after it is kept
+        assert len(gaps) == 1 and 4000 * S - MAX_GAP * S < gaps[0][0] < 4000 * S and gaps[0][1] == 4150 * S, field
+        flat = [t for t, _ in samples if 3000 * S < t < 3600 * S]
+        assert 600 // MAX_GAP - 1 <= len(flat) <= 600 // MAX_GAP + 2, field
@@ -0,0 +1,61 @@
+import requests
+
+from influx_write_by_line import InfluxWriter
+from spool import Spool
+
+class Response:
+    def __init__(self, status_code, text=""):
+        self.status_code = status_code
+        self.text = text
+
+def make_writer(responses, **options):
+    # A writer whose requests get the given responses (or raise them) in turn; records what it posted
+    writer = InfluxWriter("http://influx", "token", "org", "bucket", **options)
+    writer.posted = []
+
+    def post(lines):
+        writer.posted.append(list(lines))
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+    writer.post = post
+    return writer
+
+LINES = [f"temps,host=a temp={i} {i}" for i in range(5)]
+
+def test_partial_write_is_accepted():
+    writer = make_writer([Response(422, '{"code":"unprocessable entity","message":"partial write: '
+                                        'points beyond retention policy dropped=2"}')])
+    writer.lines = list(LINES)
+    assert writer.flush()
+    assert writer.posted == [LINES]
+    assert (writer.written, writer.rejected, writer.failed) == (3, 2, 0)
+
+def test_single_line_too_large_or_dropped_is_rejected():
+    for status in (400, 413, 422):
+        writer = make_writer([Response(status, '{"message":"no"}')], max_points=1)
+        writer.add(LINES[0])
+        assert writer.posted == [LINES[:1]]
+        assert (writer.written, writer.rejected, writer.failed) == (0, 1, 0)
+
+def test_spooled_lines_fail_once(tmp_path):
+    writer = make_writer([requests.ConnectionError("down")])
+    writer.use_spool(Spool(str(tmp_path)))
+    writer.lines = list(LINES)
+    assert writer.flush()
+    # The drainer and the last attempt at close fail again
+    writer.close()
+    assert len(writer.posted) >= 2
+    assert (writer.written, writer.failed, writer.spooled) == (0, 5, 5)
+
+def test_partial_write_does_not_block_the_spool(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(LINES[:2])
+    spool.append(LINES[2:])
+    writer = make_writer([Response(422, "partial write: points beyond retention policy dropped=1"), Response(204)])
+    writer.use_spool(spool, max_points=2)
+    writer.close()
+    assert writer.posted == [LINES[:2], LINES[2:4], LINES[4:]]
+    assert (writer.written, writer.rejected) == (4, 1)
+    assert not Spool(str(tmp_path)).has_backlog()
@@ -0,0 +1,25 @@
+import math
+
+import numpy as np
+
+from lineprotocol import format_line, parse_line, parse_lines
+
+def test_non_finite_fields_are_not_written():
+    line = format_line("probe", "printer=vc4", {"range": float("nan"), "max": float("inf"), "min": -math.inf,
+                                                "mean": np.float64("nan"), "loop": 3}, 1)
+    assert line == "probe,printer=vc4 loop=3i 1"
+    line = format_line("temps", None, {"temp": float("nan"), "pwm": 0.5}, 1, precision=3)
+    assert line == "temps pwm=0.5 1"
+
+def test_non_finite_values_do_not_parse():
+    for value in ["nan", "NaN", "inf", "-inf", "Infinity"]:
+        assert parse_line(f"probe range={value} 1") is None
+        assert parse_line(f'probe range={value},text="a b" 1') is None
+    assert parse_lines("probe range=nan 1\nprobe range=0.5 2\n") == [
+        {'measurement': 'probe', 'tag': None, 'fields': {'range': 0.5}, 'timestamp': 2}]
+
+def test_newlines_in_strings_are_escaped():
+    message = 'Loop count: 3\n"done" \\ ok'
+    line = format_line("probe_marker", None, {"message": message}, 1)
+    assert "\n" not in line
+    assert parse_line(line)['fields']['message'] == message
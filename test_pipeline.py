@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+
+import pytest
+
+from pipeline import END, receive, run_pipeline
+
+def record(i):
+    return {'measurement': 'm', 'tag': None, 'fields': {'v': float(i)}, 'timestamp': i}
+
+async def endless_source(args, inbox, outbox):
+    i = 0
+    while True:
+        await outbox.put([record(i)])
+        i += 1
+
+async def pass_through(args, inbox, outbox):
+    while (batch := await receive(inbox)) is not END:
+        await outbox.put(batch)
+
+def failing_sink(after):
+    async def sink(args, inbox, outbox):
+        batches = 0
+        while (batch := await receive(inbox)) is not END:
+            batches += 1
+            if batches == after:
+                raise RuntimeError("sink failed")
+    return sink
+
+def collecting_sink(received):
+    async def sink(args, inbox, outbox):
+        while (batch := await receive(inbox)) is not END:
+            received.extend(batch)
+    return sink
+
+def failing_transform(after):
+    async def transform(args, inbox, outbox):
+        batches = 0
+        while (batch := await receive(inbox)) is not END:
+            batches += 1
+            if batches == after:
+                raise RuntimeError("transform failed")
+            await outbox.put(batch)
+    return transform
+
+def run(stages):
+    pipeline = [(f"stage{i}", stage, argparse.Namespace()) for i, stage in enumerate(stages)]
+    return asyncio.run(asyncio.wait_for(run_pipeline(pipeline, queue_size=4), timeout=5))
+
+@pytest.mark.parametrize("stages", [
+    [endless_source, failing_sink(10)],
+    [endless_source, pass_through, pass_through, failing_sink(10)],
+])
+def test_failing_sink_stops_the_pipeline(stages, capsys):
+    assert run(stages) == 1
+    assert "Stage failed: RuntimeError('sink failed')" in capsys.readouterr().err
+
+def test_stages_after_a_failure_finish(capsys):
+    received = []
+    assert run([endless_source, failing_transform(10), collecting_sink(received)]) == 1
+    assert [r['timestamp'] for r in received] == list(range(9))
+    assert "transform failed" in capsys.readouterr().err
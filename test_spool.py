@@ -0,0 +1,78 @@
+import threading
+import time
+
+from spool import Spool, drain, start_drainer
+
+def lines(start, count):
+    return [f"temps,host=a temp={i} {i}" for i in range(start, start + count)]
+
+def test_restart_resumes_after_the_acknowledged_lines(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=200)
+    spool.append(lines(0, 10))
+    spool.append(lines(10, 10))
+    sent, position = spool.peek(max_points=7, max_bytes=1 << 20)
+    assert sent == lines(0, 7)
+    spool.ack(position)
+    # Crash before the rest was acknowledged, and a half-written line at the end
+    spool.close()
+    with open(spool.segment_path(spool.active_seq), "ab") as f:
+        f.write(b"temps,host=a te")
+
+    spool = Spool(str(tmp_path), segment_bytes=200)
+    delivered = []
+    assert drain(spool, lambda batch: delivered.extend(batch) or True, max_points=3)
+    assert delivered == lines(7, 13)
+    assert not spool.has_backlog()
+    spool.close()
+    assert not Spool(str(tmp_path)).has_backlog()
+
+def test_full_spool_drops_the_oldest_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100, max_bytes=400)
+    for start in range(0, 100, 4):
+        spool.append(lines(start, 4))
+    assert spool.total_bytes <= 400
+    assert spool.dropped_bytes > 0
+    delivered = []
+    drain(spool, lambda batch: delivered.extend(batch) or True)
+    # Whole segments went, the newest lines stayed, in order
+    assert delivered == lines(100 - len(delivered), len(delivered))
+    assert 0 < len(delivered) < 100
+
+def test_full_spool_can_drop_the_newest_instead(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100, max_bytes=400, drop_policy="newest")
+    accepted = [spool.append(lines(start, 4)) for start in range(0, 100, 4)]
+    assert accepted[0] and not accepted[-1]
+    delivered = []
+    drain(spool, lambda batch: delivered.extend(batch) or True)
+    assert delivered == lines(0, len(delivered))
+
+def test_drainer_delivers_once_the_outage_ends(tmp_path):
+    spool = Spool(str(tmp_path))
+    delivered = []
+    attempts = []
+    outage_over = threading.Event()
+
+    def send(batch):
+        attempts.append(len(batch))
+        if not outage_over.is_set():
+            return False
+        delivered.extend(batch)
+        return True
+
+    stop = threading.Event()
+    drainer = start_drainer(spool, send, stop, max_points=5, min_backoff=0.01, max_backoff=0.05)
+    spool.append(lines(0, 12))
+    deadline = time.monotonic() + 5
+    while len(attempts) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(attempts) >= 3 and not delivered
+    assert spool.has_backlog()
+
+    outage_over.set()
+    spool.append(lines(12, 3))
+    while spool.has_backlog() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stop.set()
+    drainer.join()
+    assert delivered == lines(0, 15)
+    assert not spool.has_backlog()
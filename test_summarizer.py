@@ -0,0 +1,110 @@
+import math
+import random
+import statistics
+
+import pytest
+
+from summarizer import STATS, Summarizer
+
+S = 10**9
+# On the grid of both intervals
+T0 = 1_700_000_010 * S
+
+def sample_points(seed=5, windows=9):
+    # A few samples in every 10 s window, at odd times, of two fields
+    rng = random.Random(seed)
+    points = []
+    for window in range(windows):
+        for offset in sorted(rng.uniform(0, 10) for _ in range(rng.randint(2, 5))):
+            points.append((T0 + int((window * 10 + offset) * S), {"temp": rng.uniform(20, 220), "pwm": rng.random()}))
+    return points
+
+def brute_force(points, field, start, end):
+    # The statistics of one window computed directly: each value holds until the next sample, and the
+    # last one before the window holds from its start
+    before = [fields[field] for timestamp, fields in points if timestamp < start]
+    inside = [(timestamp, fields[field]) for timestamp, fields in points if start <= timestamp < end]
+    carried = before[-1] if before else None
+    time, value = (start, carried) if before else inside[0]
+    weighted = duration = 0.0
+    for timestamp, sample in inside:
+        if value is not None:
+            weighted += value * (timestamp - time)
+            duration += timestamp - time
+        time, value = timestamp, sample
+    weighted += value * (end - time)
+    duration += end - time
+    samples = [sample for _, sample in inside]
+    extremes = samples + ([carried] if before else [])
+    variance = statistics.variance(samples) if len(samples) > 1 else 0.0
+    return {'mean': weighted / duration, 'min': min(extremes), 'max': max(extremes), 'last': samples[-1],
+            'count': len(samples), 'stddev': math.sqrt(variance), 'variance': variance,
+            'sample_mean': statistics.fmean(samples), 'sum': weighted / 1e9, 'duration': duration / 1e9}
+
+def summarize(points, intervals):
+    summarizer = Summarizer(intervals, STATS, lateness=0)
+    aggregates = []
+    for timestamp, fields in points:
+        aggregates += summarizer.add({'measurement': "temps", 'tag': "host=a", 'fields': dict(fields), 'timestamp': timestamp})
+    return aggregates + summarizer.flush()
+
+def test_windows_and_rollups_match_brute_force():
+    points = sample_points()
+    aggregates = summarize(points, [10, 30])
+    for level, interval, measurement in ((0, 10, "temps"), (1, 30, "temps_30s")):
+        windows = [(timestamp, results) for lvl, name, tag, results, timestamp in aggregates if lvl == level]
+        assert all(name == measurement for lvl, name, _, _, _ in aggregates if lvl == level)
+        # Aligned to the epoch, stamped with their end
+        assert [timestamp for timestamp, _ in windows] == [T0 + (k + 1) * interval * S for k in range(90 // interval)]
+        for end, results in windows:
+            for field in ("temp", "pwm"):
+                expected = brute_force(points, field, end - interval * S, end)
+                assert {stat: results[f"{field}_{stat}"] for stat in STATS} == pytest.approx(expected), (level, end, field)
+
+def test_windows_do_not_depend_on_how_the_input_is_split():
+    # The same stream summarized at 30 s directly and rolled up from 10 s windows
+    points = sample_points(seed=11)
+    direct = [(timestamp, results) for _, _, _, results, timestamp in summarize(points, [30])]
+    rolled = [(timestamp, results) for level, _, _, results, timestamp in summarize(points, [10, 30]) if level == 1]
+    assert [timestamp for timestamp, _ in direct] == [timestamp for timestamp, _ in rolled]
+    for (_, expected), (_, results) in zip(direct, rolled):
+        assert results == pytest.approx(expected)
+
+def test_a_lagging_series_keeps_its_own_windows():
+    # Two printers on one stream, b's lines 40 s behind a's; the watermark is checked after every line
+    late = []
+    summarizer = Summarizer([10, 30], ["count"], lateness=2.0, on_late=late.append)
+    aggregates = []
+
+    def add(tag, timestamp):
+        aggregates.extend(summarizer.add({'measurement': "temps", 'tag': tag, 'fields': {"temp": 200.0},
+                                          'timestamp': timestamp}))
+        aggregates.extend(summarizer.tick())
+
+    for second in range(120):
+        add("host=a", T0 + second * S)
+        if second >= 40:
+            add("host=b", T0 + (second - 40) * S)
+    assert summarizer.series.late == 0 and summarizer.rollups.late == 0
+    before_flush = len(aggregates)
+
+    # Too late for a, whose window was written, but not for b, whose window is still open
+    add("host=a", T0 + 75 * S)
+    add("host=b", T0 + 75 * S + S // 2)
+    assert [point['tag'] for point in late] == ["host=a"]
+    aggregates += summarizer.flush()
+
+    written = [(level, tag, timestamp) for level, _, tag, _, timestamp in aggregates]
+    assert len(written) == len(set(written))
+    counts = {(level, tag, timestamp): results["temp"] for level, _, tag, results, timestamp in aggregates}
+    for tag, seconds in (("host=a", 120), ("host=b", 80)):
+        for level, interval in ((0, 10), (1, 30)):
+            ends = [timestamp for lvl, t, timestamp in counts if lvl == level and t == tag]
+            assert ends == [T0 + (k + 1) * interval * S for k in range(math.ceil(seconds / interval))]
+            for end in ends:
+                # Every window whole: one line per second, and b's extra line at 75.5 s
+                start, stop = (end - T0) // S - interval, min((end - T0) // S, seconds)
+                expected = stop - start + (tag == "host=b" and start <= 75 < stop)
+                assert counts[(level, tag, end)] == expected, (tag, level, end)
+    # The windows a's watermark passed were written as it went, only its last ones at the end
+    assert {timestamp for _, _, tag, _, timestamp in aggregates[before_flush:] if tag == "host=a"} == {T0 + 120 * S}
@@ -0,0 +1,55 @@
+import math
+
+import pytest
+
+from capture import load_series
+from lineprotocol import format_line, parse_line
+from thermal_join import AGE_FIELD, StreamJoin, merge_series
+
+FIELDS = ["extruder_temp", "heater_bed_temp"]
+S = 10**9
+
+def farm_stream(lag):
+    # Two printers on one stream: a temperature every second and a result half a second after it.
+    # Printer b's lines arrive `lag` seconds after printer a's.
+    lines = []
+    for second in range(100, 200):
+        for host, offset, delay in (("a", 0.0, 0), ("b", 50.0, lag)):
+            t = second - delay
+            temps = {"extruder_temp": 200.0 + offset + t * 0.1, "heater_bed_temp": 60.0 + offset - t * 0.01}
+            lines.append(format_line("farm", f"host={host}", temps, t * S))
+            if t % 3 == 0:
+                lines.append(format_line("probe", f"printer={host}", {"average": 0.01 * t}, t * S + S // 2))
+    return lines
+
+def stream_join(lines, interpolated):
+    joiner = StreamJoin("probe", "farm", fields=FIELDS, tolerance=10.0, interpolated=interpolated, lateness=2.0)
+    records = []
+    for line in lines:
+        records += joiner.add(parse_line(line))
+    records += joiner.flush()
+    return {(r['tag'], r['timestamp']): {name: r['fields'].get(name) for name in [*FIELDS, AGE_FIELD]}
+            for r in records if r['measurement'] == "probe"}
+
+def merge_join(lines, tmp_path, interpolated):
+    path = tmp_path / "farm.lp"
+    path.write_text("".join(line + "\n" for line in lines))
+    joined = merge_series(load_series(str(path), "probe"), load_series(str(path), "farm"), FIELDS, 10.0, interpolated)
+    return {(series['tag'], int(timestamp)): {name: None if math.isnan(columns[name][i]) else float(columns[name][i])
+                                              for name in [*FIELDS, AGE_FIELD]}
+            for series, timestamps, columns in joined for i, timestamp in enumerate(timestamps)}
+
+@pytest.mark.parametrize("interpolated", [False, True])
+def test_stream_and_merge_agree_with_a_lagging_printer(tmp_path, interpolated):
+    lines = farm_stream(lag=30)
+    streamed = stream_join(lines, interpolated)
+    merged = merge_join(lines, tmp_path, interpolated)
+    assert streamed.keys() == merged.keys()
+    assert {tag for tag, _ in streamed} == {"printer=a", "printer=b"}
+    for key, fields in merged.items():
+        assert streamed[key] == pytest.approx(fields), key
+    # Every result has a temperature of its own printer
+    for (tag, timestamp), fields in streamed.items():
+        offset = 50.0 if tag == "printer=b" else 0.0
+        expected = 200.0 + offset + (timestamp / S - (0 if interpolated else 0.5)) * 0.1
+        assert fields["extruder_temp"] == pytest.approx(expected)
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# Attaches the thermal state to every probe result: the most recent (or interpolated) temperature
+# and PWM values from templogger.py/collector.py, within a tolerance, as extra fields of the result.
+#
+# Live, on one stream carrying both (each printer's temperatures and probe results interleaved):
+#   (./templogger.py --host ratos2.local --obj extruder heater_bed --measurement ratos2 &
+#    ./gcode_response_spy.py --host ratos2.local --probe) | ./thermal_join.py stream --temperature-measurement ratos2 | ...
+#
+# Afterwards, on captures or line protocol files, sorted and vectorized:
+#   ./thermal_join.py merge ~/tmp/drift ~/tmp/temps --temperature-measurement ratos2 > joined.lp
+import argparse
+import bisect
+import csv
+import sys
+import time
+from collections import deque
+
+import metrics
+from capture import FLOAT, load_series, restore
+from lineprotocol import format_line, parse_line, parse_tags
+from streamio import StdinLines
+from summarizer import Watermark
+
+DEFAULT_FIELDS = ["extruder_temp", "heater_bed_temp", "extruder_pwm", "heater_bed_pwm"]
+# Tags that name the printer: gcode_response_spy.py --tag printer=..., collector.py's host
+MATCH_TAGS = ["printer", "host"]
+# Seconds since the temperature sample that was used (the older one when interpolating)
+AGE_FIELD = "temperature_age_s"
+
+def series_key(tag, match_tags):
+    # Which temperatures belong to which probe results: those with the same value of the first of the
+    # match tags they have. Lines with none of them share one key, and without match tags all lines do
+    if not match_tags or not tag:
+        return None
+    tags = parse_tags(tag)
+    for name in match_tags:
+        if name in tags:
+            return tags[name]
+    return None
+
+def interpolate(timestamp, before, after):
+    # Linear between two (timestamp, value) samples
+    (t0, v0), (t1, v1) = before, after
+    if t1 == t0:
+        return v1
+    return v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+
+class TemperatureHistory:
+    # The recent samples of one printer per field, (timestamp, value) in time order, at most `limit` each
+    def __init__(self, limit):
+        self.limit = limit
+        self.samples = {}
+        self.latest = None
+
+    def add(self, timestamp, fields):
+        for field, value in fields.items():
+            samples = self.samples.get(field)
+            if samples is None:
+                samples = self.samples[field] = deque(maxlen=self.limit)
+            if samples and timestamp < samples[-1][0]:
+                # Out of order, rare: keep the history sorted
+                samples = self.samples[field] = deque(sorted([*samples, (timestamp, value)]), maxlen=self.limit)
+            else:
+                samples.append((timestamp, value))
+        if self.latest is None or timestamp > self.latest:
+            self.latest = timestamp
+
+    def forget(self, before):
+        # Drop samples older than `before`, keeping the last one of each field for as-of lookups
+        for samples in self.samples.values():
+            while len(samples) > 1 and samples[1][0] <= before:
+                samples.popleft()
+
+    def lookup(self, field, timestamp, tolerance_ns, interpolated):
+        # (value, timestamp of the sample before) within the tolerance, (None, None) without one
+        samples = self.samples.get(field)
+        if not samples:
+            return None, None
+        position = bisect.bisect_right(samples, timestamp, key=lambda sample: sample[0])
+        if position == 0 or timestamp - samples[position - 1][0] > tolerance_ns:
+            return None, None
+        before = samples[position - 1]
+        if interpolated and position < len(samples) and samples[position][0] - timestamp <= tolerance_ns:
+            return interpolate(timestamp, before, samples[position]), before[0]
+        return before[1], before[0]
+
+class StreamJoin:
+    # Holds each probe result until a temperature at or after its time arrived (so interpolating has
+    # both sides and the latest value is final), the watermark of its printer passed its time plus the
+    # tolerance, or more than max_pending results are waiting. Each printer (match key) has its own
+    # watermark, so one that lags the others isn't joined before its temperatures arrive. Temperatures are kept for the tolerance plus
+    # the lateness, at most history samples per field.
+    def __init__(self, probe_measurement, temperature_measurement, fields=DEFAULT_FIELDS, tolerance=10.0,
+                 interpolated=False, match_tags=MATCH_TAGS, lateness=2.0, history=4096, max_pending=1024):
+        self.probe_measurement = probe_measurement
+        self.temperature_measurement = temperature_measurement
+        self.fields = fields
+        self.tolerance_ns = int(tolerance * 1e9)
+        self.lateness_ns = int(lateness * 1e9)
+        self.interpolated = interpolated
+        self.match_tags = match_tags
+        self.keys = {}  # Tag set -> series key, parsed once
+        self.history = history
+        self.max_pending = max_pending
+        self.temperatures = {}
+        self.pending = deque()
+        self.watermarks = {}  # Match key -> Watermark
+        self.unmatched = 0
+
+    def add(self, record):
+        # Returns the records that are done: the joined probe results and everything else as it came
+        timestamp = record['timestamp']
+        if timestamp is None:
+            return [record]
+        measurement = record['measurement']
+        if measurement not in (self.temperature_measurement, self.probe_measurement):
+            return [record]
+        key = self.key(record['tag'])
+        watermark = self.watermarks.get(key)
+        if watermark is None:
+            watermark = self.watermarks[key] = Watermark(self.lateness_ns)
+        watermark.observe(timestamp)
+        if measurement == self.temperature_measurement:
+            history = self.temperatures.get(key)
+            if history is None:
+                history = self.temperatures[key] = TemperatureHistory(self.history)
+            history.add(timestamp, {field: value for field, value in record['fields'].items() if field in self.fields})
+            history.forget(history.latest - self.tolerance_ns - self.lateness_ns)
+            return [record, *self.release()]
+        self.pending.append(record)
+        return self.release()
+
+    def key(self, tag):
+        if tag not in self.keys:
+            self.keys[tag] = series_key(tag, self.match_tags)
+        return self.keys[tag]
+
+    def ready(self, record, watermarks):
+        key = self.key(record['tag'])
+        history = self.temperatures.get(key)
+        if history is not None and history.latest >= record['timestamp']:
+            return True
+        if key not in watermarks:
+            watermarks[key] = self.watermarks[key].current()
+        return watermarks[key] >= record['timestamp'] + self.tolerance_ns
+
+    def release(self, flush=False):
+        # The pending results that are ready, in the order they came; later ones may overtake a waiting one
+        watermarks = {}  # Read once per call
+        done = []
+        waiting = deque()
+        while self.pending:
+            record = self.pending.popleft()
+            if flush or len(self.pending) + len(waiting) >= self.max_pending or self.ready(record, watermarks):
+                done.append(self.join(record))
+            else:
+                waiting.append(record)
+        self.pending = waiting
+        return done
+
+    def flush(self):
+        return self.release(flush=True)
+
+    def join(self, record):
+        history = self.temperatures.get(self.key(record['tag']))
+        fields = dict(record['fields'])
+        oldest = None
+        for field in self.fields:
+            value, sampled = history.lookup(field, record['timestamp'], self.tolerance_ns, self.interpolated) if history else (None, None)
+            if value is None:
+                continue
+            fields[field] = value
+            oldest = sampled if oldest is None else min(oldest, sampled)
+        if oldest is None:
+            self.unmatched += 1
+        else:
+            fields[AGE_FIELD] = (record['timestamp'] - oldest) / 1e9
+        return {**record, 'fields': fields}
+
+def asof_columns(timestamps, temperature_timestamps, temperature_columns, tolerance_ns, interpolated):
+    # The vectorized join: for every timestamp, each column's last non-NaN value at or before it
+    # within the tolerance (interpolated with the next one when that is within the tolerance too),
+    # plus the age of the oldest sample used. Temperature timestamps must be sorted.
+    import numpy as np
+    joined = {}
+    oldest = np.full(len(timestamps), np.iinfo(np.int64).max)
+    for field, values in temperature_columns.items():
+        valid = ~np.isnan(values)
+        sample_times, samples = (temperature_timestamps, values) if valid.all() else (temperature_timestamps[valid], values[valid])
+        result = np.full(len(timestamps), np.nan)
+        if not len(samples):
+            joined[field] = result
+            continue
+        before = np.searchsorted(sample_times, timestamps, "right") - 1
+        clipped = np.maximum(before, 0)
+        before_times = sample_times[clipped]
+        found = (before >= 0) & (timestamps - before_times <= tolerance_ns)
+        result[found] = samples[clipped[found]]
+        if interpolated:
+            after = np.minimum(before + 1, len(samples) - 1)
+            after_times = sample_times[after]
+            both = found & (before + 1 < len(samples)) & (after_times - timestamps <= tolerance_ns) & (after_times > before_times)
+            fraction = (timestamps[both] - before_times[both]) / (after_times[both] - before_times[both])
+            result[both] = samples[clipped[both]] + (samples[after[both]] - samples[clipped[both]]) * fraction
+        oldest[found] = np.minimum(oldest[found], before_times[found])
+        joined[field] = result
+    matched = oldest != np.iinfo(np.int64).max
+    joined[AGE_FIELD] = np.where(matched, (timestamps - np.where(matched, oldest, timestamps)) / 1e9, np.nan)
+    return joined
+
+def merge_series(probes, temperatures, fields, tolerance, interpolated, match_tags=MATCH_TAGS):
+    # Every probe series of `probes` with the temperature series of the same printer: [(series entry, timestamps, columns)]
+    import numpy as np
+    by_key = {}
+    for series, timestamps, columns in temperatures:
+        by_key.setdefault(series_key(series['tag'], match_tags), []).append((timestamps, columns))
+    joined = []
+    for series, timestamps, columns in probes:
+        parts = by_key.get(series_key(series['tag'], match_tags), [])
+        if parts:
+            temperature_timestamps = np.concatenate([part[0] for part in parts])
+            temperature_columns = {field: np.concatenate([part[1].get(field, np.full(len(part[0]), np.nan)) for part in parts])
+                                   for field in fields}
+            order = np.argsort(temperature_timestamps, kind="stable")
+            if (order != np.arange(len(order))).any():
+                temperature_timestamps = temperature_timestamps[order]
+                temperature_columns = {field: values[order] for field, values in temperature_columns.items()}
+        else:
+            temperature_timestamps = np.empty(0, np.int64)
+            temperature_columns = {field: np.empty(0) for field in fields}
+        extra = asof_columns(timestamps, temperature_timestamps, temperature_columns, int(tolerance * 1e9), interpolated)
+        joined.append((series, timestamps, {**columns, **extra}))
+    return joined
+
+def write_merged(joined, output_format, out):
+    names = []
+    for series, timestamps, columns in joined:
+        names += [name for name in columns if name not in names]
+    if output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(["measurement", "tag", "timestamp", *names])
+    for series, timestamps, columns in joined:
+        types = dict(zip(series['fields'], series.get('types') or [FLOAT] * len(series['fields'])))
+        values = [columns[name].tolist() if name in columns else [None] * len(timestamps) for name in names]
+        for timestamp, row in zip(timestamps.tolist(), zip(*values)):
+            if output_format == "csv":
+                writer.writerow([series['measurement'], series['tag'] or "", timestamp,
+                                 *("" if value is None or value != value else restore(value, types.get(name, FLOAT))
+                                   for name, value in zip(names, row))])
+                continue
+            fields = {name: restore(value, types.get(name, FLOAT)) for name, value in zip(names, row)
+                      if value is not None and value == value}
+            out.write(format_line(series['measurement'], series['tag'], fields, timestamp) + "\n")
+
+def add_arguments(parser):
+    parser.add_argument("--temperature-measurement", required=True, help="Measurement of the temperatures (templogger.py --measurement)")
+    parser.add_argument("--probe-measurement", default="probe", help="Measurement of the probe results (default: probe)")
+    parser.add_argument("--fields", nargs='+', default=DEFAULT_FIELDS,
+                        help="Temperature fields to attach (default: extruder_temp heater_bed_temp extruder_pwm heater_bed_pwm)")
+    parser.add_argument("--tolerance", type=float, default=10.0,
+                        help="Seconds a temperature sample may be away from the result to be used (default: 10)")
+    parser.add_argument("--interpolate", action="store_true",
+                        help="Interpolate between the samples before and after the result instead of taking the one before")
+    parser.add_argument("--match-tag", nargs='*', default=MATCH_TAGS, metavar="TAG",
+                        help="Tags that name the printer in both, the first one a line has counts (default: printer host); "
+                             "without any all results get the same temperatures")
+
+def add_stream_arguments(parser):
+    add_arguments(parser)
+    parser.add_argument("--lateness", type=float, default=2.0,
+                        help="Seconds to wait for temperatures after a result's time before joining it without (default: 2)")
+    parser.add_argument("--history", type=int, default=4096, help="Temperature samples kept per printer and field (default: 4096)")
+    parser.add_argument("--max-pending", type=int, default=1024,
+                        help="Results waiting for their temperatures before the oldest is joined with what there is (default: 1024)")
+
+def make_stream_join(args):
+    return StreamJoin(args.probe_measurement, args.temperature_measurement, fields=args.fields, tolerance=args.tolerance,
+                      interpolated=args.interpolate, match_tags=args.match_tag, lateness=args.lateness,
+                      history=args.history, max_pending=args.max_pending)
+
+def run_stream(args, stats):
+    joiner = make_stream_join(args)
+    stats.watch("pending", lambda: len(joiner.pending))
+    stats.watch("unmatched", lambda: joiner.unmatched)
+
+    def emit(records):
+        if records:
+            sys.stdout.write("".join(format_line(r['measurement'], r['tag'], r['fields'], r['timestamp']) + "\n" for r in records))
+            sys.stdout.flush()
+            stats.count("lines_out", len(records))
+
+    reader = StdinLines()
+    while True:
+        # Wake up now and then, so waiting results go out when the temperatures stop
+        lines = reader.read(0.5)
+        if lines is None:
+            break
+        start = time.perf_counter()
+        done = []
+        for line in lines:
+            record = parse_line(line)
+            if record is None:
+                stats.count("skipped")
+                continue
+            stats.count("lines_in")
+            done += joiner.add(record)
+        done += joiner.release()
+        stats.observe("join", time.perf_counter() - start)
+        emit(done)
+    emit(joiner.flush())
+    if joiner.unmatched:
+        print(f"{joiner.unmatched} results had no temperatures within {args.tolerance} s", file=sys.stderr)
+
+def run_merge(args):
+    probes = load_series(args.probes, args.probe_measurement)
+    temperatures = load_series(args.temperatures, args.temperature_measurement)
+    if not probes:
+        sys.exit(f"No {args.probe_measurement} results in {args.probes}")
+    if not temperatures:
+        sys.exit(f"No {args.temperature_measurement} temperatures in {args.temperatures}")
+    start = time.perf_counter()
+    joined = merge_series(probes, temperatures, args.fields, args.tolerance, args.interpolate, args.match_tag)
+    count = sum(len(timestamps) for _, timestamps, _ in joined)
+    unmatched = sum(int((columns[AGE_FIELD] != columns[AGE_FIELD]).sum()) for _, _, columns in joined)
+    print(f"Joined {count} results in {time.perf_counter() - start:.3f} s, {unmatched} without temperatures "
+          f"within {args.tolerance} s", file=sys.stderr)
+    write_merged(joined, args.format, sys.stdout)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Attach temperatures and PWM to probe results.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    stream = commands.add_parser("stream", help="Join a live line protocol stream with both on stdin")
+    add_stream_arguments(stream)
+    metrics.add_arguments(stream)
+    merge = commands.add_parser("merge", help="Join captured results with captured temperatures")
+    merge.add_argument("probes", help="Capture directory or line protocol file with the probe results ('-' for stdin)")
+    merge.add_argument("temperatures", help="Capture directory or line protocol file with the temperatures")
+    add_arguments(merge)
+    merge.add_argument("--format", choices=["line", "csv"], default="line", help="Output format (default: line)")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "stream":
+            run_stream(args, metrics.setup(args, "thermal_join"))
+        else:
+            run_merge(args)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass